@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Runs many model experiments in parallel processes, sharing loaded and prepared data between them."""
+import argparse
+import glob
+import json
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from ndj_pipeline import cache, config, model, prep, utils
+
+
+def find_configs(pattern: str) -> List[Path]:
+    """Experiment config files in a directory, or matching a glob pattern, in name order."""
+    path = Path(pattern)
+    if path.is_dir():
+        return sorted(p for p in path.iterdir() if p.suffix in [".yaml", ".json"])
+    return sorted(Path(p) for p in glob.glob(pattern))
+
+
+def prepare_snapshots(
+    model_configs: List[Dict[str, Any]], cache_folder: Path = Path(config.default_cache_folder, "batch")
+) -> Dict[str, Path]:
+    """Creates one Arrow IPC snapshot per data file, shared by every experiment using it.
+
+    Each snapshot holds the union of columns required by its experiments, see
+    `prep.required_columns`, and is keyed by the data file fingerprint and those
+    columns, so it is reused across batches until either changes. Experiments
+    memory map the snapshot rather than each re-reading the parquet data.
+    Experiments with `pushdown_filters` read their own filtered data instead.
+
+    Args:
+        model_configs: Loaded model experiment configs
+        cache_folder: Location of snapshots
+
+    Returns:
+        Mapping of experiment run name to its data snapshot.
+    """
+    groups: Dict[Path, List[Dict[str, Any]]] = {}
+    for model_config in model_configs:
+        if not model_config.get("pushdown_filters"):
+            groups.setdefault(Path(*model_config["data_file"]), []).append(model_config)
+
+    snapshots = {}
+    for input_path, group in groups.items():
+        # Missing columns are left out, and reported by the experiments needing them
+        available = set(utils.read_parquet_schema(input_path).names)
+        columns = sorted({col for model_config in group for col in prep.required_columns(model_config)} & available)
+        key = {"data": cache.path_fingerprint(input_path), "columns": columns}
+        snapshot_path = Path(cache_folder, f"data_{cache.hash_object(key)[:16]}.arrow")
+        if snapshot_path.exists():
+            logging.info(f"Using snapshot {snapshot_path} of {input_path} for {len(group)} experiments")
+        else:
+            logging.info(f"Saving {len(columns)} columns of {input_path} to snapshot {snapshot_path}")
+            cache_folder.mkdir(parents=True, exist_ok=True)
+            cache.write_snapshot(utils.read_parquet_dataset(input_path, columns=columns), snapshot_path)
+        snapshots.update({model_config["run_name"]: snapshot_path for model_config in group})
+    return snapshots
+
+
+def prepare_training_data(
+    model_configs: List[Dict[str, Any]],
+    snapshots: Dict[str, Path],
+    processes: Optional[int] = None,
+    use_cache: bool = True,
+    cache_folder: Path = Path(config.default_cache_folder, "batch"),
+) -> Dict[str, Path]:
+    """Runs the data preparation stages of model training once for each group of experiments sharing them.
+
+    Experiments are grouped by the hash of the last of `model.shared_stages`,
+    which covers the data file, code and config keys of every shared stage.
+    Each group is prepared in parallel processes, see
+    `model.prepare_shared_stages`, and its train and test data memory mapped by
+    every experiment in it. Prepared data is reused across batches until the
+    hash changes. Groups whose preparation fails are left out, so that their
+    experiments run and report it themselves.
+
+    Args:
+        model_configs: Loaded model experiment configs
+        snapshots: Data snapshot of each experiment run name, see `prepare_snapshots`
+        processes: Maximum groups prepared at once, by default the number of CPUs
+        use_cache: Reuse previously prepared data, otherwise prepare every group again
+        cache_folder: Location of prepared data
+
+    Returns:
+        Mapping of experiment run name to its prepared data folder.
+    """
+    groups: Dict[Path, List[Dict[str, Any]]] = {}
+    for model_config in model_configs:
+        stage_hash = model.stage_hashes(model_config)[len(model.shared_stages) - 1]["hash"]
+        groups.setdefault(Path(cache_folder, f"prep_{stage_hash[:16]}"), []).append(model_config)
+
+    prepared = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        jobs = {}
+        for output_folder, group in groups.items():
+            if use_cache and Path(output_folder, "prepared.json").exists():
+                logging.info(f"Using prepared data {output_folder} for {len(group)} experiments")
+                prepared.update({model_config["run_name"]: output_folder for model_config in group})
+                continue
+            snapshot = snapshots.get(group[0]["run_name"])
+            job = executor.submit(model.prepare_shared_stages, group[0], output_folder, snapshot)
+            jobs[job] = (output_folder, group)
+        for job in as_completed(jobs):
+            output_folder, group = jobs[job]
+            try:
+                job.result()
+            except Exception:
+                logging.exception(f"Preparing data for {group[0]['run_name']} failed")
+                continue
+            prepared.update({model_config["run_name"]: output_folder for model_config in group})
+    return prepared
+
+
+def run_experiment(
+    config_path: Path, snapshot: Optional[Path] = None, prepared: Optional[Path] = None, use_cache: bool = True
+) -> Dict[str, Any]:
+    """Trains one experiment, returning its run time and metrics.
+
+    Runs in a worker process. Logs are also written to the experiment's model
+    folder, as with `model.main`. Failures are logged and returned, rather than
+    stopping other experiments.
+
+    Args:
+        config_path: Path to model experiment yaml or json
+        snapshot: Optional data snapshot, see `prepare_snapshots`
+        prepared: Optional folder of prepared train and test data, see `prepare_training_data`
+        use_cache: Resume from cached stages, see `model.run_model_training`
+
+    Returns:
+        Dictionary of config path, run name, status, wall time, error and metrics,
+        including cross validation mean metrics with a `cv_` prefix.
+    """
+    start = time.perf_counter()
+    model_config = utils.load_model_config(str(config_path))
+    summary: Dict[str, Any] = {"config": str(config_path), "run_name": model_config["run_name"]}
+
+    utils.create_model_folder(model_config)
+    model_path = utils.get_model_path(model_config)
+    handler = logging.FileHandler(Path(model_path, "_log.txt"))
+    handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+    logging.getLogger().addHandler(handler)
+    try:
+        model.run_model_training(model_config, use_cache=use_cache, snapshot=snapshot, prepared=prepared)
+        summary["status"] = "success"
+    except Exception as e:
+        logging.exception(f"Experiment {config_path} failed")
+        summary.update({"status": "failed", "error": repr(e)})
+    finally:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+    summary["wall_time"] = round(time.perf_counter() - start, 3)
+
+    metrics_path = Path(model_path, "metrics.json")
+    if summary["status"] == "success" and metrics_path.exists():
+        with open(metrics_path, "r") as f:
+            summary.update(json.load(f))
+    cv_path = Path(model_path, "metrics_cv.json")
+    if summary["status"] == "success" and cv_path.exists():
+        with open(cv_path, "r") as f:
+            summary.update({f"cv_{name}": value for name, value in json.load(f)["mean"].items()})
+    return summary
+
+
+def run(
+    config_paths: List[Path],
+    processes: Optional[int] = None,
+    use_cache: bool = True,
+    output_path: Path = Path(config.default_model_folder, "batch_summary.csv"),
+    cache_folder: Path = Path(config.default_cache_folder, "batch"),
+) -> pd.DataFrame:
+    """Runs model experiments in parallel processes, and summarises their run times and metrics.
+
+    Data files are read once into shared snapshots before experiments start,
+    see `prepare_snapshots`, and prepared once for each group of experiments
+    sharing the data preparation stages, see `prepare_training_data`. Each
+    experiment otherwise runs as `python -m ndj_pipeline.model` would,
+    including resuming from cached stages.
+
+    Args:
+        config_paths: Paths to model experiment yaml or json files
+        processes: Maximum experiments run at once, by default the number of CPUs
+        use_cache: Resume from cached stages, otherwise re-run every stage
+        output_path: Summary csv, with one row per experiment
+        cache_folder: Location of data snapshots and prepared data
+
+    Returns:
+        Summary DataFrame, see `run_experiment`.
+
+    Raises:
+        ValueError: If there are no configs, or several configs share a run name.
+    """
+    if not config_paths:
+        raise ValueError("No experiment configs to run")
+    model_configs = [utils.load_model_config(str(path)) for path in config_paths]
+    run_names = pd.Series([model_config["run_name"] for model_config in model_configs])
+    duplicated = run_names[run_names.duplicated()].unique()
+    if len(duplicated):
+        raise ValueError(f"Experiment run names must be unique; {', '.join(duplicated)}")
+
+    snapshots = prepare_snapshots(model_configs, cache_folder)
+    prepared = prepare_training_data(model_configs, snapshots, processes, use_cache, cache_folder)
+
+    logging.info(f"Running {len(config_paths)} experiments")
+    summaries = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        jobs = [
+            executor.submit(
+                run_experiment,
+                path,
+                snapshots.get(model_config["run_name"]),
+                prepared.get(model_config["run_name"]),
+                use_cache,
+            )
+            for path, model_config in zip(config_paths, model_configs)
+        ]
+        for job in as_completed(jobs):
+            summary = job.result()
+            logging.info(f"Finished {summary['run_name']} with status {summary['status']} in {summary['wall_time']}s")
+            summaries.append(summary)
+
+    summary_df = pd.DataFrame(summaries).sort_values("config").reset_index(drop=True)
+    logging.info(f"Saving batch summary to {output_path}")
+    summary_df.to_csv(output_path, index=False)
+    return summary_df
+
+
+def main() -> None:
+    """Run many model experiments from command line using...
+
+    `python -m ndj_pipeline.batch -p {config_folder_or_glob}`
+    """
+    parser = argparse.ArgumentParser(description="ndj_pipeline batch model training")
+    parser.add_argument("-p", type=str, help="Folder of model experiment yamls, or glob pattern i.e. 'data/*.yaml'")
+    parser.add_argument("-n", type=int, help="Maximum experiments run at once, by default the number of CPUs")
+    parser.add_argument("-o", type=str, help="Summary csv path, by default data/batch_summary.csv")
+    parser.add_argument("--no-cache", action="store_true", help="Re-run every training stage")
+    parser.add_argument("-v", action="store_true", help="Debug mode")
+
+    args = parser.parse_args()
+    log_level = logging.DEBUG if args.v else logging.INFO
+    logging.basicConfig(
+        level=log_level,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler()],
+    )
+
+    output_path = Path(args.o) if args.o else Path(config.default_model_folder, "batch_summary.csv")
+    run(find_configs(args.p), processes=args.n, use_cache=not args.no_cache, output_path=output_path)
+
+
+if __name__ == "__main__":
+    main()
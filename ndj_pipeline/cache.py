@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Content addressed caching of pipeline artifacts.
+
+Cached DataFrames are stored as Arrow IPC snapshots alongside a small json manifest.
+A cache entry is reused while the fingerprints of its input files and its key
+(i.e. schema hash, library version) are unchanged.
+
+Input files are compared on size and modification time first. If only the
+modification time differs, the content hash is compared before the cache is
+invalidated, so that touched but unchanged files are not reprocessed.
+
+Pipeline stages, i.e. of model training, are cached as pickles of the values
+they set, keyed by a hash of their inputs, see `load_stage` and `save_stage`.
+"""
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import pandas as pd
+import pyarrow as pa
+
+from ndj_pipeline import config
+
+
+def hash_file(path: Path, block_size: int = 1 << 20) -> str:
+    """Returns sha256 hex digest of file contents, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_file_range(path: Path, start: int, end: int) -> str:
+    """Returns sha256 hex digest of a byte range of a file, i.e. the tail of a previous read."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        return hashlib.sha256(f.read(end - start)).hexdigest()
+
+
+def hash_object(obj: Any) -> str:
+    """Returns sha256 hex digest of a json serializable object, i.e. a config subset."""
+    serialized = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(path: Path) -> Dict[str, int]:
+    """Returns the cheap size and modification time fingerprint of a file."""
+    stat = Path(path).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def write_snapshot(df: pd.DataFrame, output_path: Path) -> None:
+    """Writes DataFrame as an Arrow IPC file, keeping index and pandas dtypes."""
+    table = pa.Table.from_pandas(df)
+    temp_path = output_path.with_suffix(".tmp")
+    with pa.OSFile(str(temp_path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    temp_path.replace(output_path)
+
+
+def read_snapshot(input_path: Path, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Reads an Arrow IPC snapshot using a memory map, rather than buffered reads.
+
+    With a subset of columns, only those columns and the stored row index are
+    converted to pandas.
+    """
+    with pa.memory_map(str(input_path), "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    if columns is not None:
+        metadata = table.schema.pandas_metadata or {}
+        index_columns = [col for col in metadata.get("index_columns", []) if isinstance(col, str)]
+        table = table.select(columns + [col for col in index_columns if col not in columns])
+    return table.to_pandas()
+
+
+def inputs_unchanged(stored: Dict[str, Dict[str, Any]], input_paths: List[Path]) -> bool:
+    """Compares input files to their stored fingerprints.
+
+    Updates stored modification times in place where contents are unchanged.
+
+    Args:
+        stored: Mapping of input path to stored size, mtime and sha256
+        input_paths: Current input files
+
+    Returns:
+        True if all input files have the same contents as stored.
+    """
+    if sorted(stored) != sorted(str(path) for path in input_paths):
+        return False
+
+    for path in input_paths:
+        previous = stored[str(path)]
+        current = file_fingerprint(path)
+        if current == {"size": previous["size"], "mtime_ns": previous["mtime_ns"]}:
+            continue
+        if current["size"] != previous["size"]:
+            logging.debug(f"{path} size has changed")
+            return False
+        logging.debug(f"{path} modification time has changed, comparing contents")
+        if hash_file(path) != previous["sha256"]:
+            return False
+        previous.update(current)
+    return True
+
+
+def load_or_create(
+    name: str,
+    input_paths: List[Path],
+    key: Dict[str, Any],
+    create: Callable[[], pd.DataFrame],
+    cache_folder: Path = config.default_cache_folder,
+) -> pd.DataFrame:
+    """Returns a cached DataFrame if its inputs and key are unchanged, otherwise creates and caches it.
+
+    Args:
+        name: Cache entry name, used for file naming
+        input_paths: Files the DataFrame is derived from
+        key: Json serializable values which invalidate the cache when changed
+        create: Function producing the DataFrame on a cache miss
+        cache_folder: Location of snapshots and manifests
+
+    Returns:
+        Pandas DataFrame, either loaded from snapshot or newly created.
+    """
+    manifest_path = Path(cache_folder, f"{name}.json")
+    snapshot_path = Path(cache_folder, f"{name}.arrow")
+
+    if manifest_path.exists() and snapshot_path.exists():
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest["key"] == key and inputs_unchanged(manifest["inputs"], input_paths):
+            logging.info(f"Loading cached {name} from {snapshot_path}")
+            with open(manifest_path, "w") as f:
+                json.dump(manifest, f, indent=4)
+            return read_snapshot(snapshot_path)
+        logging.info(f"Cached {name} is out of date")
+
+    df = create()
+
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    logging.info(f"Saving {name} to cache {snapshot_path}")
+    write_snapshot(df, snapshot_path)
+    manifest = {
+        "key": key,
+        "inputs": {str(path): {**file_fingerprint(path), "sha256": hash_file(path)} for path in input_paths},
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    return df
+
+
+def path_fingerprint(path: Path) -> Dict[str, Dict[str, int]]:
+    """Size and modification time of a file, or of every file in a directory such as a parquet dataset."""
+    path = Path(path)
+    paths = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+    return {str(p): file_fingerprint(p) for p in paths}
+
+
+def file_mtimes(folder: Path) -> Dict[str, int]:
+    """Modification times of the files directly in a folder, except private files starting with `_`."""
+    if not folder.exists():
+        return {}
+    return {str(p): p.stat().st_mtime_ns for p in folder.iterdir() if p.is_file() and not p.name.startswith("_")}
+
+
+def load_stage(name: str, key_hash: str, cache_folder: Path) -> Optional[Dict[str, Any]]:
+    """Returns the manifest of a cached pipeline stage, if it was saved with the same key.
+
+    Args:
+        name: Stage name, used for file naming
+        key_hash: Hash of everything the stage depends on, including upstream stage hashes
+        cache_folder: Location of stage results
+
+    Returns:
+        Stage manifest, see `save_stage`, or None if the stage needs to be run
+        because its key changed, or its saved values or output files are missing.
+    """
+    manifest_path = Path(cache_folder, f"{name}.json")
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if manifest["hash"] != key_hash or "saved" not in manifest:
+        return None
+    saved = [Path(cache_folder, f"{name}_{value_name}.pkl") for value_name in manifest["saved"]]
+    missing = [str(path) for path in saved + [Path(path) for path in manifest["outputs"]] if not path.exists()]
+    if missing:
+        logging.debug(f"Stage {name} outputs missing; {', '.join(missing)}")
+        return None
+    return manifest
+
+
+def load_stage_state(manifests: List[Dict[str, Any]], cache_folder: Path) -> Optional[Dict[str, Any]]:
+    """Rebuilds the pipeline state after the last of a sequence of cached stages.
+
+    Each value is loaded from the latest stage which saved it, see `save_stage`.
+
+    Args:
+        manifests: Manifests of consecutive cached stages, see `load_stage`
+        cache_folder: Location of stage results
+
+    Returns:
+        Pipeline state, or None if a value was not saved by any of the stages.
+    """
+    state = {}
+    for value_name in manifests[-1]["state"]:
+        manifest = next((m for m in reversed(manifests) if value_name in m["saved"]), None)
+        if manifest is None:
+            return None
+        state[value_name] = pd.read_pickle(Path(cache_folder, f"{manifest['name']}_{value_name}.pkl"))
+    return state
+
+
+def save_stage(
+    name: str,
+    key: Dict[str, Any],
+    key_hash: str,
+    result: Dict[str, Any],
+    cache_folder: Path,
+    saved: Sequence[str] = (),
+    outputs: Sequence[str] = (),
+) -> None:
+    """Saves a pipeline stage with its key, see `load_stage`.
+
+    Only the state values set by the stage are pickled, one file each, so data
+    passed through unchanged is not saved again by every stage. The manifest
+    lists all state values after the stage, for `load_stage_state`.
+
+    Args:
+        name: Stage name, used for file naming
+        key: Everything the stage depends on, saved for reference
+        key_hash: Hash of the key
+        result: Pipeline state after the stage
+        cache_folder: Location of stage results
+        saved: Names of the state values set by the stage
+        outputs: Files written by the stage, which must still exist for the cache to be used
+    """
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    manifest_path = Path(cache_folder, f"{name}.json")
+    if manifest_path.exists():
+        manifest_path.unlink()
+    for path in cache_folder.glob(f"{name}_*.pkl"):
+        path.unlink()
+
+    saved = [value_name for value_name in saved if value_name in result]
+    for value_name in saved:
+        result_path = Path(cache_folder, f"{name}_{value_name}.pkl")
+        logging.debug(f"Saving stage {name} {value_name} to cache {result_path}")
+        pd.to_pickle(result[value_name], result_path)
+    manifest = {
+        "name": name,
+        "hash": key_hash,
+        "key": key,
+        "state": list(result),
+        "saved": saved,
+        "outputs": list(outputs),
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4, default=str)
@@ -23,3 +23,13 @@
 from pathlib import Path
 
 default_model_folder = Path("data")
+
+# Rows per chunk when streaming raw files through schema checks
+default_chunksize = 100_000
+
+# Snapshots of validated and prepared data, reused while inputs are unchanged
+default_cache_folder = Path("data", "cache")
+
+# Raw files and their schemas, paired by name for data checks
+default_raw_folder = Path("data")
+default_schema_folder = Path("schemas")
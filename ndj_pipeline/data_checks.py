@@ -36,38 +36,896 @@ Schema checks are useful to standardize certain information in raw data includin
 
 Schemas can often be re-applied to similar data files, i.e. tabs of an excel, or train/test data.
 """
+import argparse
+import inspect
 import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import SEEK_END, BufferedReader, RawIOBase
 from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
+import pandera
+import pyarrow as pa
+import yaml
 from pandera import io
+from pandera.errors import SchemaErrors
+from pyarrow import csv
 
-from ndj_pipeline import utils
+from ndj_pipeline import cache, config, utils
 
+# Parse time types for schema dtypes. Integers are parsed as nullable and
+# narrowed after parsing, so that unexpected missing values are reported by
+# the schema check rather than failing the parser.
+parse_dtypes = {
+    "int64": "Int64",
+    "int32": "Int64",
+    "Int64": "Int64",
+    "Int32": "Int64",
+    "float64": "float64",
+    "float32": "float64",
+    "str": "object",
+    "string": "object",
+    "object": "object",
+    "category": "category",
+    "bool": "boolean",
+    "boolean": "boolean",
+}
 
-def check_titanic() -> pd.DataFrame:
-    """Data schema and typing validations.
+arrow_dtypes = {
+    "Int64": pa.int64(),
+    "float64": pa.float64(),
+    "object": pa.string(),
+    "category": pa.dictionary(pa.int32(), pa.string()),
+    "boolean": pa.bool_(),
+}
+
+
+def load_schema(schema_path: Path) -> pandera.DataFrameSchema:
+    """Loads a pandera schema from yaml."""
+    logging.debug(f"Loading schema from {schema_path}")
+    with open(schema_path, "r") as f:
+        return io.from_yaml(f)
+
+
+def get_column_specs(schema_path: Path, input_path: Path) -> Dict[str, Dict[str, Any]]:
+    """Derives parse time typing for each raw csv column from a schema yaml.
+
+    Raw column names are matched to schema columns after `utils.clean_column_names`.
+    Columns with a `recode` mapping in the schema are parsed as strings,
+    to be recoded and typed after parsing. Columns with `category` dtype
+    are parsed directly as categoricals.
+
+    Args:
+        schema_path: Pandera yaml schema
+        input_path: Raw csv, only the header is read
 
     Returns:
-        Loaded pandas dataframe with typing and schema checks.
+        Dict of raw column name to its clean name, schema dtype, parse dtype
+        and optional recode mapping.
     """
-    # Standardize column names
-    input_path = Path("data", "titanic.csv")
-    logging.info(f"Loading data from {input_path}")
-    df = pd.read_csv(input_path)
+    with open(schema_path, "r") as f:
+        schema_columns = yaml.safe_load(f)["columns"]
+
+    raw_columns = pd.read_csv(input_path, nrows=0).columns.tolist()
+    specs = {}
+    for raw, clean in utils.clean_column_names(raw_columns).items():
+        column = schema_columns.get(clean)
+        if column is None:
+            continue
+        dtype = column.get("dtype", column.get("pandas_dtype"))
+        recode = column.get("recode")
+
+        parse_dtype = "object" if recode else parse_dtypes.get(dtype)
 
+        specs[raw] = {
+            "name": clean,
+            "dtype": dtype,
+            "parse_dtype": parse_dtype,
+            "nullable": column.get("nullable", True),
+            "recode": recode,
+        }
+    return specs
+
+
+def finalise_dtypes(df: pd.DataFrame, specs: Dict[str, Dict[str, Any]]) -> pd.DataFrame:
+    """Renames, recodes and narrows typed columns after parsing.
+
+    Args:
+        df: Parsed raw data with raw column names
+        specs: Column specs from `get_column_specs`
+
+    Returns:
+        Pandas dataframe with clean column names and schema dtypes.
+    """
     df = df.rename(columns=utils.clean_column_names(df))  # type: ignore
+    for spec in specs.values():
+        name = spec["name"]
+        if spec["recode"]:
+            df[name] = df[name].map(spec["recode"]).astype(parse_dtypes.get(spec["dtype"], "object"))
+        if spec["dtype"] in ("int64", "int32") and not df[name].hasnans:
+            df[name] = df[name].to_numpy(dtype=spec["dtype"])
+    return df
+
+
+def _csv_options(specs: Dict[str, Dict[str, Any]]) -> csv.ConvertOptions:
+    """Arrow csv conversion options with column types from specs."""
+    column_types = {raw: arrow_dtypes[spec["parse_dtype"]] for raw, spec in specs.items() if spec["parse_dtype"]}
+    return csv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+
+
+def _arrow_to_pandas(table: pa.Table) -> pd.DataFrame:
+    """Converts arrow table to pandas, keeping integer columns nullable."""
+    return table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype(), pa.bool_(): pd.BooleanDtype()}.get)
+
+
+def read_typed_csv(input_path: Path, schema_path: Path, engine: str = "c") -> pd.DataFrame:
+    """Reads a raw csv in a single typed pass, using dtypes derived from its schema.
+
+    Args:
+        input_path: Raw csv
+        schema_path: Pandera yaml schema
+        engine: Either pandas "c" parser, or multi-threaded "pyarrow" csv reader
+
+    Returns:
+        Pandas dataframe with clean column names and schema dtypes.
+    """
+    specs = get_column_specs(schema_path, input_path)
+    logging.info(f"Loading data from {input_path} using {engine} engine")
+    if engine == "pyarrow":
+        df = _arrow_to_pandas(csv.read_csv(input_path, convert_options=_csv_options(specs)))
+    else:
+        dtypes = {raw: spec["parse_dtype"] for raw, spec in specs.items() if spec["parse_dtype"]}
+        df = pd.read_csv(input_path, dtype=dtypes, engine=engine)
+    return finalise_dtypes(df, specs)
+
+
+class _BoundedReader(RawIOBase):
+    """Read only view of a file handle, ending after a fixed number of bytes."""
+
+    def __init__(self, handle: BinaryIO, length: int) -> None:
+        self.handle = handle
+        self.remaining = length
+
+    def readable(self) -> bool:
+        """Always readable."""
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        """Reads into buffer, up to the remaining bytes."""
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        data = self.handle.read(size)
+        buffer[: len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def complete_lines_end(input_path: Path, block_size: int = 1 << 16) -> int:
+    """Byte offset just after the last newline, excluding any partly written final line."""
+    with open(input_path, "rb") as f:
+        position = f.seek(0, SEEK_END)
+        while position > 0:
+            start = max(0, position - block_size)
+            f.seek(start)
+            block = f.read(position - start)
+            newline = block.rfind(b"\n")
+            if newline >= 0:
+                return start + newline + 1
+            position = start
+    return 0
+
+
+def iter_typed_csv(
+    input_path: Path,
+    schema_path: Path,
+    chunksize: int = config.default_chunksize,
+    engine: str = "c",
+    start: int = 0,
+    end: Optional[int] = None,
+    row_offset: int = 0,
+) -> Iterator[pd.DataFrame]:
+    """Streaming version of `read_typed_csv`.
+
+    A byte range of the file can be read, i.e. rows appended since a previous
+    read. Ranges starting after the header use the header of the whole file.
+
+    Args:
+        input_path: Raw csv
+        schema_path: Pandera yaml schema
+        chunksize: Number of rows per chunk
+        engine: Either pandas "c" parser, or multi-threaded "pyarrow" csv reader
+        start: Byte offset to start reading from, must be the start of a line
+        end: Optional byte offset to stop reading at, must be the end of a line
+        row_offset: Row index of the first row read
+
+    Yields:
+        Pandas dataframe chunks with clean column names and schema dtypes.
+        Row index continues across chunks.
+    """
+    specs = get_column_specs(schema_path, input_path)
+    names = pd.read_csv(input_path, nrows=0).columns.tolist() if start else None
+    logging.info(f"Streaming data from {input_path} in chunks of {chunksize} rows using {engine} engine")
+
+    with open(input_path, "rb") as f:
+        f.seek(start)
+        handle = BufferedReader(_BoundedReader(f, end - start)) if end is not None else f
+
+        if engine != "pyarrow":
+            dtypes = {raw: spec["parse_dtype"] for raw, spec in specs.items() if spec["parse_dtype"]}
+            header = None if names else "infer"
+            for chunk in pd.read_csv(
+                handle, dtype=dtypes, chunksize=chunksize, engine=engine, header=header, names=names
+            ):
+                chunk.index = chunk.index + row_offset
+                yield finalise_dtypes(chunk, specs)
+            return
+
+        # Arrow reads in blocks of bytes, so record batches are regrouped into exact row chunks
+        reader = csv.open_csv(
+            handle, read_options=csv.ReadOptions(column_names=names), convert_options=_csv_options(specs)
+        )
+        batches: List[pa.RecordBatch] = []
+        buffered = 0
+        offset = row_offset
+        for batch in reader:
+            batches.append(batch)
+            buffered += batch.num_rows
+            while buffered >= chunksize:
+                table = pa.Table.from_batches(batches)
+                chunk = _arrow_to_pandas(table.slice(0, chunksize))
+                chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+                offset += len(chunk)
+                yield finalise_dtypes(chunk, specs)
+                batches = table.slice(chunksize).to_batches()
+                buffered = table.num_rows - len(chunk)
+        if buffered:
+            chunk = _arrow_to_pandas(pa.Table.from_batches(batches))
+            chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+            yield finalise_dtypes(chunk, specs)
+
+
+class DuplicateTracker:
+    """Detects duplicate rows or keys across a stream of DataFrame chunks.
+
+    Rows, or the given key columns, are hashed into uint64 values in a single
+    vectorised pass. Keys seen so far are held as a few sorted runs of hashes,
+    merged as they grow, so memory is 8 bytes per distinct key rather than a
+    deduplicated copy of the data.
+
+    With 64 bit hashes a collision between distinct keys is possible but very
+    unlikely (around n^2 / 2^65 for n keys). The reported sample holds actual
+    key values, so reported duplicates can be confirmed.
+
+    Args:
+        columns: Key columns to check for uniqueness, or all columns if None
+        sample_size: Number of duplicate keys to keep for reporting
+    """
+
+    def __init__(self, columns: Optional[List[str]] = None, sample_size: int = 10) -> None:
+        self.columns = columns
+        self.sample_size = sample_size
+        self.duplicates = 0
+        self.sample: List[Dict[str, Any]] = []
+        self._runs: List[np.ndarray] = []
+
+    @property
+    def label(self) -> str:
+        """Description of what is checked for uniqueness."""
+        return ", ".join(self.columns) if self.columns else "full rows"
+
+    def update(self, df: pd.DataFrame) -> np.ndarray:
+        """Adds a chunk of rows, returning a mask of rows which duplicate earlier keys."""
+        keys = df if self.columns is None else df[self.columns]
+        hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+        duplicated = pd.Series(hashes).duplicated().to_numpy()
+        for run in self._runs:
+            position = np.searchsorted(run, hashes).clip(max=len(run) - 1)
+            duplicated |= run[position] == hashes
+
+        self._add_run(np.unique(hashes[~duplicated]))
+
+        count = int(duplicated.sum())
+        if count:
+            self.duplicates += count
+            remaining = self.sample_size - len(self.sample)
+            if remaining > 0:
+                self.sample += keys.loc[duplicated].head(remaining).reset_index().to_dict("records")
+        return duplicated
+
+    def _add_run(self, run: np.ndarray) -> None:
+        """Adds newly seen hashes, merging runs of similar size to keep lookups few."""
+        if not len(run):
+            return
+        self._runs.append(run)
+        while len(self._runs) > 1 and len(self._runs[-2]) <= 2 * len(self._runs[-1]):
+            last = self._runs.pop()
+            self._runs[-1] = np.sort(np.concatenate([self._runs[-1], last]))
+
+    def seen(self) -> np.ndarray:
+        """Sorted hashes of all distinct keys seen so far, i.e. to save tracker state between runs."""
+        return np.sort(np.concatenate(self._runs)) if self._runs else np.empty(0, dtype=np.uint64)
+
+    def add_seen(self, hashes: np.ndarray) -> None:
+        """Restores hashes of previously seen keys, see `seen`."""
+        self._add_run(np.unique(hashes))
+
+    def report(self) -> Dict[str, Any]:
+        """Summary of duplicates found, with a sample of offending keys and their row index."""
+        return {"key": self.label, "duplicates": self.duplicates, "sample": self.sample}
+
+
+def create_duplicate_trackers(schema: pandera.DataFrameSchema) -> List[DuplicateTracker]:
+    """Trackers for full row duplicates, and for each schema column with `allow_duplicates: false`."""
+    unique_columns = [name for name, column in schema.columns.items() if column.unique]
+    return [DuplicateTracker()] + [DuplicateTracker([name]) for name in unique_columns]
+
+
+def without_unique_checks(schema: pandera.DataFrameSchema) -> pandera.DataFrameSchema:
+    """Copy of schema with column uniqueness checks removed, as these are left to `DuplicateTracker`."""
+    return schema.update_columns({name: {"unique": False} for name, column in schema.columns.items() if column.unique})
+
+
+def track_duplicates(df: pd.DataFrame, trackers: List[DuplicateTracker]) -> pd.DataFrame:
+    """Updates duplicate trackers with a DataFrame or chunk.
+
+    Args:
+        df: Typed data, or a chunk of it
+        trackers: Trackers from `create_duplicate_trackers`
+
+    Returns:
+        Failure cases for duplicate rows, in the same layout as pandera failure cases.
+    """
+    failures = []
+    for tracker in trackers:
+        duplicated = tracker.update(df)
+        if duplicated.any():
+            failures.append(
+                pd.DataFrame(
+                    {
+                        "schema_context": "Column" if tracker.columns else "DataFrameSchema",
+                        "column": tracker.label if tracker.columns else None,
+                        "check": "field_uniqueness" if tracker.columns else "no_duplicate_rows",
+                        "failure_case": "duplicate",
+                        "index": df.index[duplicated],
+                    }
+                )
+            )
+    if not failures:
+        return pd.DataFrame()
+    return pd.concat(failures, ignore_index=True)
+
+
+def structural_schema(schema: pandera.DataFrameSchema) -> pandera.DataFrameSchema:
+    """Copy of schema with only structural checks; column set, order and dtypes."""
+    return schema.update_columns({name: {"checks": [], "nullable": True} for name in schema.columns})
+
+
+def list_value_checks(schema: pandera.DataFrameSchema) -> List[Dict[str, Any]]:
+    """Lists value checks per column, with the check number pandera reports in failure cases.
+
+    Nullability is not a numbered check, so has no check number.
+    """
+    checks: List[Dict[str, Any]] = []
+    for name, column in schema.columns.items():
+        if not column.nullable:
+            checks.append({"column": name, "check": "not_nullable", "check_number": None})
+        for i, check in enumerate(column.checks):
+            checks.append({"column": name, "check": str(check.error or check.name), "check_number": i})
+    return checks
+
+
+def sample_rows(
+    df: pd.DataFrame, sample: float, stratify: Optional[List[str]] = None, random_state: int = 42
+) -> pd.DataFrame:
+    """Reproducible, optionally stratified, sample of rows.
+
+    Args:
+        df: Typed data, or a chunk of it
+        sample: Fraction of rows if 1 or less, otherwise a number of rows
+        stratify: Columns to sample within, so that each group keeps its share of rows
+        random_state: Seed for reproducible samples
+
+    Returns:
+        Sampled rows, keeping original row index.
+    """
+    frac = sample if sample <= 1 else min(1.0, sample / max(len(df), 1))
+    if stratify:
+        return df.groupby(stratify, group_keys=False, dropna=False).sample(frac=frac, random_state=random_state)
+    return df.sample(frac=frac, random_state=random_state)
+
+
+def validate_sampled(
+    df: pd.DataFrame,
+    schema: pandera.DataFrameSchema,
+    sample: float,
+    stratify: Optional[List[str]] = None,
+    random_state: int = 42,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Validates structure on all rows, and value checks on a sample of rows.
+
+    Structural checks (column set, dtypes) are cheap and run on every row.
+    Value checks (`isin`, ranges, nullability) run on a reproducible, optionally
+    stratified, sample. Uniqueness is not sampled, see `DuplicateTracker`.
+
+    Args:
+        df: Typed data, or a chunk of it
+        schema: Pandera schema, without uniqueness checks
+        sample: Fraction of rows if 1 or less, otherwise a number of rows
+        stratify: Columns to sample within
+        random_state: Seed for reproducible samples
+
+    Returns:
+        Validated data, pandera style failure cases (empty if passed), and a
+        coverage report with rows checked and failures found per check.
+    """
+    failures = []
+    try:
+        df = structural_schema(schema).validate(df, lazy=True)
+    except SchemaErrors as err:
+        failures.append(err.failure_cases)
+
+    sampled = sample_rows(df, sample, stratify, random_state)
+    try:
+        schema.validate(sampled, lazy=True)
+    except SchemaErrors as err:
+        failures.append(err.failure_cases)
+
+    columns = ["column", "check", "check_number"]
+    failure_cases = pd.concat(failures, ignore_index=True) if failures else pd.DataFrame(columns=columns)
+    # Checks are matched by number, as check names can differ, i.e. in set ordering
+    failure_keys = failure_cases["check_number"].astype(object).fillna(failure_cases["check"])
+    failure_counts = failure_cases.groupby([failure_cases["column"], failure_keys]).size()
+
+    checks = list_value_checks(schema)
+    report = pd.DataFrame(checks, columns=["column", "check"])
+    report["rows_total"] = len(df)
+    report["rows_checked"] = len(sampled)
+    report["failures"] = [
+        failure_counts.get(
+            (check["column"], check["check"] if check["check_number"] is None else check["check_number"]), 0
+        )
+        for check in checks
+    ]
+    return df, failure_cases, report
 
-    # Checks for duplicates
-    assert df.shape == df.drop_duplicates().shape
 
-    # Recoding of string variables
-    df["sex"] = df["sex"].replace({"male": 1, "female": 0}).astype("Int64")
+def summarise_coverage(reports: List[pd.DataFrame], confidence_z: float = 1.96) -> pd.DataFrame:
+    """Combines sampled coverage reports, i.e. across chunks, into coverage and confidence per check.
+
+    The upper bound on the failure rate in unchecked rows is the Wilson score
+    interval at 95% confidence by default. With no failures found in n sampled
+    rows, this is roughly 4 / n.
+
+    Args:
+        reports: Coverage reports from `validate_sampled`
+        confidence_z: Normal quantile for the upper bound, 1.96 for 95%
+
+    Returns:
+        Report with rows checked, coverage, failures and failure rate upper bound per check.
+    """
+    report = pd.concat(reports).groupby(["column", "check"], sort=False).sum().reset_index()
+    report["coverage"] = report["rows_checked"] / report["rows_total"].clip(lower=1)
+
+    n = report["rows_checked"].clip(lower=1)
+    p = report["failures"] / n
+    z2 = confidence_z**2
+    centre = p + z2 / (2 * n)
+    margin = confidence_z * np.sqrt(p * (1 - p) / n + z2 / (4 * n**2))
+    report["failure_rate_upper"] = ((centre + margin) / (1 + z2 / n)).clip(upper=1).round(6)
+    return report
+
+
+def check_titanic(
+    input_path: Path = Path("data", "titanic.csv"),
+    schema_path: Path = Path("schemas", "titanic.yaml"),
+    engine: str = "c",
+    sampling: Optional[Dict[str, Any]] = None,
+) -> pd.DataFrame:
+    """Data schema and typing validations.
+
+    Args:
+        input_path: Raw titanic csv
+        schema_path: Pandera yaml schema
+        engine: Csv parser, either "c" or "pyarrow"
+        sampling: Optional `validate_sampled` arguments; `sample`, `stratify`
+          and `random_state`. Value checks then only run on a sample of rows.
+
+    Returns:
+        Loaded pandas dataframe with typing and schema checks.
+
+    Raises:
+        ValueError: If duplicates are found, or sampled validation fails.
+    """
+    # Standardize column names, types and recode string variables according to schema
+    df = read_typed_csv(input_path, schema_path, engine)
 
     # Full expressive list of variables, assumptions and questions
-    schema_path = Path("schemas", "titanic.yaml")
-    with open(schema_path, "r") as f:
-        pandera_schema_check = io.from_yaml(f)
-    df = pandera_schema_check.validate(df)
+    pandera_schema_check = load_schema(schema_path)
+
+    # Checks for duplicate rows and keys
+    trackers = create_duplicate_trackers(pandera_schema_check)
+    if not track_duplicates(df, trackers).empty:
+        reports = [tracker.report() for tracker in trackers if tracker.duplicates]
+        raise ValueError(f"Duplicates found; {reports}")
+
+    pandera_schema_check = without_unique_checks(pandera_schema_check)
+    if sampling:
+        df, failure_cases, report = validate_sampled(df, pandera_schema_check, **sampling)
+        log_coverage(summarise_coverage([report]))
+        if not failure_cases.empty:
+            summary = failure_cases.groupby(["column", "check"], dropna=False).size().to_string()
+            raise ValueError(f"{len(failure_cases)} validation failures;\n{summary}")
+    else:
+        df = pandera_schema_check.validate(df)
     logging.info("Validation checks passed")
     return df
+
+
+def check_titanic_cached(
+    input_path: Path = Path("data", "titanic.csv"),
+    schema_path: Path = Path("schemas", "titanic.yaml"),
+    engine: str = "c",
+    sampling: Optional[Dict[str, Any]] = None,
+) -> pd.DataFrame:
+    """Cached version of `check_titanic`, skipping validation of unchanged raw files.
+
+    The cache is invalidated by changes to the raw file, the schema yaml,
+    the pandera version or the check code itself.
+
+    Args:
+        input_path: Raw titanic csv
+        schema_path: Pandera yaml schema
+        engine: Csv parser, either "c" or "pyarrow"
+        sampling: Optional `validate_sampled` arguments
+
+    Returns:
+        Loaded pandas dataframe with typing and schema checks.
+    """
+    key = {
+        "schema": cache.hash_file(schema_path),
+        "pandera": pandera.__version__,
+        "code": cache.hash_object(inspect.getsource(inspect.getmodule(check_titanic))),  # type: ignore
+        "sampling": sampling,
+    }
+    return cache.load_or_create(
+        "titanic", [input_path], key, lambda: check_titanic(input_path, schema_path, engine, sampling)
+    )
+
+
+def iter_checked_chunks(
+    input_path: Path,
+    schema_path: Path,
+    failures: List[pd.DataFrame],
+    chunksize: int = config.default_chunksize,
+    engine: str = "c",
+    sampling: Optional[Dict[str, Any]] = None,
+    coverage: Optional[List[pd.DataFrame]] = None,
+    start: int = 0,
+    end: Optional[int] = None,
+    row_offset: int = 0,
+    trackers: Optional[List[DuplicateTracker]] = None,
+) -> Iterator[pd.DataFrame]:
+    """Streams a raw csv in chunks, yielding each chunk once it passes schema checks.
+
+    Memory use depends on `chunksize` rather than file size. Chunks are validated
+    lazily so that every failure in a chunk is reported, not just the first.
+    Failing chunks are not yielded; their failure cases are appended to `failures`
+    so the caller can report on all chunks once the stream is consumed.
+
+    Duplicate rows, and duplicates in columns with `allow_duplicates: false`,
+    are found across chunks by `DuplicateTracker`.
+
+    Args:
+        input_path: Raw csv
+        schema_path: Pandera yaml schema
+        failures: List collecting pandera failure cases, one DataFrame per failing chunk
+        chunksize: Number of rows read per chunk
+        engine: Csv parser, either "c" or "pyarrow"
+        sampling: Optional `validate_sampled` arguments. A `sample` number of
+          rows applies to each chunk.
+        coverage: List collecting sampled coverage reports, one per chunk
+        start: Byte offset to start reading from, see `iter_typed_csv`
+        end: Optional byte offset to stop reading at
+        row_offset: Row index of the first row read
+        trackers: Optional duplicate trackers holding keys from earlier reads,
+          created from the schema if not given
+
+    Yields:
+        Validated pandas dataframe chunks. Row index continues across chunks.
+    """
+    pandera_schema_check = load_schema(schema_path)
+    if trackers is None:
+        trackers = create_duplicate_trackers(pandera_schema_check)
+    pandera_schema_check = without_unique_checks(pandera_schema_check)
+
+    chunks = iter_typed_csv(input_path, schema_path, chunksize, engine, start, end, row_offset)
+    for i, chunk in enumerate(chunks):
+        logging.debug(f"Checking chunk {i}, rows {chunk.index.min()} to {chunk.index.max()}")
+        duplicates = track_duplicates(chunk, trackers)
+        if not duplicates.empty:
+            failures.append(duplicates.assign(chunk=i))
+            continue
+
+        if sampling:
+            chunk, failure_cases, report = validate_sampled(chunk, pandera_schema_check, **sampling)
+            if coverage is not None:
+                coverage.append(report)
+            if not failure_cases.empty:
+                failures.append(failure_cases.assign(chunk=i))
+                continue
+            yield chunk
+            continue
+
+        try:
+            chunk = pandera_schema_check.validate(chunk, lazy=True)
+        except SchemaErrors as err:
+            failures.append(err.failure_cases.assign(chunk=i))
+            continue
+        yield chunk
+
+    for tracker in trackers:
+        if tracker.duplicates:
+            logging.warning(f"Duplicates found; {tracker.report()}")
+
+
+def log_coverage(report: pd.DataFrame) -> None:
+    """Logs coverage and failure rate upper bound of sampled value checks."""
+    logging.info(f"Sampled validation coverage\n{report.to_string(index=False)}")
+
+
+def raise_for_failures(failures: List[pd.DataFrame], report_path: Path) -> None:
+    """Saves collected chunk failure cases and raises if there are any.
+
+    Args:
+        failures: Pandera failure cases collected by `iter_checked_chunks`
+        report_path: Location to save the combined failure cases as csv
+
+    Raises:
+        ValueError: If any chunk failed validation.
+    """
+    if not failures:
+        logging.info("Validation checks passed")
+        return
+
+    failure_cases = pd.concat(failures, ignore_index=True)
+    logging.info(f"Saving validation failures to {report_path}")
+    failure_cases.to_csv(report_path, index=False)
+
+    summary = failure_cases.groupby(["column", "check"], dropna=False).size().to_string()
+    raise ValueError(
+        f"{len(failure_cases)} validation failures in {failure_cases['chunk'].nunique()} chunks;\n{summary}"
+    )
+
+
+def check_file_chunked(
+    input_path: Path,
+    schema_path: Path,
+    output_path: Path,
+    chunksize: int = config.default_chunksize,
+    engine: str = "c",
+    sampling: Optional[Dict[str, Any]] = None,
+) -> int:
+    """Streams a raw csv through schema checks, writing checked chunks straight to parquet.
+
+    With sampled validation, the coverage report is saved next to the output.
+
+    Args:
+        input_path: Raw csv
+        schema_path: Pandera yaml schema
+        output_path: Parquet file for checked data
+        chunksize: Number of rows read per chunk
+        engine: Csv parser, either "c" or "pyarrow"
+        sampling: Optional `validate_sampled` arguments
+
+    Returns:
+        Number of checked rows written.
+
+    Raises:
+        ValueError: If any chunk failed validation, after all chunks are checked.
+    """
+    failures: List[pd.DataFrame] = []
+    coverage: List[pd.DataFrame] = []
+    chunks = iter_checked_chunks(input_path, schema_path, failures, chunksize, engine, sampling, coverage)
+    rows = utils.write_parquet_chunks(chunks, output_path)
+
+    if coverage:
+        report = summarise_coverage(coverage)
+        log_coverage(report)
+        report.to_csv(output_path.with_name(f"{output_path.stem}_coverage.csv"), index=False)
+
+    if failures and output_path.exists():
+        output_path.unlink()
+    raise_for_failures(failures, output_path.with_name(f"{output_path.stem}_failures.csv"))
+    logging.info(f"Saved {rows} checked rows to {output_path}")
+    return rows
+
+
+def check_titanic_chunked(
+    output_path: Path = Path("data", "processed", "titanic_checked.parquet"),
+    input_path: Path = Path("data", "titanic.csv"),
+    schema_path: Path = Path("schemas", "titanic.yaml"),
+    chunksize: int = config.default_chunksize,
+    engine: str = "c",
+) -> Path:
+    """Streaming version of `check_titanic`, writing checked chunks straight to parquet.
+
+    Args:
+        output_path: Parquet file for checked data
+        input_path: Raw titanic csv
+        schema_path: Pandera yaml schema
+        chunksize: Number of rows read per chunk
+        engine: Csv parser, either "c" or "pyarrow"
+
+    Returns:
+        Path of the checked parquet file.
+    """
+    check_file_chunked(input_path, schema_path, output_path, chunksize, engine)
+    return output_path
+
+
+def pair_sources(
+    raw_folder: Path = config.default_raw_folder,
+    schema_folder: Path = config.default_schema_folder,
+    manifest_path: Optional[Path] = None,
+) -> Dict[str, Dict[str, Path]]:
+    """Pairs raw files with their schemas, by naming convention or manifest.
+
+    By convention each `{schema_folder}/{name}.yaml` checks `{raw_folder}/{name}.csv`,
+    with output to `data/processed/{name}_checked.parquet`. Schemas without a raw
+    file are skipped.
+
+    A manifest yaml lists sources explicitly, with paths as lists of folder parts
+    in the same style as experiment configs. Only `input` is required::
+
+        titanic:
+          input: [data, titanic.csv]
+          schema: [schemas, titanic.yaml]
+          output: [data, processed, titanic_checked.parquet]
+
+    Args:
+        raw_folder: Folder containing raw csv files
+        schema_folder: Folder containing pandera yaml schemas
+        manifest_path: Optional manifest yaml, replaces the naming convention
+
+    Returns:
+        Dict of source name to its `input`, `schema` and `output` paths.
+    """
+    if manifest_path:
+        with open(manifest_path, "r") as f:
+            manifest = yaml.safe_load(f)
+        return {
+            name: {
+                "input": Path(*source["input"]),
+                "schema": Path(*source.get("schema", [schema_folder, f"{name}.yaml"])),
+                "output": Path(*source.get("output", ["data", "processed", f"{name}_checked.parquet"])),
+            }
+            for name, source in manifest.items()
+        }
+
+    sources = {}
+    for schema_path in sorted(schema_folder.glob("*.yaml")):
+        input_path = Path(raw_folder, f"{schema_path.stem}.csv")
+        if not input_path.exists():
+            logging.debug(f"No raw file for schema {schema_path}, skipping")
+            continue
+        sources[schema_path.stem] = {
+            "input": input_path,
+            "schema": schema_path,
+            "output": Path("data", "processed", f"{schema_path.stem}_checked.parquet"),
+        }
+    return sources
+
+
+def run_source_check(
+    name: str, paths: Dict[str, Path], chunksize: int, engine: str, sampling: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Checks a single source, capturing timing and any failure for the run summary."""
+    start = time.perf_counter()
+    result: Dict[str, Any] = {"source": name, "input": str(paths["input"]), "schema": str(paths["schema"])}
+    try:
+        result["rows"] = check_file_chunked(
+            paths["input"], paths["schema"], paths["output"], chunksize, engine, sampling
+        )
+        result["status"] = "passed"
+        result["error"] = ""
+    except Exception as err:
+        result["rows"] = None
+        result["status"] = "failed"
+        result["error"] = str(err)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run_checks(
+    sources: Dict[str, Dict[str, Path]],
+    processes: Optional[int] = None,
+    chunksize: int = config.default_chunksize,
+    engine: str = "c",
+    sampling: Optional[Dict[str, Any]] = None,
+) -> pd.DataFrame:
+    """Checks many sources in parallel, one process per source.
+
+    Total run time is close to that of the slowest source, rather than the sum.
+
+    Args:
+        sources: Source paths from `pair_sources`
+        processes: Size of process pool, defaults to number of CPUs
+        chunksize: Number of rows read per chunk
+        engine: Csv parser, either "c" or "pyarrow"
+        sampling: Optional `validate_sampled` arguments
+
+    Returns:
+        Summary DataFrame with status, rows, timing and error message per source.
+    """
+    logging.info(f"Checking {len(sources)} sources")
+    results = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(run_source_check, name, paths, chunksize, engine, sampling)
+            for name, paths in sources.items()
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            logging.info(f"{result['source']} {result['status']} in {result['seconds']}s")
+            results.append(result)
+
+    summary = pd.DataFrame(results, columns=["source", "status", "rows", "seconds", "input", "schema", "error"])
+    return summary.sort_values("source").reset_index(drop=True)
+
+
+def main() -> None:
+    """Run schema checks over all raw sources from command line using...
+
+    `python -m ndj_pipeline.data_checks`
+    """
+    parser = argparse.ArgumentParser(description="ndj_pipeline data checks")
+    parser.add_argument("-m", type=str, help="Path to optional sources manifest yaml")
+    parser.add_argument("-n", type=int, help="Number of processes, defaults to number of CPUs")
+    parser.add_argument("-c", type=int, default=config.default_chunksize, help="Rows per chunk")
+    parser.add_argument("-e", default="c", choices=["c", "pyarrow"], help="Csv parser engine")
+    parser.add_argument("-s", type=float, help="Only value check a sample; fraction if 1 or less, else rows per chunk")
+    parser.add_argument("--stratify", nargs="+", help="Columns to stratify the value check sample by")
+    parser.add_argument("-v", action="store_true", help="Debug mode")
+
+    args = parser.parse_args()
+    log_level = logging.DEBUG if args.v else logging.INFO
+    log_path = Path("logs", "_log.txt")
+
+    try:
+        logging.basicConfig(
+            level=log_level,
+            format="%(asctime)s [%(levelname)s] %(message)s",
+            handlers=[logging.FileHandler(log_path), logging.StreamHandler()],
+        )
+    except FileNotFoundError:
+        msg = f"""Directory '{log_path}' missing, cannot create log file.
+                  Make sure you are running from base of repo, with correct data folder structure.
+                  Continuing without log file writing."""
+        logging.basicConfig(
+            level=log_level,
+            format="%(asctime)s [%(levelname)s] %(message)s",
+            handlers=[logging.StreamHandler()],
+        )
+        logging.warning(msg)
+
+    sources = pair_sources(manifest_path=Path(args.m) if args.m else None)
+    sampling = {"sample": args.s, "stratify": args.stratify} if args.s else None
+    summary = run_checks(sources, processes=args.n, chunksize=args.c, engine=args.e, sampling=sampling)
+
+    output_path = Path("data", "processed", "checks_summary.csv")
+    logging.info(f"Saving check summary to {output_path}")
+    summary.to_csv(output_path, index=False)
+    logging.info(f"Check summary\n{summary.drop(columns=['input', 'schema']).to_string(index=False)}")
+
+    failed = summary.loc[summary["status"] == "failed", "source"].tolist()
+    if failed:
+        raise ValueError(f"Schema checks failed for {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
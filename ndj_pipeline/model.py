@@ -21,20 +21,108 @@
 
 """Contains custom ML model functions and pipeline for running modeling."""
 import argparse
+import inspect
+import json
 import logging
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
+import joblib
+import numpy as np
 import pandas as pd
-from sklearn.ensemble import GradientBoostingRegressor
+from scipy import sparse
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor
+from sklearn.inspection import permutation_importance
 from sklearn.linear_model import LinearRegression
+from sklearn.model_selection import KFold, ParameterGrid, ParameterSampler
 
-from ndj_pipeline import post, prep, utils
+from ndj_pipeline import cache, post, prep, utils
 
 pd.options.mode.chained_assignment = None
 
 
-def baseline(train: pd.DataFrame, test: pd.DataFrame, features: List[str], config: Dict[str, Any]) -> List[str]:
+estimators = {"gbr": GradientBoostingRegressor, "hgbr": HistGradientBoostingRegressor, "ols": LinearRegression}
+
+# Model functions handling missing values and categorical dummy codes themselves,
+# which skip missing data replacement and one-hot dummy columns.
+native_feature_models = ["hgbr"]
+
+
+def create_estimator(config: Dict[str, Any], features: Optional[List[str]] = None) -> Any:
+    """Unfitted sklearn estimator for the config model function, with config model parameters.
+
+    For native feature models, given the features, dummy code columns are
+    marked as categorical unless `categorical_features` is in model parameters.
+
+    Raises:
+        ValueError: If the model function has no matching estimator in `estimators`.
+    """
+    model_function_name = config.get("model_function_name")
+    if model_function_name not in estimators:
+        raise ValueError(f"No estimator for model function {model_function_name}, expected one of {list(estimators)}")
+    model_params = dict(config.get("model_params", {}))
+    if model_function_name in native_feature_models and features is not None:
+        model_params.setdefault("categorical_features", [feature.endswith("_##") for feature in features])
+    return estimators[model_function_name](**model_params)
+
+
+def save_estimator(model: Any, config: Dict[str, Any]) -> None:
+    """Saves a fitted estimator to the model folder as `model.joblib`, for scoring new data."""
+    output_path = Path(utils.get_model_path(config), "model.joblib")
+    logging.info(f"Saving fitted model to {output_path}")
+    joblib.dump(model, output_path)
+
+
+def load_estimator(config: Dict[str, Any]) -> Any:
+    """Loads the fitted estimator saved by `save_estimator`, memory mapping its arrays rather than reading them.
+
+    Raises:
+        FileNotFoundError: If the model has not been trained, or its model function saves no estimator.
+    """
+    input_path = Path(utils.get_model_path(config), "model.joblib")
+    if not input_path.exists():
+        raise FileNotFoundError(f"No fitted model at {input_path}, run model training with this config first")
+    logging.info(f"Loading fitted model from {input_path}")
+    return joblib.load(input_path, mmap_mode="r")
+
+
+def check_native_categories(model_config: Dict[str, Any], categories: Dict[str, int]) -> None:
+    """Checks categorical columns of native feature models have no more categories than the model's `max_bins`.
+
+    Args:
+        model_config: Loaded model experiment config
+        categories: Mapping of dummy or hashed feature column: number of categories
+
+    Raises:
+        ValueError: If any column has too many categories.
+    """
+    if not native_features(model_config):
+        return
+    max_bins = (model_config.get("model_params") or {}).get("max_bins", 255)
+    problems = [f"{col} ({count})" for col, count in categories.items() if count > max_bins]
+    if problems:
+        raise ValueError(
+            f"{model_config['model_function_name']} categorical features need at most {max_bins} categories; "
+            + f"{', '.join(problems)}. Lower hashed_features buckets, or raise min_dummy_percent"
+        )
+
+
+def native_features(model_config: Dict[str, Any]) -> bool:
+    """Whether the config model function handles missing values and categorical codes, see `native_feature_models`."""
+    return model_config.get("model_function_name") in native_feature_models
+
+
+def baseline(
+    train: pd.DataFrame,
+    test: pd.DataFrame,
+    features: List[str],
+    config: Dict[str, Any],
+    X_train: Optional["prep.FeatureMatrix"] = None,
+    X_test: Optional["prep.FeatureMatrix"] = None,
+) -> List[str]:
     """Compares Actual results to a naive baseline.
 
     This will compare "Actual" results to a pre-calculated baseline
@@ -55,6 +143,8 @@ def baseline(train: pd.DataFrame, test: pd.DataFrame, features: List[str], confi
           target and numeric features from `features`
         features: List of columns to use in model training
         config: Loaded model experiment config, for model parameters
+        X_train: Optional prepared train feature matrix, see `prep.feature_matrix`
+        X_test: Optional prepared test feature matrix
 
     Returns:
         List of strings indicating important features to use
@@ -74,7 +164,14 @@ def baseline(train: pd.DataFrame, test: pd.DataFrame, features: List[str], confi
     return features[:2]
 
 
-def gbr(train: pd.DataFrame, test: pd.DataFrame, features: List[str], config: Dict[str, Any]) -> List[str]:
+def gbr(
+    train: pd.DataFrame,
+    test: pd.DataFrame,
+    features: List[str],
+    config: Dict[str, Any],
+    X_train: Optional["prep.FeatureMatrix"] = None,
+    X_test: Optional["prep.FeatureMatrix"] = None,
+) -> List[str]:
     """Train a Gradient Boosted Regression.
 
     Trains using specified train dataframe and list of simple and dummy features.
@@ -90,22 +187,30 @@ def gbr(train: pd.DataFrame, test: pd.DataFrame, features: List[str], config: Di
           target and numeric features from `features`
         features: List of columns to use in model training
         config: Loaded model experiment config, for model parameters
+        X_train: Optional prepared train feature matrix, see `prep.feature_matrix`
+        X_test: Optional prepared test feature matrix
 
     Returns:
         List of strings indicating important features to use
         for further reporting
     """
-    model = GradientBoostingRegressor(**config.get("model_params", {}))
+    model = create_estimator(config)
 
     target = config["target"]
+    if X_train is None:
+        X_train = prep.feature_matrix(train, features, config)
+    if X_test is None:
+        X_test = prep.feature_matrix(test, features, config)
+
     logging.info("Fitting GBR model")
-    model.fit(train[features], train[target])
+    model.fit(X_train, train[target])
     logging.info("Fit finished GBR model")
+    save_estimator(model, config)
 
     results = pd.DataFrame(test[target])
     results.columns = ["Actual"]
     logging.debug("Predicting results")
-    results["Predicted"] = model.predict(test[features])
+    results["Predicted"] = model.predict(X_test)
 
     # Save predictions
     output_path = Path(utils.get_model_path(config), "pred_test.csv")
@@ -121,25 +226,111 @@ def gbr(train: pd.DataFrame, test: pd.DataFrame, features: List[str], config: Di
         post.create_metrics_plot(results, config, name="gbr")
 
     # Generate important features analysis
-    importance_groups_sub = pd.DataFrame(
-        pd.Series(dict(zip(features, model.feature_importances_)), name="temp")
-    ).reset_index()
-
-    importance_groups_sub = importance_groups_sub.join(
-        importance_groups_sub["index"].str.split("_##_", expand=True)
-    ).sort_values("temp", ascending=False)
-    importance_groups_sub.columns = [
-        "feature",
-        "importance",
-        "feature_group",
-        "feature_subgroup",
-    ]
+    return save_feature_importance(features, model.feature_importances_, config)
+
+
+def hgbr(
+    train: pd.DataFrame,
+    test: pd.DataFrame,
+    features: List[str],
+    config: Dict[str, Any],
+    X_train: Optional["prep.FeatureMatrix"] = None,
+    X_test: Optional["prep.FeatureMatrix"] = None,
+) -> List[str]:
+    """Train a Histogram Gradient Boosted Regression.
+
+    Much faster than `gbr` on large training data, binning features and
+    fitting trees on multiple threads. Missing values are handled natively, so
+    simple features are not filled, and dummy features are fitted as a single
+    categorical code column each rather than one-hot columns. Categorical
+    columns can have at most `max_bins` (255) categories, so lower the
+    `hashed_features` buckets or raise `min_dummy_percent` for columns with
+    more, see `check_native_categories`.
+
+    Feature importance is permutation importance on the test data, or training
+    data if the test data has no ground truth actuals.
+
+    Args:
+        train: training dataframe containing config specified
+          target and features from `features`
+        test: training dataframe containing config specified
+          target and features from `features`
+        features: List of columns to use in model training
+        config: Loaded model experiment config, for model parameters
+        X_train: Optional prepared train feature matrix, see `prep.feature_matrix`
+        X_test: Optional prepared test feature matrix
+
+    Returns:
+        List of strings indicating important features to use
+        for further reporting
+    """
+    model = create_estimator(config, features)
+
+    target = config["target"]
+    if X_train is None:
+        X_train = prep.feature_matrix(train, features, config)
+    if X_test is None:
+        X_test = prep.feature_matrix(test, features, config)
+
+    logging.info("Fitting HGBR model")
+    model.fit(X_train, train[target])
+    logging.info("Fit finished HGBR model")
+    save_estimator(model, config)
+
+    results = pd.DataFrame(test[target])
+    results.columns = ["Actual"]
+    logging.debug("Predicting results")
+    results["Predicted"] = model.predict(X_test)
+
+    # Save predictions
+    output_path = Path(utils.get_model_path(config), "pred_test.csv")
+    logging.info(f"Saving HGBR predictions to {output_path}")
+    results.to_csv(output_path)
+
+    # Generate metrics
+    if results["Actual"].isna().any():
+        logging.info("HGBR predictions contain no ground truth actuals")
+        logging.info("Skipping plots")
+        X_importance, y_importance = X_train, train[target]
+    else:
+        logging.debug("Creating plot")
+        post.create_metrics_plot(results, config, name="hgbr")
+        X_importance, y_importance = X_test, test[target]
+
+    # Generate important features analysis
+    logging.info("Calculating HGBR permutation importance")
+    importance = permutation_importance(model, X_importance, y_importance, n_repeats=5, random_state=42)
+    return save_feature_importance(features, importance.importances_mean, config)
+
+
+def save_feature_importance(features: List[str], importances: np.ndarray, config: Dict[str, Any]) -> List[str]:
+    """Saves feature importance, and importance grouped by dummy feature.
+
+    Saves `importance_subgroups.csv` with the importance of each feature, split
+    into its feature group and dummy value subgroup, and `importance.csv` with
+    total importance of each group.
+
+    Args:
+        features: List of columns used in model training
+        importances: Importance of each feature
+        config: Loaded model experiment config
+
+    Returns:
+        The config `num_features_reporting` most important features
+    """
+    importance_groups_sub = pd.DataFrame({"feature": features, "importance": importances})
+    importance_groups_sub[["feature_group", "feature_subgroup"]] = importance_groups_sub["feature"].str.extract(
+        r"^(.*?)(?:_##_?(.*))?$"
+    )
+    importance_groups_sub = importance_groups_sub.sort_values("importance", ascending=False)
 
     output_path = Path(utils.get_model_path(config), "importance_subgroups.csv")
     logging.info(f"Saving to: {output_path}")
     importance_groups_sub.to_csv(output_path)
 
-    importance_grouped = importance_groups_sub.groupby("feature_group").sum().sort_values("importance", ascending=False)
+    importance_grouped = (
+        importance_groups_sub.groupby("feature_group")[["importance"]].sum().sort_values("importance", ascending=False)
+    )
 
     output_path = Path(utils.get_model_path(config), "importance.csv")
     logging.info(f"Saving to: {output_path}")
@@ -150,7 +341,14 @@ def gbr(train: pd.DataFrame, test: pd.DataFrame, features: List[str], config: Di
     return reporting_features
 
 
-def ols(train: pd.DataFrame, test: pd.DataFrame, features: List[str], config: Dict[str, Any]) -> List[str]:
+def ols(
+    train: pd.DataFrame,
+    test: pd.DataFrame,
+    features: List[str],
+    config: Dict[str, Any],
+    X_train: Optional["prep.FeatureMatrix"] = None,
+    X_test: Optional["prep.FeatureMatrix"] = None,
+) -> List[str]:
     """Train a Ordinary Least Squares Regression.
 
     Trains using specified train dataframe and list of simple and dummy features.
@@ -166,22 +364,30 @@ def ols(train: pd.DataFrame, test: pd.DataFrame, features: List[str], config: Di
           target and numeric features from `features`
         features: List of columns to use in model training
         config: Loaded model experiment config, for model parameters
+        X_train: Optional prepared train feature matrix, see `prep.feature_matrix`
+        X_test: Optional prepared test feature matrix
 
     Returns:
         List of strings indicating important features to use
         for further reporting
     """
-    model = LinearRegression(**config.get("model_params", {}))
+    model = create_estimator(config)
 
     target = config["target"]
+    if X_train is None:
+        X_train = prep.feature_matrix(train, features, config)
+    if X_test is None:
+        X_test = prep.feature_matrix(test, features, config)
+
     logging.info("Fitting OLS model")
-    model.fit(train[features], train[target])
+    model.fit(X_train, train[target])
     logging.info("Fit finished OLS model")
+    save_estimator(model, config)
 
     results = pd.DataFrame(test[target])
     results.columns = ["Actual"]
     logging.debug("Predicting results")
-    results["Predicted"] = model.predict(test[features])
+    results["Predicted"] = model.predict(X_test)
 
     # Save predictions
     output_path = Path(utils.get_model_path(config), "pred_test.csv")
@@ -200,7 +406,575 @@ def ols(train: pd.DataFrame, test: pd.DataFrame, features: List[str], config: Di
     return features[:2]
 
 
-def run_model_training(model_config: Dict[str, Any]) -> None:
+def _load_stage(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Loads data, optionally from a shared snapshot, and sets index."""
+    return {"data": prep.load_data_and_key(model_config, snapshot=state.get("snapshot"))}
+
+
+def _dummies_stage(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Creates config specified dummy features, as code columns only for native feature models."""
+    if native_features(model_config):
+        model_config = {**model_config, "sparse_dummies": True}
+    data, dummy_features = prep.create_dummy_features(state["data"], model_config)
+    categories = pd.Series([feature.split("_##_")[0] for feature in dummy_features], dtype=object).value_counts()
+    check_native_categories(model_config, categories.to_dict())
+    return {"data": data, "dummy_features": dummy_features}
+
+
+def _filter_stage(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Applies filtering to the filter field, if present in model_config."""
+    return {**state, "data": prep.apply_filtering(state["data"], model_config)}
+
+
+def _split_stage(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Train test split according to config."""
+    train, test = prep.split(state["data"], model_config)
+    return {"train": train, "test": test, "dummy_features": state["dummy_features"]}
+
+
+def _target_stage(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Target variable may have missing data; drop all rows with missing."""
+    return {**state, "train": prep.filter_target(state["train"], model_config)}
+
+
+def _aggregates_stage(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Fill missing features (using train) according to config (i.e. mean, mode), except for native feature models."""
+    if native_features(model_config):
+        logging.info(f"Keeping missing values for {model_config['model_function_name']} model")
+        return state
+    if model_config.get("streaming_aggregates"):
+        batch_size = model_config["streaming_aggregates"].get("batch_size")
+        batches = prep.iter_train_batches(model_config, list(model_config.get("simple_features", {})), batch_size)
+        aggregates = prep.stream_feature_aggregates(batches, model_config)
+    else:
+        aggregates = prep.get_simple_feature_aggregates(state["train"], model_config)
+    downcast = model_config.get("downcast_features", False)
+    train = prep.apply_feature_aggregates(state["train"], aggregates, downcast)
+    test = prep.apply_feature_aggregates(state["test"], aggregates, downcast)
+    return {**state, "train": train, "test": test}
+
+
+def _features_stage(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Optionally saves data, and collates the final feature list, with dummy code columns for native feature models."""
+    if model_config.get("save_data"):
+        prep.save_data(state["train"], state["test"], model_config)
+    dummy_features = state["dummy_features"]
+    if native_features(model_config):
+        dummy_features = prep.dummy_code_columns(dummy_features)
+    return {**state, "features": prep.collate_features(model_config, dummy_features)}
+
+
+def _save_training_matrix(
+    train: pd.DataFrame, features: List[str], model_config: Dict[str, Any], matrix_folder: Path
+) -> None:
+    """Saves the train feature matrix and target as numpy files, for worker processes to memory map."""
+    matrix = prep.feature_matrix(train, features, model_config, Path(matrix_folder, "X.npy"))
+    if sparse.issparse(matrix):
+        prep.save_feature_matrix(matrix, matrix_folder)
+    del matrix
+    np.save(Path(matrix_folder, "y.npy"), train[model_config["target"]].to_numpy(dtype=np.float64))
+
+
+def _fit_fold(
+    matrix_folder: Path, fold: int, features: List[str], model_config: Dict[str, Any]
+) -> Tuple[int, np.ndarray]:
+    """Fits the config estimator on all but one fold, returning predictions for that fold.
+
+    Runs in a worker process, memory mapping the shared feature matrix, target and fold arrays.
+    """
+    matrix = prep.load_feature_matrix(matrix_folder)
+    target = np.load(Path(matrix_folder, "y.npy"), mmap_mode="r")
+    folds = np.load(Path(matrix_folder, "folds.npy"), mmap_mode="r")
+    train_rows, test_rows = np.flatnonzero(folds != fold), np.flatnonzero(folds == fold)
+
+    estimator = create_estimator(model_config, features)
+    estimator.fit(matrix[train_rows], target[train_rows])
+    return fold, estimator.predict(matrix[test_rows])
+
+
+def run_cross_validation(train: pd.DataFrame, features: List[str], model_config: Dict[str, Any]) -> None:
+    """K-fold cross validation of the config model on the training data.
+
+    The feature matrix is prepared once and saved as numpy files, which each
+    worker process memory maps rather than receiving a pickled copy. Missing
+    data replacement uses aggregates of the full training data.
+
+    Saves `metrics_cv.json` with metrics per fold, their mean and standard
+    deviation, and metrics of all out of fold predictions, which are saved to
+    `pred_oof.csv`.
+
+    Args:
+        train: Training dataframe containing config specified
+          target and features from `features`
+        features: List of columns to use in model training
+        model_config: Loaded model experiment config, specifically for the `cv`
+          section with number of `folds`, `processes` and `random_state`.
+    """
+    cv_config = model_config["cv"]
+    n_folds = cv_config.get("folds", 5)
+    model_path = utils.get_model_path(model_config)
+    matrix_folder = Path(model_path, "_cv")
+
+    folds = np.zeros(len(train), dtype=np.int32)
+    kfold = KFold(n_splits=n_folds, shuffle=True, random_state=cv_config.get("random_state", 42))
+    for fold, (_, test_rows) in enumerate(kfold.split(folds)):
+        folds[test_rows] = fold
+
+    _save_training_matrix(train, features, model_config, matrix_folder)
+    np.save(Path(matrix_folder, "folds.npy"), folds)
+
+    results = pd.DataFrame({"Actual": train[model_config["target"]].astype(float), "fold": folds}, index=train.index)
+    results["Predicted"] = np.nan
+    logging.info(f"Cross validating {model_config['model_function_name']} model on {n_folds} folds")
+    try:
+        with ProcessPoolExecutor(max_workers=cv_config.get("processes")) as executor:
+            jobs = [executor.submit(_fit_fold, matrix_folder, fold, features, model_config) for fold in range(n_folds)]
+            for job in as_completed(jobs):
+                fold, predictions = job.result()
+                logging.info(f"Finished fold {fold}")
+                results.loc[folds == fold, "Predicted"] = predictions
+    finally:
+        shutil.rmtree(matrix_folder, ignore_errors=True)
+
+    fold_metrics = pd.DataFrame([post.calculate_metrics(results.loc[folds == fold]) for fold in range(n_folds)])
+    metrics = {
+        "folds": fold_metrics.to_dict("records"),
+        "mean": fold_metrics.mean().round(5).to_dict(),
+        "std": fold_metrics.std().round(5).to_dict(),
+        "out_of_fold": post.calculate_metrics(results),
+    }
+    logging.info(f"Cross validation metrics {metrics['mean']}")
+
+    output_path = Path(model_path, "metrics_cv.json")
+    logging.info(f"Saving to: {output_path}")
+    with open(output_path, "w") as f:
+        json.dump(metrics, f, indent=2)
+
+    output_path = Path(model_path, "pred_oof.csv")
+    logging.info(f"Saving out of fold predictions to {output_path}")
+    results[["Actual", "Predicted", "fold"]].to_csv(output_path)
+
+
+def _cv_stage(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Optionally cross validates the model on training data."""
+    if model_config.get("cv"):
+        run_cross_validation(state["train"], state["features"], _fit_config(state, model_config))
+    return state
+
+
+def search_candidates(search_config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Model parameter candidates of a search config.
+
+    Every combination of the `params` lists, or with `method: random` (or
+    `halving` with `candidates` set), a sample of `candidates` combinations.
+    Scipy distributions may be used in place of lists for random sampling.
+
+    Raises:
+        ValueError: If the search method is unknown.
+    """
+    method = search_config.get("method", "grid")
+    if method not in ["grid", "random", "halving"]:
+        raise ValueError(f"Unknown search method {method}, expected one of grid, random or halving")
+    params = search_config.get("params", {})
+    if method == "random" or (method == "halving" and search_config.get("candidates")):
+        sampler = ParameterSampler(
+            params, n_iter=search_config.get("candidates", 10), random_state=search_config.get("random_state", 42)
+        )
+        return list(sampler)
+    return list(ParameterGrid(params))
+
+
+def halving_resources(n_candidates: int, max_resource: int, search_config: Dict[str, Any]) -> List[int]:
+    """Resource of each successive halving round.
+
+    Each round keeps the best `1 / factor` of candidates, and multiplies the
+    resource by `factor`, so the final round fits a single candidate with
+    `max_resource`. The first round uses `min_resource` if set.
+    """
+    factor = search_config.get("factor", 3)
+    rounds = 1 + int(np.ceil(np.log(max(n_candidates, 1)) / np.log(factor)))
+    min_resource = search_config.get("min_resource") or max(1, max_resource // factor ** (rounds - 1))
+    resources = [min(max_resource, int(min_resource * factor**i)) for i in range(rounds)]
+    resources[-1] = max_resource
+    return resources
+
+
+def _fit_candidate(
+    matrix_folder: Path,
+    params: Dict[str, Any],
+    resource: Optional[int],
+    features: List[str],
+    model_config: Dict[str, Any],
+) -> Dict[str, Any]:
+    """Fits the config estimator with candidate parameters, returning validation metrics and wall time.
+
+    Runs in a worker process, memory mapping the shared feature matrix, target
+    and row arrays. A `rows` resource fits on that many of the shuffled
+    training rows, any other resource sets that estimator parameter.
+    """
+    start = time.perf_counter()
+    matrix = prep.load_feature_matrix(matrix_folder)
+    target = np.load(Path(matrix_folder, "y.npy"), mmap_mode="r")
+    train_rows = np.load(Path(matrix_folder, "train_rows.npy"))
+    validation_rows = np.load(Path(matrix_folder, "validation_rows.npy"))
+
+    model_params = {**model_config.get("model_params", {}), **params}
+    resource_name = model_config["search"].get("resource")
+    if resource is not None and resource_name == "rows":
+        train_rows = train_rows[:resource]
+    elif resource is not None:
+        model_params[resource_name] = resource
+
+    estimator = create_estimator({**model_config, "model_params": model_params}, features)
+    estimator.fit(matrix[train_rows], target[train_rows])
+    results = pd.DataFrame({"Actual": target[validation_rows], "Predicted": estimator.predict(matrix[validation_rows])})
+    return {**post.calculate_metrics(results), "wall_time": round(time.perf_counter() - start, 3)}
+
+
+def run_search(train: pd.DataFrame, features: List[str], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Searches model parameters on a validation split of the training data.
+
+    Candidates from `search_candidates` are fitted in parallel processes, each
+    memory mapping the feature matrix prepared once in the model folder's
+    `_search`. With `method: halving`, candidates are fitted in rounds of
+    increasing `resource`; either `rows` of training data or an estimator
+    parameter such as `n_estimators`, up to `max_resource`. Only the best
+    `1 / factor` of each round continue, so weak candidates stop early.
+
+    Every trial's parameters, metrics and wall time are saved to
+    `search_leaderboard.csv`, and the winning parameters to `search_params.json`.
+
+    Args:
+        train: Training dataframe containing config specified
+          target and features from `features`
+        features: List of columns to use in model training
+        model_config: Loaded model experiment config, specifically for the
+          `search` section with `method`, `params`, `validation_size`,
+          `metric` and `processes`, and halving `resource` options.
+
+    Returns:
+        Model parameters with the winning candidate parameters.
+
+    Raises:
+        ValueError: If halving has no maximum resource, or the search has no candidates.
+    """
+    search_config = model_config["search"]
+    candidates = search_candidates(search_config)
+    if not candidates:
+        raise ValueError("Search has no candidate parameters")
+    model_params = model_config.get("model_params", {})
+    metric = search_config.get("metric", "mse")
+    model_path = utils.get_model_path(model_config)
+    matrix_folder = Path(model_path, "_search")
+
+    rows = np.random.default_rng(search_config.get("random_state", 42)).permutation(len(train))
+    n_validation = int(np.ceil(len(train) * search_config.get("validation_size", 0.2)))
+    train_rows = rows[n_validation:]
+
+    resources: List[Optional[int]] = [None]
+    if search_config.get("method") == "halving":
+        resource_name = search_config.get("resource", "rows")
+        max_resource = len(train_rows) if resource_name == "rows" else search_config.get("max_resource")
+        max_resource = max_resource or model_params.get(resource_name)
+        if not max_resource:
+            raise ValueError(f"Halving over {resource_name} needs `max_resource` in search, or in model_params")
+        resources = halving_resources(len(candidates), max_resource, search_config)
+        search_config = {**search_config, "resource": resource_name}
+
+    _save_training_matrix(train, features, model_config, matrix_folder)
+    np.save(Path(matrix_folder, "train_rows.npy"), train_rows)
+    np.save(Path(matrix_folder, "validation_rows.npy"), rows[:n_validation])
+
+    trials: List[Dict[str, Any]] = []
+    survivors = candidates
+    worker_config = {**model_config, "search": search_config}
+    try:
+        with ProcessPoolExecutor(max_workers=search_config.get("processes")) as executor:
+            for i, resource in enumerate(resources):
+                logging.info(f"Search round {i}, fitting {len(survivors)} candidates with resource {resource}")
+                jobs = [
+                    executor.submit(_fit_candidate, matrix_folder, c, resource, features, worker_config)
+                    for c in survivors
+                ]
+                scores = [{**job.result(), "params": c} for job, c in zip(jobs, survivors)]
+                scores.sort(key=lambda score: score[metric], reverse=metric == "r2")
+                trials += [{"round": i, "resource": resource, **score} for score in scores]
+                keep = max(1, len(survivors) // search_config.get("factor", 3))
+                survivors = [score["params"] for score in scores[:keep]]
+    finally:
+        shutil.rmtree(matrix_folder, ignore_errors=True)
+
+    best = {**model_params, **survivors[0]}
+    if search_config.get("resource", "rows") != "rows" and search_config.get("method") == "halving":
+        best[search_config["resource"]] = resources[-1]
+    logging.info(f"Search best parameters {best}")
+
+    leaderboard = pd.DataFrame(trials)
+    leaderboard["params"] = leaderboard["params"].apply(json.dumps)
+    output_path = Path(model_path, "search_leaderboard.csv")
+    logging.info(f"Saving search leaderboard to {output_path}")
+    leaderboard.to_csv(output_path, index=False)
+
+    output_path = Path(model_path, "search_params.json")
+    logging.info(f"Saving to: {output_path}")
+    with open(output_path, "w") as f:
+        json.dump(best, f, indent=2)
+    return best
+
+
+def _search_stage(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Optionally searches model parameters, used by later stages in place of config `model_params`."""
+    if model_config.get("search"):
+        return {
+            **state,
+            "model_params": run_search(state["train"], state["features"], _fit_config(state, model_config)),
+        }
+    return state
+
+
+def _fit_config(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Model config for fitting, with any searched model parameters, and dense matrices for native feature models."""
+    if "model_params" in state:
+        model_config = {**model_config, "model_params": state["model_params"]}
+    if native_features(model_config):
+        model_config = {**model_config, "sparse_dummies": False}
+    return model_config
+
+
+def _fit_stage(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Trains model according to model specifications.
+
+    Feature matrices are built once, optionally memory mapped in the model
+    folder's `_matrix` with `matrix_memmap: True`, and shared by the model
+    function and reporting. Only target and reported feature columns are kept
+    for plots.
+    """
+    train, test, features = state["train"], state["test"], state["features"]
+    model_config = _fit_config(state, model_config)
+    reporting_features: List[str] = []
+    model_function_name = model_config.get("model_function_name")
+    if not model_function_name:
+        return {"train": train[[model_config["target"]]], "reporting_features": reporting_features}
+
+    matrix_folder = Path(utils.get_model_path(model_config), "_matrix")
+    memmap = model_config.get("matrix_memmap", False)
+    try:
+        X_train = prep.feature_matrix(
+            train, features, model_config, Path(matrix_folder, "X_train.npy") if memmap else None
+        )
+        X_test = prep.feature_matrix(
+            test, features, model_config, Path(matrix_folder, "X_test.npy") if memmap else None
+        )
+
+        model_function = utils.get_model(model_function_name)
+        reporting_features = model_function(train, test, features, model_config, X_train=X_train, X_test=X_test)
+
+        reporting = prep.matrix_columns(X_train, features, reporting_features, train.index)
+    finally:
+        if memmap:
+            shutil.rmtree(matrix_folder, ignore_errors=True)
+    reporting[model_config["target"]] = train[model_config["target"]]
+    return {"train": reporting, "reporting_features": reporting_features}
+
+
+def _plots_stage(state: Dict[str, Any], model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Produce diagnostic info."""
+    post.create_univariate_plots(state["train"], state["reporting_features"], model_config)
+    post.create_continuous_plots(state["train"], state["reporting_features"], model_config)
+    post.create_correlation_matrix(state["train"], state["reporting_features"], model_config)
+    return {}
+
+
+def _load_key(model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Config the load stage depends on, including projected columns and pushed down filters."""
+    key = {name: model_config.get(name) for name in ["data_file", "unique_key", "pushdown_filters"]}
+    key["columns"] = prep.required_columns(model_config)
+    if model_config.get("pushdown_filters"):
+        key.update({name: model_config.get(name) for name in ["filters", "split"]})
+    return key
+
+
+# Model training stages in order; each with the config keys it depends on, or a
+# function returning its config key, and the state values it sets. Stages which
+# run differently for native feature models also depend on that. Files a stage
+# writes in the model folder are recorded when it runs, and must still exist to
+# skip the stage.
+training_stages: List[Dict[str, Any]] = [
+    {"name": "load", "run": _load_stage, "key": _load_key, "state": ["data"]},
+    {
+        "name": "dummies",
+        "run": _dummies_stage,
+        "config_keys": ["dummy_features", "hashed_features", "min_dummy_percent", "sparse_dummies"],
+        "native_features": True,
+        "state": ["data", "dummy_features"],
+    },
+    {"name": "filter", "run": _filter_stage, "config_keys": ["filters"], "state": ["data"]},
+    {"name": "split", "run": _split_stage, "config_keys": ["split"], "state": ["train", "test"]},
+    {"name": "target", "run": _target_stage, "config_keys": ["target"], "state": ["train"]},
+    {
+        "name": "aggregates",
+        "run": _aggregates_stage,
+        "config_keys": ["simple_features", "streaming_aggregates", "downcast_features"],
+        "native_features": True,
+        "state": ["train", "test"],
+    },
+    {
+        "name": "features",
+        "run": _features_stage,
+        "config_keys": ["save_data"],
+        "native_features": True,
+        "state": ["features"],
+    },
+    {
+        "name": "search",
+        "run": _search_stage,
+        "config_keys": ["search", "model_function_name", "model_params", "matrix_dtype"],
+        "state": ["model_params"],
+    },
+    {
+        "name": "cv",
+        "run": _cv_stage,
+        "config_keys": ["cv", "model_function_name", "model_params", "matrix_dtype"],
+        "state": [],
+    },
+    {
+        "name": "fit",
+        "run": _fit_stage,
+        "config_keys": [
+            "model_function_name",
+            "model_params",
+            "baseline",
+            "matrix_dtype",
+            "num_features_reporting",
+            "plot_min_clip",
+            "plot_max_clip",
+        ],
+        "state": ["train", "reporting_features"],
+    },
+    {"name": "plots", "run": _plots_stage, "config_keys": [], "state": []},
+]
+
+# Data preparation stages, which depend only on the data file and their config
+# keys, so may be run once for several experiments, see `prepare_shared_stages`.
+shared_stages = ["load", "dummies", "filter", "split", "target"]
+
+
+def stage_hashes(model_config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Keys and key hashes of each training stage.
+
+    A stage key holds its config keys and the hash of the stage before it, so
+    any change upstream also changes every later stage. The first stage key
+    also includes the processed data file fingerprint and the pipeline code.
+
+    Args:
+        model_config: Loaded model experiment config
+
+    Returns:
+        List of dictionaries with stage `key` and `hash`, in stage order.
+    """
+    upstream = cache.hash_object(
+        {
+            "data": cache.path_fingerprint(Path(*model_config["data_file"])),
+            "code": [cache.hash_object(inspect.getsource(module)) for module in (prep, post, utils)],
+            "model": cache.hash_object(inspect.getsource(inspect.getmodule(stage_hashes))),  # type: ignore
+        }
+    )
+    hashes = []
+    for stage in training_stages:
+        if "key" in stage:
+            config = stage["key"](model_config)
+        else:
+            config = {name: model_config.get(name) for name in stage["config_keys"]}
+        if stage.get("native_features"):
+            config["native_features"] = native_features(model_config)
+        key = {"upstream": upstream, "config": config}
+        upstream = cache.hash_object(key)
+        hashes.append({"key": key, "hash": upstream})
+    return hashes
+
+
+def prepare_shared_stages(model_config: Dict[str, Any], output_folder: Path, snapshot: Optional[Path] = None) -> None:
+    """Runs the data preparation stages, see `shared_stages`, saving their results for other experiments.
+
+    Train and test data are saved as Arrow IPC snapshots, for experiments to
+    memory map rather than each repeating the preparation, see
+    `run_model_training`. Files the stages write to the model folder, i.e.
+    `filter_counts.csv`, are copied alongside them. `prepared.json` holds the
+    last stage hash, dummy feature names and copied file names, and is written
+    last, so that its presence marks a complete folder.
+
+    Args:
+        model_config: Loaded model experiment config, of any experiment sharing the stages
+        output_folder: Location of prepared data
+        snapshot: Optional Arrow IPC snapshot of the data file to load from, see `batch.prepare_snapshots`
+    """
+    utils.create_model_folder(model_config)
+    model_path = utils.get_model_path(model_config)
+    before = cache.file_mtimes(model_path)
+    state: Dict[str, Any] = {"snapshot": snapshot}
+    for stage in training_stages[: len(shared_stages)]:
+        logging.debug(f"Running stage {stage['name']}")
+        state = stage["run"](state, model_config)
+    outputs = [Path(path) for path, mtime in cache.file_mtimes(model_path).items() if before.get(path) != mtime]
+
+    logging.info(f"Saving prepared train and test data to {output_folder}")
+    output_folder.mkdir(parents=True, exist_ok=True)
+    cache.write_snapshot(state["train"], Path(output_folder, "train.arrow"))
+    cache.write_snapshot(state["test"], Path(output_folder, "test.arrow"))
+    for path in outputs:
+        shutil.copy2(path, Path(output_folder, path.name))
+    prepared = {
+        "hash": stage_hashes(model_config)[len(shared_stages) - 1]["hash"],
+        "dummy_features": state["dummy_features"],
+        "outputs": [path.name for path in outputs],
+    }
+    with open(Path(output_folder, "prepared.json"), "w") as f:
+        json.dump(prepared, f, indent=2)
+
+
+def _load_prepared_stages(
+    prepared_folder: Path, hashes: List[Dict[str, Any]], model_config: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """Loads the data saved by `prepare_shared_stages`, and caches it as the result of the shared stages.
+
+    Saved files are copied to the model folder. Only the last shared stage
+    saves its values, so resuming from an earlier stage re-runs every stage.
+
+    Returns:
+        Pipeline state after the shared stages, or None if the data was prepared for different stage keys.
+    """
+    with open(Path(prepared_folder, "prepared.json"), "r") as f:
+        prepared = json.load(f)
+    if prepared["hash"] != hashes[-1]["hash"]:
+        logging.warning(f"Prepared data {prepared_folder} does not match this experiment, preparing it again")
+        return None
+    logging.info(f"Loading prepared train and test data from {prepared_folder}")
+    state = {
+        "train": cache.read_snapshot(Path(prepared_folder, "train.arrow")),
+        "test": cache.read_snapshot(Path(prepared_folder, "test.arrow")),
+        "dummy_features": prepared["dummy_features"],
+    }
+
+    model_path = utils.get_model_path(model_config)
+    outputs = [str(Path(model_path, name)) for name in prepared["outputs"]]
+    for name, output_path in zip(prepared["outputs"], outputs):
+        shutil.copy2(Path(prepared_folder, name), output_path)
+    cache_folder = Path(model_path, "_cache")
+    for stage, stage_hash in zip(training_stages, hashes):
+        last = stage["name"] == shared_stages[-1]
+        saved = list(state) if last else []
+        cache.save_stage(
+            stage["name"], stage_hash["key"], stage_hash["hash"], state, cache_folder, saved, outputs if last else []
+        )
+    return state
+
+
+def run_model_training(
+    model_config: Dict[str, Any],
+    use_cache: bool = True,
+    snapshot: Optional[Path] = None,
+    prepared: Optional[Path] = None,
+) -> None:
     """Run all modeling transformations.
 
     Includes the following steps:
@@ -213,49 +987,62 @@ def run_model_training(model_config: Dict[str, Any]) -> None:
     * Filters target variable in train data
     * Prepares missing data replacement
     * Optionally saves data
+    * Optionally searches model parameters on training data
+    * Optionally cross validates model on training data
     * Trains model according to model specifications
     * Produce metrics and plots
 
+    Each step is a stage in `training_stages`, with the values it sets cached
+    in the model folder's `_cache`. Re-runs resume after the last stage whose
+    config keys, upstream stages, data and code are unchanged, and whose
+    written files, and those of every stage before it, still exist.
+
     Args:
         model_config: Loaded model experiment config
+        use_cache: Resume from cached stages, otherwise run and re-cache every stage
+        snapshot: Optional Arrow IPC snapshot of the data file to load from, see `batch.prepare_snapshots`
+        prepared: Optional folder of data prepared by the shared stages, see `prepare_shared_stages`,
+          used in place of running them
     """
+    check_native_categories(model_config, model_config.get("hashed_features") or {})
+
     # Create resource folder if not exist
     utils.create_model_folder(model_config)
-    data = prep.load_data_and_key(model_config)
-
-    # Create dummy features
-    data, dummy_features = prep.create_dummy_features(data, model_config)
-
-    # Apply filtering to the filter field, if present in model_config
-    data = prep.apply_filtering(data, model_config)
-
-    # Train test split according to config
-    train, test = prep.split(data, model_config)
-
-    # Target variable may have missing data; drop all rows with missing
-    train = prep.filter_target(train, model_config)
-
-    # Fill missing features (using train) according to config (i.e. mean, mode)
-    aggregates = prep.get_simple_feature_aggregates(train, model_config)
-    train = prep.apply_feature_aggregates(train, aggregates)
-    test = prep.apply_feature_aggregates(test, aggregates)
-
-    if model_config.get("save_data"):
-        prep.save_data(train, test, model_config)
-
-    # Get features
-    features = prep.collate_features(model_config, dummy_features)
-
-    # Train model
-    model_function_name = model_config.get("model_function_name")
-    if model_function_name:
-        model_function = utils.get_model(model_function_name)
-        reporting_features = model_function(train, test, features, model_config)
-
-    # Produce diagnostic info
-    post.create_univariate_plots(train, reporting_features, model_config)
-    post.create_continuous_plots(train, reporting_features, model_config)
-    post.create_correlation_matrix(train, reporting_features, model_config)
+    model_path = utils.get_model_path(model_config)
+    cache_folder = Path(model_path, "_cache")
+    hashes = stage_hashes(model_config)
+
+    # Find the latest stage which can be skipped, with every stage before it unchanged
+    manifests: List[Dict[str, Any]] = []
+    for stage, stage_hash in zip(training_stages, hashes) if use_cache else []:
+        manifest = cache.load_stage(stage["name"], stage_hash["hash"], cache_folder)
+        if manifest is None:
+            break
+        manifests.append(manifest)
+
+    first, state = 0, {"snapshot": snapshot}
+    result = cache.load_stage_state(manifests, cache_folder) if manifests else None
+    if result is not None:
+        logging.info(f"Stages up to {training_stages[len(manifests) - 1]['name']} unchanged, resuming from cache")
+        first, state = len(manifests), result
+
+    if prepared is not None and first < len(shared_stages):
+        result = _load_prepared_stages(prepared, hashes[: len(shared_stages)], model_config)
+        if result is not None:
+            first, state = len(shared_stages), result
+
+    for stage, stage_hash in zip(training_stages[first:], hashes[first:]):
+        logging.debug(f"Running stage {stage['name']}")
+        before = cache.file_mtimes(model_path)
+        result = stage["run"](state, model_config)
+        unexpected = [name for name in result if name not in stage["state"] and result[name] is not state.get(name)]
+        if unexpected:
+            raise ValueError(f"Stage {stage['name']} set undeclared state {unexpected}")
+        outputs = [path for path, mtime in cache.file_mtimes(model_path).items() if before.get(path) != mtime]
+        cache.save_stage(
+            stage["name"], stage_hash["key"], stage_hash["hash"], result, cache_folder, stage["state"], outputs
+        )
+        state = result
 
 
 def main() -> None:
@@ -266,6 +1053,7 @@ def main() -> None:
     """
     parser = argparse.ArgumentParser(description="ndj_pipeline model training")
     parser.add_argument("-p", type=str, help="Path to model experiment yaml")
+    parser.add_argument("--no-cache", action="store_true", help="Re-run every training stage")
     parser.add_argument("-v", action="store_true", help="Debug mode")
 
     args = parser.parse_args()
@@ -293,7 +1081,7 @@ def main() -> None:
         logging.warning(msg)
 
     logging.info("Running in training mode")
-    run_model_training(model_config)
+    run_model_training(model_config, use_cache=not args.no_cache)
 
 
 if __name__ == "__main__":
@@ -54,6 +54,14 @@ sns.set_palette(five_thirty_eight)
 sns.set(rc={"figure.figsize": (8, 5)})
 
 
+def calculate_metrics(results: pd.DataFrame) -> Dict[str, float]:
+    """Rounded r2, mae and mse metrics of a results table with "Actual" and "Predicted" columns."""
+    _r2 = r2_score(results["Actual"], results["Predicted"])
+    _mae = mae(results["Actual"], results["Predicted"])
+    _mse = mse(results["Actual"], results["Predicted"])
+    return {"r2": round(_r2, 2), "mae": round(_mae, 5), "mse": round(_mse, 5)}
+
+
 def create_metrics_plot(results: pd.DataFrame, model_config: Dict[str, Any], name: str = "") -> None:
     """Produce metrics and scatterplot for results table.
 
@@ -65,11 +73,7 @@ def create_metrics_plot(results: pd.DataFrame, model_config: Dict[str, Any], nam
         name: Simple label added to outputs, helpful to distinguish models
     """
     # Metrics
-    _r2 = r2_score(results["Actual"], results["Predicted"])
-    _mae = mae(results["Actual"], results["Predicted"])
-    _mse = mse(results["Actual"], results["Predicted"])
-
-    metrics = {"r2": round(_r2, 2), "mae": round(_mae, 5), "mse": round(_mse, 5)}
+    metrics = calculate_metrics(results)
 
     output_path = Path(utils.get_model_path(model_config), "metrics.json")
     with open(output_path, "w") as f:
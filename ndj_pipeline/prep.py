@@ -22,30 +22,119 @@
 
 These operations are ordered according to `ndj_pipeline.model.run_model_training`.
 """
+import functools
+import json
 import logging
+import operator
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+from scipy import sparse
 from sklearn.model_selection import train_test_split as tts
 
-from ndj_pipeline import utils
+from ndj_pipeline import cache, config, streaming, utils
 
+# Model inputs, see `feature_matrix`
+FeatureMatrix = Union[np.ndarray, sparse.csr_matrix]
 
-def load_data_and_key(model_config: Dict[str, Any]) -> pd.DataFrame:
+
+def required_columns(model_config: Dict[str, Any]) -> List[str]:
+    """Columns of the processed data used by a model experiment config.
+
+    Includes key, filter, target, baseline and split columns, simple and dummy
+    features, and any `extra_columns` needed by custom model functions.
+    """
+    split_params = model_config.get("split") or {}
+    split_field = split_params.get("field")
+    stratify = split_params.get("stratify") if split_params.get("method") == "hash" else None
+    columns = [
+        *(model_config.get("unique_key") or []),
+        "_filter",
+        model_config["target"],
+        model_config.get("baseline"),
+        split_field,
+        *([stratify] if isinstance(stratify, str) else stratify or []),
+        *(model_config.get("simple_features") or {}),
+        *(model_config.get("dummy_features") or []),
+        *(model_config.get("hashed_features") or {}),
+        *(model_config.get("extra_columns") or []),
+    ]
+    return list(dict.fromkeys(col for col in columns if col))
+
+
+def pushdown_filters(input_path: Path, model_config: Dict[str, Any]) -> Optional[ds.Expression]:
+    """Arrow dataset filter excluding rows that later filtering and splitting would drop.
+
+    Filter labels are matched against the unique `_filter` values only, from a
+    scan of that single column. Rows with a split field other than 0 or 1 are
+    excluded, as they are neither train nor test.
+
+    Args:
+        input_path: Processed parquet file or dataset directory
+        model_config: Loaded model experiment config, specifically for
+          filter labels and split field.
+
+    Returns:
+        Arrow dataset expression, or None if no rows can be excluded.
+    """
+    expressions = []
+    labels = model_config.get("filters") or []
+    if labels:
+        values = utils.read_parquet_dataset(input_path, columns=["_filter"])["_filter"]
+        _, uniques, unique_matches = filter_label_matches(values, labels)
+        excluded = uniques[unique_matches.any(axis=1)]
+        if len(excluded):
+            expressions.append(ds.field("_filter").is_null() | ~ds.field("_filter").isin(excluded.tolist()))
+
+    split_field = (model_config.get("split") or {}).get("field")
+    if split_field:
+        expressions.append(ds.field(split_field).isin([0, 1]))
+
+    if not expressions:
+        return None
+    logging.info(f"Pushing down filters {model_config.get('filters', [])} and split field {split_field}")
+    return functools.reduce(operator.and_, expressions)
+
+
+def load_data_and_key(model_config: Dict[str, Any], snapshot: Optional[Path] = None) -> pd.DataFrame:
     """Uses config to load data and assign key.
 
+    Only columns used by the config are read, see `required_columns`. With
+    `pushdown_filters: True` rows removed by filters or split field are also
+    skipped while reading, see `pushdown_filters`. Dummy feature incidence is
+    then calculated on the remaining rows only.
+
+    Otherwise, data may be read from a memory mapped snapshot of the data file
+    shared by several experiments, see `batch.prepare_snapshots`.
+
     Args:
         model_config: Loaded model experiment config, specifically for
           data path and index column(s)
+        snapshot: Optional Arrow IPC snapshot of the data file, with at least the required columns
 
     Returns:
         Pandas dataframe with optionally assigned index
+
+    Raises:
+        ValueError: If config specified columns are missing, or the key is not unique.
     """
     input_path = Path(*model_config["data_file"])
-    logging.info(f"Loading parquet from {input_path}")
-    data = pd.read_parquet(input_path)
+    columns = required_columns(model_config)
+    missing = set(columns) - set(utils.read_parquet_schema(input_path).names)
+    if missing:
+        raise ValueError(f"Config specified columns missing from {input_path}; {', '.join(sorted(missing))}")
+
+    if snapshot and not model_config.get("pushdown_filters"):
+        logging.info(f"Loading {len(columns)} columns of {input_path} from snapshot {snapshot}")
+        data = cache.read_snapshot(snapshot, columns=columns)
+    else:
+        filters = pushdown_filters(input_path, model_config) if model_config.get("pushdown_filters") else None
+        logging.info(f"Loading {len(columns)} columns of parquet from {input_path}")
+        data = utils.read_parquet_dataset(input_path, columns=columns, filters=filters)
 
     unique_key = model_config.get("unique_key")
     if unique_key:
@@ -55,13 +144,39 @@ def load_data_and_key(model_config: Dict[str, Any]) -> pd.DataFrame:
     return data
 
 
+def filter_label_matches(values: pd.Series, labels: List[str]) -> Tuple[np.ndarray, pd.Index, np.ndarray]:
+    """Matches filter labels against each unique value of a `_filter` column.
+
+    Categorical columns use their existing categories and codes, otherwise the
+    column is factorized. Labels are combined into one regex pass over the
+    unique values, see `utils.match_patterns`.
+
+    Args:
+        values: `_filter` column, string or categorical type.
+        labels: Filter labels, as regex patterns.
+
+    Returns:
+        Row codes into the unique values (-1 where missing), the unique values,
+        and a boolean array of shape (unique values, labels).
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+        uniques = pd.Index(uniques)
+    return codes, uniques, utils.match_patterns(pd.Series(uniques, dtype=object), labels)
+
+
 def apply_filtering(df: pd.DataFrame, model_config: Dict[str, Any]) -> pd.DataFrame:
     """Filters dataframe according to config specified labels.
 
-    Any row containing a specified label is filtered from the data.
+    Any row containing a specified label is filtered from the data. Labels are
+    matched in a single pass over the unique `_filter` values, and the result
+    broadcast to rows. Rows matching each label are counted, logged and saved
+    to `filter_counts.csv` in the model folder.
 
     Args:
-        df: Pandas dataframe, must contain `_filter` column with string type.
+        df: Pandas dataframe, must contain `_filter` column with string or categorical type.
         model_config: Loaded model experiment config, specifically for
           list of filter labels.
 
@@ -74,21 +189,109 @@ def apply_filtering(df: pd.DataFrame, model_config: Dict[str, Any]) -> pd.DataFr
     if "_filter" not in df.columns:
         raise ValueError("Expects `_filter` column in processed data.")
 
-    if not model_config.get("filters", []):
+    labels = model_config.get("filters", [])
+    if not labels:
         logging.debug("No filter conditions from config, passing")
         return df
 
-    master_filter = pd.Series(0, index=df.index)
-    for _filter in model_config.get("filters", []):
-        master_filter = master_filter | df["_filter"].str.contains(_filter)
-    master_filter = ~master_filter
+    codes, _, unique_matches = filter_label_matches(df["_filter"], labels)
+    unique_counts = np.bincount(codes[codes >= 0], minlength=len(unique_matches))
+    only_label = unique_matches & (unique_matches.sum(axis=1, keepdims=True) == 1)
+
+    counts = pd.DataFrame(
+        {"rows_matched": unique_counts @ unique_matches, "rows_matched_only": unique_counts @ only_label},
+        index=pd.Index(labels, name="filter"),
+    )
+    logging.info(f"Rows matching each filter label\n{counts.to_string()}")
+    output_path = Path(utils.get_model_path(model_config), "filter_counts.csv")
+    logging.info(f"Saving to: {output_path}")
+    counts.to_csv(output_path)
 
-    logging.info(f"Applying filters {model_config.get('filters', [])} to dataset, pre shape {df.shape}")
-    df = df.loc[master_filter]
+    # Missing values, code -1, take the appended False
+    excluded = np.append(unique_matches.any(axis=1), False)[codes]
+    logging.info(f"Applying filters {labels} to dataset, pre shape {df.shape}")
+    df = df.loc[~excluded]
     logging.info(f"Post filter shape {df.shape}")
     return df
 
 
+def fit_compressed_dummies(values: pd.Series, dummy: str, min_dummy: float) -> Dict[str, Any]:
+    """Fits the compressed dummy encoding of a single column.
+
+    Values are compared as cleaned strings. Each value with at least `min_dummy`
+    incidence gets its own dummy column, named `{col_name}_##_{value}` in sorted
+    order, and all others share a final `_other_combined` column.
+
+    Args:
+        values: Column to encode
+        dummy: string label of the column, used for dummy column naming
+        min_dummy: minimum percentage incidence to create standalone
+          dummy feature, otherwise group into `_other_combined`.
+
+    Returns:
+        Json serializable encoding; raw string `values` with their dummy `codes`,
+        and dummy column `names`. Any other value takes the final code.
+    """
+    counts = values.astype(str).value_counts(sort=False)
+    cleaned = pd.Series(utils.clean_column_names(counts.index.tolist()))
+    incidence = counts.groupby(cleaned).sum() / max(len(values), 1)
+
+    kept = incidence.index[incidence >= min_dummy]
+    raw_codes = cleaned.map(pd.Series(np.arange(len(kept)), index=kept)).dropna().astype(int)
+    return {
+        "values": raw_codes.index.tolist(),
+        "codes": raw_codes.tolist(),
+        "names": [f"{dummy}_##_{value}" for value in kept] + [f"{dummy}_##_other_combined"],
+    }
+
+
+def fit_hashed_dummies(dummy: str, buckets: int) -> Dict[str, Any]:
+    """Hashed dummy encoding of a single column, with a fixed number of buckets.
+
+    Nothing is learnt from the data, so the number of columns is bounded no
+    matter how many distinct values there are. Distinct values may share a bucket.
+
+    Args:
+        dummy: string label of the column, used for dummy column naming
+        buckets: Number of hashed dummy columns
+
+    Returns:
+        Json serializable encoding with `buckets` and dummy column `names`.
+    """
+    return {"buckets": buckets, "names": [f"{dummy}_##_hash_{i}" for i in range(buckets)]}
+
+
+def dummy_codes(values: pd.Series, encoding: Dict[str, Any]) -> np.ndarray:
+    """Looks up the dummy code of each value from a fitted encoding, see `fit_compressed_dummies`.
+
+    Hashed encodings, see `fit_hashed_dummies`, hash each unique value once,
+    with rows taking their bucket through factorized codes.
+    """
+    if "buckets" in encoding:
+        codes, uniques = pd.factorize(values.astype(str))
+        hashed = pd.util.hash_array(np.asarray(uniques, dtype=object)) % np.uint64(encoding["buckets"])
+        return hashed.astype(np.int32)[codes]
+
+    other = len(encoding["names"]) - 1
+    position = pd.Index(encoding["values"], dtype=object).get_indexer(values.astype(str))
+    return np.append(np.asarray(encoding["codes"], dtype=np.int32), np.int32(other))[position]
+
+
+def dense_dummies(codes: np.ndarray, names: List[str], index: pd.Index) -> pd.DataFrame:
+    """One-hot DataFrame from dummy codes."""
+    one_hot = codes[:, None] == np.arange(len(names))
+    return pd.DataFrame(one_hot.astype(np.uint8), columns=names, index=index)
+
+
+def dummy_block(codes: np.ndarray, width: int) -> sparse.csr_matrix:
+    """One-hot CSR matrix from dummy codes."""
+    rows = len(codes)
+    return sparse.csr_matrix(
+        (np.ones(rows, dtype=np.float64), codes, np.arange(rows + 1)),
+        shape=(rows, width),
+    )
+
+
 def create_compressed_dummies(df: pd.DataFrame, dummy: str, min_dummy: float) -> Tuple[pd.DataFrame, List[str]]:
     """Creates enhanced feature dummies for a single dataframe column.
 
@@ -106,26 +309,94 @@ def create_compressed_dummies(df: pd.DataFrame, dummy: str, min_dummy: float) ->
         Dummified Pandas DataFrame for a single feature.
         Also returns dummy column names as a list of strings.
     """
-    # Cleaning steps to avoid weird characters in string
-    df[dummy] = df[dummy].astype(str)
-    values = list(df[dummy].unique())
-    df[dummy] = df[dummy].replace(utils.clean_column_names(values))
+    encoding = fit_compressed_dummies(df[dummy], dummy, min_dummy)
+    return dense_dummies(dummy_codes(df[dummy], encoding), encoding["names"], df.index), encoding["names"]
 
-    raw_dummies = pd.get_dummies(df[dummy], prefix=f"{dummy}_##")
-    dummies_min_test = raw_dummies.mean() < min_dummy
 
-    insufficient = dummies_min_test[dummies_min_test].index
-    sufficient = dummies_min_test[~dummies_min_test].index
+def fit_dummy_encoder(df: pd.DataFrame, model_config: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Fits compressed dummy encodings for each config specified dummy feature.
+
+    Args:
+        df: Pandas dataframe, must contain specified dummy columns.
+        model_config: Loaded model experiment config, specifically for
+          list of dummy features and minimum incidence.
+
+    Columns in the `hashed_features` config section, of column name: number of
+    buckets, are encoded by hashing instead, see `fit_hashed_dummies`.
+
+    Returns:
+        Dictionary of column name: encoding, see `fit_compressed_dummies`.
+
+    Raises:
+        ValueError: If a column is both a dummy and a hashed feature.
+    """
+    dummy_features = model_config.get("dummy_features") or []
+    hashed_features = model_config.get("hashed_features") or {}
+    both = set(dummy_features) & set(hashed_features)
+    if both:
+        raise ValueError(f"Columns cannot be both dummy and hashed features; {', '.join(sorted(both))}")
+
+    min_dummy = model_config.get("min_dummy_percent", 0.001)
+    encoder = {col: fit_compressed_dummies(df[col], col, min_dummy) for col in dummy_features}
+    encoder.update({col: fit_hashed_dummies(col, buckets) for col, buckets in hashed_features.items()})
+    return encoder
+
+
+def save_dummy_encoder(encoder: Dict[str, Dict[str, Any]], model_config: Dict[str, Any]) -> None:
+    """Saves a fitted dummy encoder to the model folder as json."""
+    output_path = Path(utils.get_model_path(model_config), "dummy_encoder.json")
+    logging.info(f"Saving dummy encoder to {output_path}")
+    with open(output_path, "w") as f:
+        json.dump(encoder, f, indent=2)
 
-    selected_dummies = raw_dummies[sufficient]
-    selected_dummies[f"{dummy}_##_other_combined"] = (raw_dummies[insufficient].sum(axis=1) > 0).astype(int)
-    return selected_dummies, selected_dummies.columns.tolist()
+
+def load_dummy_encoder(model_config: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Loads the dummy encoder fitted in model training, see `save_dummy_encoder`."""
+    input_path = Path(utils.get_model_path(model_config), "dummy_encoder.json")
+    logging.info(f"Loading dummy encoder from {input_path}")
+    with open(input_path, "r") as f:
+        return json.load(f)
+
+
+def apply_dummy_encoder(
+    df: pd.DataFrame, encoder: Dict[str, Dict[str, Any]], sparse_dummies: bool = False
+) -> Tuple[pd.DataFrame, List[str]]:
+    """Adds dummy features to a DataFrame using a fitted encoder.
+
+    Values are looked up in each column's fitted encoding, so new data always
+    gets the same dummy columns in the same order, with unseen values in
+    `_other_combined`.
+
+    Args:
+        df: Pandas dataframe, must contain the encoded columns.
+        encoder: Fitted encoder, see `fit_dummy_encoder`
+        sparse_dummies: Add a single `{col}_##` code column per feature, rather
+          than one column per dummy, see `feature_matrix`.
+
+    Returns:
+        Pandas DataFrame with original data plus all new dummy fields.
+        Also returns full list of dummy column names.
+    """
+    codes = {f"{col}_##": dummy_codes(df[col], encoding) for col, encoding in encoder.items()}
+    dummy_features = [name for encoding in encoder.values() for name in encoding["names"]]
+    if sparse_dummies:
+        df[list(codes)] = pd.DataFrame(codes, index=df.index)
+        return df, dummy_features
+
+    blocks = [dense_dummies(codes[f"{col}_##"], encoding["names"], df.index) for col, encoding in encoder.items()]
+    return pd.concat([df] + blocks, axis=1), dummy_features
 
 
 def create_dummy_features(df: pd.DataFrame, model_config: Dict[str, Any]) -> Tuple[pd.DataFrame, List[str]]:
     """Create dummy features for each config specified dummy_variable.
 
-    Iterates through all specified dummy features and adds to DataFrame.
+    Fits a dummy encoder on the data, saves it to the model folder as
+    `dummy_encoder.json`, and applies it, see `apply_dummy_encoder`.
+
+    With `sparse_dummies: True` in config, a single `{col}_##` code column is
+    added per dummy feature rather than one column per value. Dummy column names
+    are still returned, and the one-hot values are built as a sparse matrix when
+    fitting, see `feature_matrix`.
 
     Args:
         df: Pandas dataframe, must contain specified dummy columns.
@@ -137,14 +408,101 @@ def create_dummy_features(df: pd.DataFrame, model_config: Dict[str, Any]) -> Tup
         Also returns full list of created dummy column names
     """
     logging.info("Creating dummy features")
-    dummy_features = []
-    min_dummy = model_config.get("min_dummy_percent", 0.001)
-    for col in model_config.get("dummy_features", []):
-        logging.debug(f"Creating dummy features for {col}")
-        _features, _cols = create_compressed_dummies(df, col, min_dummy)
-        df = df.join(_features)
-        dummy_features += _cols
-    return df, dummy_features
+    encoder = fit_dummy_encoder(df, model_config)
+    save_dummy_encoder(encoder, model_config)
+    return apply_dummy_encoder(df, encoder, model_config.get("sparse_dummies", False))
+
+
+def dummy_code_columns(dummy_features: List[str]) -> List[str]:
+    """The `{col}_##` code column of each dummy feature column, in order, see `apply_dummy_encoder`."""
+    return list(dict.fromkeys(feature.split("_##_")[0] + "_##" for feature in dummy_features))
+
+
+def feature_matrix(
+    df: pd.DataFrame, features: List[str], model_config: Dict[str, Any], output_path: Optional[Path] = None
+) -> FeatureMatrix:
+    """Model inputs for the given features, in order, built once for fitting and reporting.
+
+    Dense features are copied column by column into a single C contiguous array,
+    of `matrix_dtype` from config (float64 by default, or float32 to halve
+    memory), without first copying the mixed dtype feature block. With an
+    output path, the array is a memory mapped `.npy` file instead.
+
+    With `sparse_dummies`, returns a CSR matrix of simple feature columns followed
+    by the one-hot block of each dummy feature.
+
+    Args:
+        df: Pandas dataframe with simple feature columns, and dummy columns or codes.
+        features: Simple feature names followed by dummy feature names, see `collate_features`
+        model_config: Loaded model experiment config
+        output_path: Optional `.npy` file to memory map a dense matrix to
+
+    Returns:
+        Numpy array, or scipy CSR matrix, with one column per feature.
+
+    Raises:
+        ValueError: If features are not simple features followed by dummy features.
+    """
+    dtype = np.dtype(model_config.get("matrix_dtype", "float64"))
+    if not model_config.get("sparse_dummies"):
+        shape = (len(df), len(features))
+        if output_path:
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            matrix = np.lib.format.open_memmap(output_path, mode="w+", dtype=dtype, shape=shape)
+        else:
+            matrix = np.empty(shape, dtype=dtype)
+        for i, feature in enumerate(features):
+            matrix[:, i] = df[feature].to_numpy(dtype=dtype, na_value=np.nan)
+        return matrix
+
+    simple_features = [feature for feature in features if feature in df.columns]
+    widths: Dict[str, int] = {}
+    for feature in features[len(simple_features) :]:
+        code_column = feature.split("_##_")[0] + "_##"
+        widths[code_column] = widths.get(code_column, 0) + 1
+
+    blocks = [sparse.csr_matrix(df[simple_features].to_numpy(dtype=dtype))]
+    for code_column, width in widths.items():
+        blocks.append(dummy_block(df[code_column].to_numpy(), width))
+    matrix = sparse.hstack(blocks, format="csr", dtype=dtype)
+    if matrix.shape[1] != len(features):
+        raise ValueError(f"Sparse feature matrix has {matrix.shape[1]} columns, expected {len(features)}")
+    return matrix
+
+
+def matrix_columns(matrix: FeatureMatrix, features: List[str], names: List[str], index: pd.Index) -> pd.DataFrame:
+    """DataFrame of a few named feature columns of a model matrix, i.e. for plotting reported features."""
+    positions = [features.index(name) for name in names]
+    columns = matrix[:, positions]
+    columns = columns.toarray() if sparse.issparse(columns) else np.asarray(columns)
+    return pd.DataFrame(columns, columns=names, index=index)
+
+
+def save_feature_matrix(matrix: FeatureMatrix, output_folder: Path) -> None:
+    """Saves a feature matrix as numpy files, so that it can be memory mapped by other processes.
+
+    Dense matrices are saved as a single contiguous `X.npy`. Sparse matrices
+    are saved as their CSR data, indices, indptr and shape arrays.
+    """
+    output_folder.mkdir(parents=True, exist_ok=True)
+    logging.debug(f"Saving feature matrix to {output_folder}")
+    if sparse.issparse(matrix):
+        matrix = sparse.csr_matrix(matrix)
+        for name in ["data", "indices", "indptr"]:
+            np.save(Path(output_folder, f"X_{name}.npy"), getattr(matrix, name))
+        np.save(Path(output_folder, "X_shape.npy"), np.array(matrix.shape))
+    else:
+        np.save(Path(output_folder, "X.npy"), np.ascontiguousarray(matrix))
+
+
+def load_feature_matrix(input_folder: Path) -> FeatureMatrix:
+    """Memory maps a feature matrix saved by `save_feature_matrix`, without reading it into memory."""
+    dense_path = Path(input_folder, "X.npy")
+    if dense_path.exists():
+        return np.load(dense_path, mmap_mode="r")
+    arrays = [np.load(Path(input_folder, f"X_{name}.npy"), mmap_mode="r") for name in ["data", "indices", "indptr"]]
+    shape = tuple(np.load(Path(input_folder, "X_shape.npy")))
+    return sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
 
 
 def filter_target(df: pd.DataFrame, model_config: Dict[str, Any]) -> pd.DataFrame:
@@ -164,6 +522,59 @@ def filter_target(df: pd.DataFrame, model_config: Dict[str, Any]) -> pd.DataFram
     return df
 
 
+def hash_split_mask(
+    df: pd.DataFrame,
+    test_size: Union[float, Dict[Any, float]],
+    salt: str = "ndj_pipeline",
+    stratify: Optional[List[str]] = None,
+) -> np.ndarray:
+    """Deterministic test set assignment from a hash of each row's index.
+
+    Each row's salted hash is compared to a threshold, `test_size` of the hash
+    range, so the same row always lands in the same set across re-runs, added
+    data, or when applied to chunks and partitions separately. The test share
+    is then `test_size` in expectation. Changing the salt gives a different split.
+
+    With a stratify column, `test_size` may instead map each of its values to
+    that stratum's test share, with each row compared to its stratum's threshold.
+
+    Args:
+        df: Pandas dataframe indexed by its unique key
+        test_size: Fraction of rows in the test set, or mapping of stratum value: fraction
+        salt: String hashed with each key
+        stratify: Optional columns to set test shares by, see `test_size`
+
+    Returns:
+        Boolean array, True for test rows.
+
+    Raises:
+        ValueError: If a test size is not a fraction between 0 and 1, or a stratum has no test size.
+    """
+    if isinstance(test_size, dict):
+        if not stratify or len(stratify) != 1:
+            raise ValueError("Hash split test_size by stratum needs a single stratify column")
+        fractions = df[stratify[0]].map(test_size)
+        if fractions.isna().any():
+            missing = df.loc[fractions.isna().to_numpy(), stratify[0]].unique()
+            raise ValueError(f"Hash split test_size missing for {stratify[0]} values; {', '.join(map(str, missing))}")
+        fractions = fractions.to_numpy(dtype=np.float64)
+    elif isinstance(test_size, (int, np.integer)) and not isinstance(test_size, bool):
+        raise ValueError(f"Hash split test_size {test_size} must be a fraction, as row counts depend on other rows")
+    else:
+        fractions = np.full(len(df), test_size, dtype=np.float64)
+    if ((fractions < 0) | (fractions > 1)).any():
+        raise ValueError(f"Hash split test_size {test_size}, expected fractions between 0 and 1")
+
+    keys = df.index.to_frame(index=False)
+    keys["_salt"] = salt
+    hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+    # Thresholds in integer space, as uint64 max times a float is not exact
+    uniques, inverse = np.unique(fractions, return_inverse=True)
+    thresholds = np.array([min(int(fraction * 2.0**64), 2**64 - 1) for fraction in uniques], dtype=np.uint64)
+    return (hashes < thresholds[inverse]) | (fractions >= 1.0)
+
+
 def split(df: pd.DataFrame, model_config: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """Create train test split using model config.
 
@@ -171,6 +582,11 @@ def split(df: pd.DataFrame, model_config: Dict[str, Any]) -> Tuple[pd.DataFrame,
     or use sklearn style split params. No config results in no split,
     with the creation of an empty test dataframe.
 
+    With `method: hash`, rows are assigned by hashing the unique key with a
+    `salt`, against `test_size` (0.25 by default, as in sklearn), optionally
+    set per value of a `stratify` column, see `hash_split_mask`. Assignment is
+    then stable as data is added.
+
     Args:
         df: Pandas dataframe, must contain a pre-calculated split column
           if this is specified in the `model_config`.
@@ -179,14 +595,28 @@ def split(df: pd.DataFrame, model_config: Dict[str, Any]) -> Tuple[pd.DataFrame,
 
     Returns:
         Two Pandas DataFrames intended for training, test sets.
+
+    Raises:
+        ValueError: If a hash split has no unique key, or an invalid test size.
     """
-    split_params = model_config.get("split", {})
+    split_params = dict(model_config.get("split") or {})
     split_field = split_params.get("field", None)
+    method = split_params.pop("method", "random")
 
     if split_field:
         logging.info(f"Splitting sample at using existing {split_field} column")
         train = df.loc[df[split_field] == 1]
         test = df.loc[df[split_field] == 0]
+    elif method == "hash":
+        if not model_config.get("unique_key"):
+            raise ValueError("Hash split needs a config `unique_key`, as row positions change when data is added")
+        logging.info(f"Splitting sample by hash of {df.index.names}")
+        stratify = split_params.get("stratify") or []
+        stratify = [stratify] if isinstance(stratify, str) else stratify
+        test_size = split_params.get("test_size", 0.25)
+        is_test = hash_split_mask(df, test_size, split_params.get("salt", "ndj_pipeline"), stratify)
+        train = df.loc[~is_test]
+        test = df.loc[is_test]
     elif split_params:
         logging.info("Splitting sample at random")
         train, test = tts(df, **split_params)
@@ -200,12 +630,51 @@ def split(df: pd.DataFrame, model_config: Dict[str, Any]) -> Tuple[pd.DataFrame,
     return train, test
 
 
+def aggregate_block(block: np.ndarray, how: str) -> np.ndarray:
+    """Column aggregates of a 2d float array, ignoring missing values.
+
+    Args:
+        block: Float array of rows by columns, with NaN for missing values
+        how: Aggregation, one of mean, median or mode. The smallest value is
+          used where a column has several modes.
+
+    Returns:
+        Array with one aggregate per column, NaN where a column has no values.
+    """
+    present = ~np.isnan(block)
+    counts = present.sum(axis=0)
+    empty = np.full(block.shape[1], np.nan)
+
+    if how == "mean":
+        return np.divide(np.nansum(block, axis=0), counts, out=empty, where=counts > 0)
+
+    if how == "median":
+        # Partial sorts, only selecting the middle values of each column
+        if counts.all():
+            return np.nanmedian(block, axis=0)
+        empty[counts > 0] = np.nanmedian(block[:, counts > 0], axis=0)
+        return empty
+
+    if how == "mode":
+        for i in np.flatnonzero(counts):
+            values, value_counts = np.unique(block[present[:, i], i], return_counts=True)
+            empty[i] = values[value_counts.argmax()]
+        return empty
+
+    raise ValueError(f"Unsupported block aggregation {how}")
+
+
 def get_simple_feature_aggregates(df: pd.DataFrame, model_config: Dict[str, Any]) -> pd.Series:
     """Generates config specified feature aggregates.
 
     These are used to inform missing data replacement strategy. Ideally this is
     run on training data, and used to replace train and test data.
 
+    Features are grouped by aggregation, and each group is converted to a float
+    array in blocks of `aggregate_block_columns` columns. Infinity checks and
+    mean, median or mode are computed together on each block, optionally across
+    `aggregate_threads` threads. Other pandas aggregations are passed to `df.agg`.
+
     Performs validations and raises errors as part of process.
 
     Args:
@@ -222,43 +691,190 @@ def get_simple_feature_aggregates(df: pd.DataFrame, model_config: Dict[str, Any]
     """
     simple_features_agg = model_config.get("simple_features", {})
 
+    problems = [feature for feature in simple_features_agg if not pd.api.types.is_numeric_dtype(df[feature])]
+    numeric = {feature: how for feature, how in simple_features_agg.items() if feature not in problems}
+
+    block_columns = model_config.get("aggregate_block_columns", 256)
+    groups = []
+    for how in dict.fromkeys(numeric.values()):
+        columns = [feature for feature, feature_how in numeric.items() if feature_how == how]
+        groups += [(how, columns[i : i + block_columns]) for i in range(0, len(columns), block_columns)]
+
+    def _aggregate(group: Tuple[str, List[str]]) -> Tuple[np.ndarray, np.ndarray]:
+        how, columns = group
+        logging.debug(f"Aggregating {how} of {len(columns)} columns")
+        block = df[columns].to_numpy(dtype=np.float64, na_value=np.nan)
+        isinf = np.isinf(block).any(axis=0)
+        if how in ("mean", "median", "mode"):
+            return isinf, aggregate_block(block, how)
+        return isinf, df[columns].agg(how).to_numpy(dtype=np.float64)
+
+    threads = model_config.get("aggregate_threads", 1)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(_aggregate, groups))
+
     # Validate to ensure no features contain infinity
-    problems = []
-    for feature in simple_features_agg:
-        logging.debug(f"{feature} has {str(df[feature].dtype)}")
-        try:
-            isinf = df[feature].dropna().apply(np.isinf)
-        except TypeError:
-            problems.append(feature)
-        if isinf.any():
-            problems.append(feature)
+    aggregates = pd.Series(np.nan, index=list(simple_features_agg), name="aggregates")
+    for (_, columns), (isinf, values) in zip(groups, results):
+        problems += [column for column, inf in zip(columns, isinf) if inf]
+        aggregates[columns] = values
     if problems:
         raise ValueError(f"One or more features contains -inf/inf, fix these; {', '.join(problems)}")
 
-    agg = df.agg(simple_features_agg)
-    try:
-        agg = agg.loc[0]  # type: ignore
-    except KeyError:
-        logging.debug("No 'mode' values detected in aggregations")
+    save_feature_aggregates(aggregates, model_config)
+    return aggregates
+
 
-    aggregates = pd.Series(agg, name="aggregates")
+def iter_train_batches(
+    model_config: Dict[str, Any], columns: List[str], batch_size: Optional[int] = None
+) -> Iterator[pd.DataFrame]:
+    """Reads the training rows of the config data file in batches, without loading the data as a whole.
 
+    Rows are filtered and split as in model training; filter labels and split
+    field are pushed down to the read, see `pushdown_filters`, hash splits are
+    applied to each batch, see `hash_split_mask`, and rows with missing target
+    are dropped. Random splits depend on all rows, so are not supported.
+
+    Args:
+        model_config: Loaded model experiment config
+        columns: Columns needed from each batch, besides those used for filtering and splitting
+        batch_size: Maximum rows per batch read
+
+    Yields:
+        Pandas DataFrame batches of training rows, indexed by the unique key if any.
+
+    Raises:
+        ValueError: If the split is random, or a hash split has no unique key.
+    """
+    input_path = Path(*model_config["data_file"])
+    unique_key = model_config.get("unique_key") or []
+    target = model_config["target"]
+    split_params = model_config.get("split") or {}
+    split_field = split_params.get("field")
+    hashed = not split_field and split_params.get("method") == "hash"
+    if split_params and not split_field and not hashed:
+        raise ValueError("Reading training rows in batches needs a split `field` or `method: hash` split")
+    if hashed and not unique_key:
+        raise ValueError("Hash split needs a config `unique_key`, as row positions change when data is added")
+    stratify = (split_params.get("stratify") or []) if hashed else []
+    stratify = [stratify] if isinstance(stratify, str) else stratify
+
+    expressions = [pushdown_filters(input_path, model_config)]
+    if split_field:
+        expressions.append(ds.field(split_field) == 1)
+    expressions = [expression for expression in expressions if expression is not None]
+    filters = functools.reduce(operator.and_, expressions) if expressions else None
+    read_columns = list(dict.fromkeys([*unique_key, target, *stratify, *columns]))
+
+    batches = utils.iter_parquet_batches(
+        input_path, columns=read_columns, filters=filters, batch_size=batch_size or config.default_chunksize
+    )
+    for batch in batches:
+        if unique_key:
+            batch = batch.set_index(unique_key)
+        if hashed:
+            test_size = split_params.get("test_size", 0.25)
+            batch = batch.loc[~hash_split_mask(batch, test_size, split_params.get("salt", "ndj_pipeline"), stratify)]
+        yield batch.dropna(subset=[target])
+
+
+def stream_feature_aggregates(batches: Iterable[pd.DataFrame], model_config: Dict[str, Any]) -> pd.Series:
+    """Streaming version of `get_simple_feature_aggregates`, using bounded aggregation state.
+
+    In model training, batches of training rows are read from the data file,
+    see `iter_train_batches`, so the training data is never held as a whole.
+    Means are exact, while medians and modes are approximations, with sizes
+    set by the `streaming_aggregates` config section, see `ndj_pipeline.streaming`.
+
+    Args:
+        batches: DataFrames containing the `simple_features` columns
+        model_config: Loaded model experiment config, specifically for
+          `simple_features` dictionary of column names and aggregation strategy.
+
+    Returns:
+        Pandas Series with specified feature columns: value of aggregation.
+
+    Raises:
+        ValueError: If any features are not numeric, or contain infinate values that need fixing.
+    """
+    simple_features_agg = model_config.get("simple_features", {})
+    options = model_config.get("streaming_aggregates") or {}
+    aggregator = streaming.StreamingAggregator(
+        simple_features_agg,
+        sketch_size=options.get("sketch_size", 200),
+        mode_counters=options.get("mode_counters", 1000),
+    )
+
+    for batch in batches:
+        problems = [feature for feature in simple_features_agg if not pd.api.types.is_numeric_dtype(batch[feature])]
+        if problems:
+            raise ValueError(f"One or more features are not numeric, fix these; {', '.join(problems)}")
+        aggregator.update(batch)
+
+    problems = aggregator.problems()
+    if problems:
+        raise ValueError(f"One or more features contains -inf/inf, fix these; {', '.join(problems)}")
+
+    aggregates = aggregator.result()
+    save_feature_aggregates(aggregates, model_config)
+    return aggregates
+
+
+def save_feature_aggregates(aggregates: pd.Series, model_config: Dict[str, Any]) -> None:
+    """Saves feature aggregates to the model folder as `calc_train_aggregates.csv`."""
     model_path = utils.get_model_path(model_config)
     output_path = Path(model_path, "calc_train_aggregates.csv")
     logging.info(f"Saving to: {output_path}")
     pd.DataFrame(aggregates).to_csv(output_path)
 
-    return aggregates
+
+def load_feature_aggregates(model_config: Dict[str, Any]) -> pd.Series:
+    """Loads the feature aggregates calculated in model training, see `save_feature_aggregates`."""
+    input_path = Path(utils.get_model_path(model_config), "calc_train_aggregates.csv")
+    logging.info(f"Loading feature aggregates from {input_path}")
+    return pd.read_csv(input_path, index_col=0).iloc[:, 0]
+
+
+def fill_column(df: pd.DataFrame, col: str, value: Any) -> None:
+    """Fills missing values of a single column, replacing the column with a filled copy.
+
+    Columns without missing values are left as they are, so are not copied.
+
+    Raises:
+        TypeError: If the value cannot be stored in the column's type, i.e. float into Int64.
+    """
+    column = df[col]
+    if column.hasnans:
+        df[col] = column.fillna(value)
 
 
-def apply_feature_aggregates(df: pd.DataFrame, aggregates: pd.Series) -> pd.DataFrame:
+def downcast_columns(df: pd.DataFrame, columns: List[str]) -> None:
+    """Downcasts numeric columns in place; floats to float32, integers to the narrowest integer type.
+
+    Nullable integer columns are only downcast when they have no missing values.
+    """
+    for col in columns:
+        column = df[col]
+        if pd.api.types.is_bool_dtype(column.dtype):
+            continue
+        if pd.api.types.is_float_dtype(column.dtype):
+            df[col] = column.to_numpy(dtype=np.float32, na_value=np.nan)
+        elif pd.api.types.is_integer_dtype(column.dtype) and not column.hasnans:
+            df[col] = pd.to_numeric(column.to_numpy(dtype=np.int64), downcast="integer")
+
+
+def apply_feature_aggregates(df: pd.DataFrame, aggregates: pd.Series, downcast: bool = False) -> pd.DataFrame:
     """Applies feature aggregates to a DataFrame's missing values.
 
+    Columns are filled one at a time, see `fill_column`, rather than copying
+    the whole block of feature columns.
+
     Performs validations and raises errors as part of process.
 
     Args:
         df: Pandas dataframe. Must include same columns as aggregates.
         aggregates: Pandas series with labels and aggregate values.
+        downcast: Downcast the filled columns to save memory, see `downcast_columns`
 
     Returns:
         Pandas Dataframe with missing data replaced.
@@ -267,18 +883,17 @@ def apply_feature_aggregates(df: pd.DataFrame, aggregates: pd.Series) -> pd.Data
         ValueError: If unable to apply aggregation value to a column.
           This is commonly due to the datatypes not working i.e. float into Int64.
     """
-    try:
-        df[aggregates.index] = df[aggregates.index].fillna(aggregates)
-    except BaseException:
-        # If there is a problem, try one by one and report.
-        problems = []
-        for col, agg in aggregates.items():
-            try:
-                df[col].fillna(agg)
-            except TypeError:
-                problems.append(col)
-        if problems:
-            raise ValueError(f"Unable to parse some fields due to type issues {', '.join(problems)}") from None
+    problems = []
+    for col, agg in aggregates.items():
+        try:
+            fill_column(df, col, agg)
+        except (TypeError, ValueError):
+            problems.append(col)
+    if problems:
+        raise ValueError(f"Unable to parse some fields due to type issues {', '.join(problems)}")
+
+    if downcast:
+        downcast_columns(df, list(aggregates.index))
     return df
 
 
@@ -316,3 +931,11 @@ def collate_features(model_config: Dict[str, Any], dummy_features: List[str]) ->
             f.write("\n")
 
     return features
+
+
+def load_features(model_config: Dict[str, Any]) -> List[str]:
+    """Loads the final list of features used in model training, see `collate_features`."""
+    input_path = Path(utils.get_model_path(model_config), "features.txt")
+    logging.info(f"Loading list of features from {input_path}")
+    with open(input_path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
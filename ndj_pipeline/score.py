@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Scores new data with a trained model, streaming row batches with bounded memory."""
+import argparse
+import logging
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import pandas as pd
+
+from ndj_pipeline import config, model, prep, utils
+
+
+def load_scoring_assets(model_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Loads everything saved in model training that is needed to score new data.
+
+    The fitted estimator is memory mapped, see `model.load_estimator`. Native
+    feature models have no feature aggregates, as missing values are kept.
+
+    Args:
+        model_config: Loaded model experiment config
+
+    Returns:
+        Dictionary with fitted `estimator`, dummy `encoder`, feature `aggregates` and `features`.
+    """
+    return {
+        "estimator": model.load_estimator(model_config),
+        "encoder": prep.load_dummy_encoder(model_config),
+        "aggregates": None if model.native_features(model_config) else prep.load_feature_aggregates(model_config),
+        "features": prep.load_features(model_config),
+    }
+
+
+def scoring_columns(model_config: Dict[str, Any], encoder: Dict[str, Dict[str, Any]]) -> List[str]:
+    """Input columns needed to score data; the unique key, simple features and dummy encoded columns."""
+    columns = list(model_config.get("unique_key") or [])
+    columns += list(model_config.get("simple_features", {}))
+    columns += list(encoder)
+    return list(dict.fromkeys(columns))
+
+
+def score_batch(df: pd.DataFrame, assets: Dict[str, Any], model_config: Dict[str, Any]) -> pd.DataFrame:
+    """Predicts a batch of rows, using the same prep steps as model training.
+
+    Args:
+        df: Pandas dataframe batch with `scoring_columns`
+        assets: Trained model assets, see `load_scoring_assets`
+        model_config: Loaded model experiment config
+
+    Returns:
+        Pandas DataFrame with unique key columns, if any, and "Predicted" column.
+    """
+    unique_key = model_config.get("unique_key")
+    if unique_key:
+        df = df.set_index(unique_key)
+
+    native = model.native_features(model_config)
+    df, _ = prep.apply_dummy_encoder(df, assets["encoder"], native or model_config.get("sparse_dummies", False))
+    if assets["aggregates"] is not None:
+        df = prep.apply_feature_aggregates(df, assets["aggregates"], model_config.get("downcast_features", False))
+
+    matrix_config = {**model_config, "sparse_dummies": False} if native else model_config
+    matrix = prep.feature_matrix(df, assets["features"], matrix_config)
+    results = pd.DataFrame({"Predicted": assets["estimator"].predict(matrix)}, index=df.index)
+    return results.reset_index() if unique_key else results
+
+
+def run(
+    model_config: Dict[str, Any],
+    input_path: Optional[Path] = None,
+    output_path: Optional[Path] = None,
+    batch_size: int = config.default_chunksize,
+) -> int:
+    """Scores a parquet file or dataset with a trained model.
+
+    Input is read in batches of rows, see `utils.iter_parquet_batches`, and
+    predictions are written as each batch is scored, so memory use depends on
+    the batch size rather than the input size. Output is parquet, or csv for a
+    `.csv` output path.
+
+    Args:
+        model_config: Loaded model experiment config, of a trained model
+        input_path: Parquet file or dataset directory to score, by default the config `data_file`
+        output_path: Predictions file, by default `pred_score.parquet` in the model folder
+        batch_size: Maximum rows scored at a time
+
+    Returns:
+        Number of rows scored.
+
+    Raises:
+        ValueError: If input columns needed for scoring are missing.
+        FileNotFoundError: If the model has not been trained, see `model.load_estimator`.
+    """
+    input_path = input_path or Path(*model_config["data_file"])
+    output_path = output_path or Path(utils.get_model_path(model_config), "pred_score.parquet")
+    assets = load_scoring_assets(model_config)
+
+    columns = scoring_columns(model_config, assets["encoder"])
+    missing = set(columns) - set(utils.read_parquet_schema(input_path).names)
+    if missing:
+        raise ValueError(f"Columns needed for scoring missing from {input_path}; {', '.join(sorted(missing))}")
+
+    def predictions() -> Iterator[pd.DataFrame]:
+        for i, batch in enumerate(utils.iter_parquet_batches(input_path, columns=columns, batch_size=batch_size)):
+            logging.debug(f"Scoring batch {i} of {len(batch)} rows")
+            yield score_batch(batch, assets, model_config)
+
+    logging.info(f"Scoring {input_path} to {output_path}")
+    if output_path.suffix == ".csv":
+        rows = 0
+        for i, results in enumerate(predictions()):
+            results.to_csv(output_path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+            rows += len(results)
+    else:
+        rows = utils.write_parquet_chunks(predictions(), output_path)
+    logging.info(f"Scored {rows} rows")
+    return rows
+
+
+def main() -> None:
+    """Score data from command line using...
+
+    `python -m ndj_pipeline.score -p {path_to_experiment.yaml} -i {path_to_input.parquet}`
+    """
+    parser = argparse.ArgumentParser(description="ndj_pipeline model scoring")
+    parser.add_argument("-p", type=str, help="Path to model experiment yaml, of a trained model")
+    parser.add_argument("-i", type=str, help="Parquet file or dataset to score, by default the config data file")
+    parser.add_argument("-o", type=str, help="Predictions parquet or csv file, by default in the model folder")
+    parser.add_argument("-b", type=int, default=config.default_chunksize, help="Rows scored per batch")
+    parser.add_argument("-v", action="store_true", help="Debug mode")
+
+    args = parser.parse_args()
+
+    model_config = utils.load_model_config(args.p)
+    log_level = logging.DEBUG if args.v else logging.INFO
+    logging.basicConfig(
+        level=log_level,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler()],
+    )
+
+    input_path = Path(args.i) if args.i else None
+    output_path = Path(args.o) if args.o else None
+    run(model_config, input_path, output_path, batch_size=args.b)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+"""Streaming aggregates over batches of rows, in bounded memory.
+
+Used as an optional alternative for fitting missing value replacement, see
+`ndj_pipeline.prep.stream_feature_aggregates`. Aggregation state stays within
+the sketch sizes however many rows are seen, and sketches of separate batches
+can be merged.
+
+* Means are exact, from running sums and counts
+* Medians are approximate, from a KLL style quantile sketch
+* Modes are approximate, from Misra-Gries heavy hitter counts
+
+Both approximations are exact while the number of values (medians) or
+distinct values (modes) stays within the sketch size.
+"""
+import logging
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+class QuantileSketch:
+    """Approximate quantiles of a stream of values in bounded memory.
+
+    Values are held in levels of compactors. When a level is full it is sorted
+    and every other value, from a random offset, is promoted to the next level
+    with double the weight. Rank error is around `1 / size` of the values seen,
+    with memory of a few times `size` values.
+
+    Args:
+        size: Capacity of the highest level compactor; larger is more accurate
+        seed: Random seed for compaction offsets, for reproducible results
+    """
+
+    def __init__(self, size: int = 200, seed: int = 42) -> None:
+        self.size = size
+        self.count = 0
+        self.levels: List[np.ndarray] = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def capacity(self, level: int) -> int:
+        """Compactor capacity, smaller for lower levels holding less weight."""
+        return max(2, int(self.size * (2 / 3) ** (len(self.levels) - level - 1)))
+
+    def update(self, values: np.ndarray) -> None:
+        """Adds non-missing values."""
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compact()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """Adds all values seen by another sketch, with the same accuracy as if seen by this one."""
+        self.count += other.count
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self._compact()
+
+    def _compact(self) -> None:
+        """Compacts each level over capacity into the next."""
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                # An odd value out stays behind, so no weight is lost
+                ordered = np.sort(self.levels[level])
+                remainder = len(ordered) % 2
+                promoted = ordered[remainder:][self._rng.integers(2) :: 2]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                self.levels[level] = ordered[:remainder]
+            level += 1
+
+    def median(self) -> float:
+        """Approximate median, or exact median if no values have been compacted."""
+        if not self.count:
+            return np.nan
+        if len(self.levels) == 1:
+            return float(np.median(self.levels[0]))
+
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0**i) for i, level in enumerate(self.levels)])
+        order = np.argsort(values, kind="stable")
+        cumulative = np.cumsum(weights[order])
+        return float(values[order][np.searchsorted(cumulative, cumulative[-1] / 2)])
+
+
+class HeavyHitters:
+    """Misra-Gries counts of the most frequent values in a stream.
+
+    At most `size` values are counted. When more are seen, the smallest counts
+    are subtracted from all counts and values reaching zero are dropped. Any
+    value occurring more than `n / (size + 1)` times in `n` values is kept, and
+    counts are exact while there are no more than `size` distinct values.
+
+    Args:
+        size: Maximum number of distinct values counted
+    """
+
+    def __init__(self, size: int = 1000) -> None:
+        self.size = size
+        self.counts = pd.Series(dtype=np.int64)
+
+    def update(self, values: np.ndarray) -> None:
+        """Adds non-missing values."""
+        self._add(pd.Series(values[~np.isnan(values)]).value_counts())
+
+    def merge(self, other: "HeavyHitters") -> None:
+        """Adds all values counted by another instance, keeping the same guarantees over both streams."""
+        self._add(other.counts)
+
+    def _add(self, batch: pd.Series) -> None:
+        """Adds counts of values, then drops the smallest counts when over size."""
+        counts = self.counts.add(batch, fill_value=0).astype(np.int64)
+        if len(counts) > self.size:
+            threshold = counts.nlargest(self.size + 1).iloc[-1]
+            counts = counts - threshold
+            counts = counts.loc[counts > 0]
+        self.counts = counts
+
+    def mode(self) -> float:
+        """Most frequent value, the smallest value if tied."""
+        if self.counts.empty:
+            return np.nan
+        top = self.counts.loc[self.counts == self.counts.max()]
+        return float(top.index.min())
+
+
+class StreamingAggregator:
+    """Streaming version of `ndj_pipeline.prep.get_simple_feature_aggregates`.
+
+    Args:
+        simple_features: Dictionary of column name: aggregation, one of mean, median or mode
+        sketch_size: Size of median sketches, see `QuantileSketch`
+        mode_counters: Number of values counted for modes, see `HeavyHitters`
+
+    Raises:
+        ValueError: If an aggregation is not supported.
+    """
+
+    def __init__(self, simple_features: Dict[str, str], sketch_size: int = 200, mode_counters: int = 1000) -> None:
+        unsupported = {how for how in simple_features.values()} - {"mean", "median", "mode"}
+        if unsupported:
+            raise ValueError(f"Unsupported streaming aggregations {', '.join(sorted(unsupported))}")
+        self.simple_features = simple_features
+        self.columns = list(simple_features)
+        self.sums = np.zeros(len(self.columns))
+        self.counts = np.zeros(len(self.columns), dtype=np.int64)
+        self.isinf = np.zeros(len(self.columns), dtype=bool)
+        self.sketches = {col: QuantileSketch(sketch_size) for col, how in simple_features.items() if how == "median"}
+        self.heavy_hitters = {col: HeavyHitters(mode_counters) for col, how in simple_features.items() if how == "mode"}
+        self.rows = 0
+
+    def update(self, df: pd.DataFrame) -> None:
+        """Adds a batch of rows, which must contain every simple feature column."""
+        block = df[self.columns].to_numpy(dtype=np.float64, na_value=np.nan)
+        self.isinf |= np.isinf(block).any(axis=0)
+        self.sums += np.nansum(block, axis=0)
+        self.counts += (~np.isnan(block)).sum(axis=0)
+        for i, col in enumerate(self.columns):
+            if col in self.sketches:
+                self.sketches[col].update(block[:, i])
+            elif col in self.heavy_hitters:
+                self.heavy_hitters[col].update(block[:, i])
+        self.rows += len(df)
+        logging.debug(f"Aggregated {self.rows} rows")
+
+    def problems(self) -> List[str]:
+        """Columns containing infinite values."""
+        return [col for col, inf in zip(self.columns, self.isinf) if inf]
+
+    def result(self) -> pd.Series:
+        """Aggregates of all rows seen, as a Series of column name: value."""
+        means = np.divide(self.sums, self.counts, out=np.full(len(self.columns), np.nan), where=self.counts > 0)
+        values = {}
+        for col, mean in zip(self.columns, means):
+            if col in self.sketches:
+                values[col] = self.sketches[col].median()
+            elif col in self.heavy_hitters:
+                values[col] = self.heavy_hitters[col].mode()
+            else:
+                values[col] = mean
+        return pd.Series(values, name="aggregates", dtype=np.float64)
@@ -24,43 +24,420 @@ Can be run from command line, or as imported functions in other python
 scripts and jupyter notebooks.
 """
 import argparse
+import inspect
+import json
 import logging
 from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
+import yaml
 
-from ndj_pipeline import data_checks
+from ndj_pipeline import cache, config, data_checks, utils
 
+string_operations = {
+    "lower": lambda values: values.str.lower(),
+    "strip": lambda values: values.str.strip(),
+}
+
+
+default_output = {
+    "path": ["data", "processed", "titanic.parquet"],
+    "partition_cols": [],
+    "row_group_size": None,
+    "compression": "snappy",
+}
+
+# Bytes before the watermark which must be unchanged for an incremental update
+watermark_tail_bytes = 4096
+
+
+def load_feature_spec(spec_path: Path) -> Dict[str, Any]:
+    """Loads a declarative feature spec yaml, see `data/titanic_features.yaml`."""
+    logging.debug(f"Loading feature spec from {spec_path}")
+    with open(spec_path, "r") as f:
+        return yaml.safe_load(f)
 
-def create_titanic_features(df: pd.DataFrame) -> None:
-    """Feature engineering, including _filter and split columns.
 
-    Fully custom pandas code for titanic data feature engineering.
+def compile_feature_plan(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """Compiles a feature spec into a plan with shared intermediates and combined regex passes.
+
+    All `contains` patterns on the same source are gathered, so that each source
+    is scanned once for every pattern together. Derived sources are computed
+    once and shared by every rule using them.
+
+    Args:
+        spec: Loaded feature spec
+
+    Returns:
+        Plan dict of output file options, derived sources, patterns per source,
+        and output rules referring to patterns by (source, position).
+    """
+    derived = spec.get("derived") or {}
+    for name, derivation in derived.items():
+        unknown = set(derivation.get("operations", [])) - set(string_operations)
+        if unknown:
+            raise ValueError(f"Unsupported operations for derived source {name}: {', '.join(unknown)}")
+
+    patterns: Dict[str, List[str]] = {}
+
+    def _compile_rule(rule: Dict[str, Any]) -> Dict[str, Any]:
+        if "rows" in rule:
+            return {"rows": rule["rows"]}
+        source_patterns = patterns.setdefault(rule["source"], [])
+        if rule["contains"] not in source_patterns:
+            source_patterns.append(rule["contains"])
+        return {"source": rule["source"], "pattern": source_patterns.index(rule["contains"])}
+
+    fields = {}
+    for name, field in (spec.get("fields") or {}).items():
+        rules = [{**_compile_rule(rule), "value": rule["value"]} for rule in field["rules"]]
+        fields[name] = {"default": field.get("default"), "rules": rules}
+
+    output = {**default_output, **(spec.get("output") or {})}
+
+    return {
+        "output": output,
+        "derived": derived,
+        "patterns": patterns,
+        "filters": {label: _compile_rule(rule) for label, rule in (spec.get("filters") or {}).items()},
+        "fields": fields,
+        "flags": {name: _compile_rule(rule) for name, rule in (spec.get("flags") or {}).items()},
+    }
+
+
+def _match_sources(df: pd.DataFrame, plan: Dict[str, Any]) -> Dict[str, np.ndarray]:
+    """Runs every pattern for each source in one pass over its unique values.
+
+    Derived sources apply their string operations to unique values of the
+    underlying column only, and rows receive results through factorized codes.
+    """
+    factorized: Dict[str, Any] = {}
+    matches = {}
+    for source, patterns in plan["patterns"].items():
+        derivation = plan["derived"].get(source, {"source": source})
+        column = derivation["source"]
+        if column not in factorized:
+            factorized[column] = pd.factorize(df[column])
+        codes, uniques = factorized[column]
+
+        values = pd.Series(uniques, dtype=object)
+        for operation in derivation.get("operations", []):
+            values = string_operations[operation](values)
+
+        unique_matches = utils.match_patterns(values, patterns)
+        matches[source] = utils.match_patterns_by_codes(codes, unique_matches)
+    return matches
+
+
+def _rule_mask(df: pd.DataFrame, rule: Dict[str, Any], matches: Dict[str, np.ndarray]) -> np.ndarray:
+    """Boolean row mask for a compiled rule."""
+    if "rows" in rule:
+        return df.index.isin(rule["rows"])
+    return matches[rule["source"]][:, rule["pattern"]]
+
+
+def apply_feature_plan(df: pd.DataFrame, plan: Dict[str, Any]) -> None:
+    """Adds features from a compiled plan to a DataFrame in place.
+
+    Works on a full DataFrame or a chunk of one, provided the row index
+    continues across chunks. Outputs are computed as arrays and assigned
+    together at the end.
+
+    Args:
+        df: Pre-validated and checked Pandas DataFrame.
+        plan: Compiled feature plan from `compile_feature_plan`
+    """
+    matches = _match_sources(df, plan)
+    outputs: Dict[str, Any] = {}
+
+    # Filter labels; each row's combination of labels is encoded as bits, and
+    # only the distinct combinations are joined into strings
+    labels = list(plan["filters"])
+    combination = np.zeros(len(df), dtype=np.int64)
+    for bit, label in enumerate(labels):
+        combination |= _rule_mask(df, plan["filters"][label], matches).astype(np.int64) << bit
+    unique_combinations, codes = np.unique(combination, return_inverse=True)
+    joined = [", ".join(label for bit, label in enumerate(labels) if code >> bit & 1) for code in unique_combinations]
+    outputs["_filter"] = np.array(joined, dtype=object)[codes]
+
+    # Fields take the value of their last matching rule
+    for name, field in plan["fields"].items():
+        rules = field["rules"][::-1]
+        default = np.nan if field["default"] is None else field["default"]
+        outputs[name] = np.select(
+            [_rule_mask(df, rule, matches) for rule in rules], [rule["value"] for rule in rules], default=default
+        )
+
+    for name, rule in plan["flags"].items():
+        outputs[name] = _rule_mask(df, rule, matches).astype(int)
+
+    df[list(outputs)] = pd.DataFrame(outputs, index=df.index)
+
+
+def add_titanic_features(df: pd.DataFrame, plan: Dict[str, Any]) -> None:
+    """Adds titanic features to a DataFrame in place.
+
+    Declarative features come from the compiled feature spec. Any fully custom
+    pandas code can be added here.
 
     Args:
         df: Pre-validated and checked Pandas DataFrame.
+        plan: Compiled feature plan from `compile_feature_plan`
     """
-    # Example of custom filter
-    df["_filter"] = ""
-    df.loc[0, "_filter"] = "remove_me"
-    df.loc[1, "_filter"] = "remove_me, condition_2"
-
-    # Example of custom split field for men vs women; excludes other titles
-    df["my_split_field"] = np.nan
-    # Single men
-    df.loc[df["name"].str.lower().str.contains("mr."), "my_split_field"] = 1
-    # Vs women, or / and accompanying men
-    df.loc[df["name"].str.lower().str.contains("mrs"), "my_split_field"] = 0
-
-    output_path = Path("data", "processed", "titanic.parquet")
+    apply_feature_plan(df, plan)
+
+
+def create_titanic_features(df: pd.DataFrame, spec_path: Path = Path("data", "titanic_features.yaml")) -> None:
+    """Feature engineering, including _filter and split columns.
+
+    Args:
+        df: Pre-validated and checked Pandas DataFrame.
+        spec_path: Declarative feature spec yaml
+    """
+    plan = compile_feature_plan(load_feature_spec(spec_path))
+    add_titanic_features(df, plan)
+    save_features([df], plan["output"])
+
+
+def save_features(chunks: Iterable[pd.DataFrame], output: Dict[str, Any]) -> int:
+    """Saves feature rich data as parquet, replacing any previous output.
+
+    Args:
+        chunks: Feature rich DataFrames, i.e. a single DataFrame in a list, or a stream of chunks
+        output: Output options from the feature spec; path, partition_cols,
+          row_group_size and compression
+
+    Returns:
+        Number of rows written.
+    """
+    output_path = Path(*output["path"])
     logging.info(f"Saving data to {output_path}")
-    df.to_parquet(output_path)
+    utils.remove_parquet(output_path)
+    return utils.write_parquet_chunks(
+        chunks,
+        output_path,
+        partition_cols=output["partition_cols"],
+        row_group_size=output["row_group_size"],
+        compression=output["compression"],
+    )
+
+
+def iter_titanic_features(chunks: Iterable[pd.DataFrame], plan: Dict[str, Any]) -> Iterator[pd.DataFrame]:
+    """Adds titanic features to each of a stream of checked chunks."""
+    for chunk in chunks:
+        add_titanic_features(chunk, plan)
+        yield chunk
+
+
+def stream_titanic_features(chunksize: int, engine: str = "c", sampling: Optional[Dict[str, Any]] = None) -> None:
+    """Streaming version of check and feature steps, with bounded memory use.
+
+    Raw data is read, checked and feature engineered one chunk at a time,
+    with each chunk written straight to parquet.
+
+    Args:
+        chunksize: Number of raw rows per chunk
+        engine: Csv parser, either "c" or "pyarrow"
+        sampling: Optional sampled validation arguments, see `data_checks.validate_sampled`
+    """
+    failures: List[pd.DataFrame] = []
+    coverage: List[pd.DataFrame] = []
+    chunks = data_checks.iter_checked_chunks(
+        Path("data", "titanic.csv"),
+        Path("schemas", "titanic.yaml"),
+        failures,
+        chunksize,
+        engine,
+        sampling,
+        coverage,
+    )
+
+    plan = compile_feature_plan(load_feature_spec(Path("data", "titanic_features.yaml")))
+    rows = save_features(iter_titanic_features(chunks, plan), plan["output"])
+
+    if coverage:
+        data_checks.log_coverage(data_checks.summarise_coverage(coverage))
+    if failures:
+        utils.remove_parquet(Path(*plan["output"]["path"]))
+    data_checks.raise_for_failures(failures, Path("data", "processed", "titanic_failures.csv"))
+    logging.info(f"Saved {rows} rows")
+
+
+def titanic_fingerprint(schema_path: Path, spec_path: Path) -> str:
+    """Hash of everything that determines processed rows, other than the raw data itself."""
+    return cache.hash_object(
+        {
+            "schema": cache.hash_file(schema_path),
+            "features": cache.hash_file(spec_path),
+            "checks": cache.hash_object(inspect.getsource(data_checks)),
+            "transform": cache.hash_object(inspect.getsource(inspect.getmodule(titanic_fingerprint))),  # type: ignore
+        }
+    )
+
+
+def load_watermark(output_path: Path, input_path: Path, fingerprint: str) -> Optional[Dict[str, Any]]:
+    """Loads the watermark of a previous incremental run, if processed data can be appended to.
+
+    Args:
+        output_path: Processed dataset directory
+        input_path: Raw csv
+        fingerprint: Current `titanic_fingerprint`
+
+    Returns:
+        Watermark dictionary, or None if a full rebuild is needed.
+    """
+    watermark_path = Path(output_path, "_watermark.json")
+    if not watermark_path.exists() or not Path(output_path, "_duplicates.npz").exists():
+        logging.info("No previous incremental run found")
+        return None
+    with open(watermark_path, "r") as f:
+        watermark = json.load(f)
+
+    if watermark["fingerprint"] != fingerprint:
+        logging.info("Schema, feature spec or code changed since previous run")
+        return None
+    if watermark["source"] != str(input_path) or input_path.stat().st_size < watermark["byte_offset"]:
+        logging.info(f"{input_path} is not an extension of the previously processed file")
+        return None
+    tail_start = max(0, watermark["byte_offset"] - watermark_tail_bytes)
+    if cache.hash_file_range(input_path, tail_start, watermark["byte_offset"]) != watermark["tail_hash"]:
+        logging.info(f"Previously processed rows of {input_path} were modified")
+        return None
+    return watermark
+
+
+def update_titanic_features(
+    chunksize: int = config.default_chunksize,
+    engine: str = "c",
+    sampling: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Incremental version of `stream_titanic_features`, for append only raw data.
+
+    A watermark saved alongside the processed dataset records how far into the
+    raw file previous runs have read. Only rows appended since then are checked,
+    feature engineered and written, as new files in the dataset directory.
+    Duplicate checks include previously processed rows, using saved key hashes.
+
+    Everything is rebuilt if the schema, feature spec or check and transform
+    code change, or if previously processed raw rows appear modified. A final
+    raw line without a newline is treated as still being written, and is left
+    for the next run.
+
+    Args:
+        chunksize: Number of raw rows per chunk
+        engine: Csv parser, either "c" or "pyarrow"
+        sampling: Optional sampled validation arguments, see `data_checks.validate_sampled`
+    """
+    input_path = Path("data", "titanic.csv")
+    schema_path = Path("schemas", "titanic.yaml")
+    spec_path = Path("data", "titanic_features.yaml")
+
+    plan = compile_feature_plan(load_feature_spec(spec_path))
+    output = plan["output"]
+    output_path = Path(*output["path"])
+    fingerprint = titanic_fingerprint(schema_path, spec_path)
+
+    trackers = data_checks.create_duplicate_trackers(data_checks.load_schema(schema_path))
+    end = data_checks.complete_lines_end(input_path)
+    watermark = load_watermark(output_path, input_path, fingerprint) if output_path.is_dir() else None
+    if watermark is None:
+        logging.info(f"Rebuilding {output_path} from all rows of {input_path}")
+        utils.remove_parquet(output_path)
+        watermark = {"source": str(input_path), "fingerprint": fingerprint, "byte_offset": 0, "rows": 0, "runs": 0}
+        schema = None
+    else:
+        with np.load(Path(output_path, "_duplicates.npz")) as seen:
+            for i, tracker in enumerate(trackers):
+                tracker.add_seen(seen[f"arr_{i}"])
+        schema = pq.read_schema(Path(output_path, "_common_metadata"))
+
+    if end <= watermark["byte_offset"]:
+        logging.info(f"No new rows in {input_path} since previous run")
+        return
+
+    run_id = watermark["runs"]
+    failures: List[pd.DataFrame] = []
+    coverage: List[pd.DataFrame] = []
+    chunks = data_checks.iter_checked_chunks(
+        input_path,
+        schema_path,
+        failures,
+        chunksize,
+        engine,
+        sampling,
+        coverage,
+        start=watermark["byte_offset"],
+        end=end,
+        row_offset=watermark["rows"],
+        trackers=trackers,
+    )
+    logging.info(f"Appending rows from byte {watermark['byte_offset']} of {input_path} to {output_path}")
+    rows = utils.write_parquet_chunks(
+        iter_titanic_features(chunks, plan),
+        output_path,
+        partition_cols=output["partition_cols"],
+        row_group_size=output["row_group_size"],
+        compression=output["compression"],
+        basename_template=f"part-{run_id}-{{i}}.parquet",
+        dataset=True,
+        schema=schema,
+    )
+
+    if coverage:
+        data_checks.log_coverage(data_checks.summarise_coverage(coverage))
+    if failures:
+        # Watermark is not moved, so the same rows are re-checked next run
+        for path in output_path.rglob(f"part-{run_id}-*.parquet"):
+            path.unlink()
+    data_checks.raise_for_failures(failures, Path("data", "processed", "titanic_failures.csv"))
+
+    np.savez(Path(output_path, "_duplicates.npz"), *[tracker.seen() for tracker in trackers])
+    tail_start = max(0, end - watermark_tail_bytes)
+    watermark.update(
+        {
+            "byte_offset": end,
+            "rows": watermark["rows"] + rows,
+            "runs": run_id + 1,
+            "tail_hash": cache.hash_file_range(input_path, tail_start, end),
+        }
+    )
+    with open(Path(output_path, "_watermark.json"), "w") as f:
+        json.dump(watermark, f, indent=2)
+    logging.info(f"Appended {rows} rows, {watermark['rows']} rows in total")
+
+
+def run(
+    chunksize: Optional[int] = None,
+    use_cache: bool = True,
+    engine: str = "c",
+    sampling: Optional[Dict[str, Any]] = None,
+    incremental: bool = False,
+) -> None:
+    """Perform all data transformation steps.
+
+    Args:
+        chunksize: Optionally stream raw data in chunks of this many rows,
+          rather than loading it all into memory.
+        use_cache: Reuse previously validated data if raw file and schema are unchanged.
+        engine: Csv parser, either "c" or "pyarrow"
+        sampling: Optional sampled validation arguments, see `data_checks.validate_sampled`
+        incremental: Only process raw rows appended since the previous incremental run
+    """
+    if incremental:
+        update_titanic_features(chunksize or config.default_chunksize, engine, sampling)
+        return
 
+    if chunksize:
+        stream_titanic_features(chunksize, engine, sampling)
+        return
 
-def run() -> None:
-    """Perform all data transformation steps."""
-    df = data_checks.check_titanic()
+    if use_cache:
+        df = data_checks.check_titanic_cached(engine=engine, sampling=sampling)
+    else:
+        df = data_checks.check_titanic(engine=engine, sampling=sampling)
     create_titanic_features(df)
 
 
@@ -70,6 +447,12 @@ def main() -> None:
     `python -m ndj_pipeline.transform`
     """
     parser = argparse.ArgumentParser(description="ndj_pipeline transformations")
+    parser.add_argument("-c", type=int, help="Stream raw data in chunks of this many rows")
+    parser.add_argument("-e", default="c", choices=["c", "pyarrow"], help="Csv parser engine")
+    parser.add_argument("-s", type=float, help="Only value check a sample; fraction if 1 or less, else rows per chunk")
+    parser.add_argument("--stratify", nargs="+", help="Columns to stratify the value check sample by")
+    parser.add_argument("--no-cache", action="store_true", help="Re-validate raw data even if unchanged")
+    parser.add_argument("-i", action="store_true", help="Only process raw rows appended since the previous -i run")
     parser.add_argument("-v", action="store_true", help="Debug mode")
 
     args = parser.parse_args()
@@ -93,7 +476,8 @@ def main() -> None:
         )
         logging.warning(msg)
 
-    run()
+    sampling = {"sample": args.s, "stratify": args.stratify} if args.s else None
+    run(chunksize=args.c, use_cache=not args.no_cache, engine=args.e, sampling=sampling, incremental=args.i)
 
 
 if __name__ == "__main__":
@@ -21,16 +21,29 @@
 
 """Mix of utilities."""
 import argparse
+import itertools
 import json
 import logging
+import re
+import shutil
 from pathlib import Path
-from typing import Any, Callable, Dict, List
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import yaml
 
 from ndj_pipeline import config, model, post
 
+# Global inline flags, i.e. `(?i)`, which are only valid at the start of an expression
+global_flags = re.compile(r"\(\?([aiLmsux]+)\)")
+
+# Numbered backreferences, i.e. `\1`, which refer to other groups once patterns are combined
+numbered_backreference = re.compile(r"\\[1-9]")
+
 
 def clean_column_names(column_list: List[str]) -> Dict[str, str]:
     """Simple string cleaning rules for columns.
@@ -58,6 +71,68 @@ def clean_column_names(column_list: List[str]) -> Dict[str, str]:
     return dict(zip(column_list, new_column_list))
 
 
+def scope_inline_flags(pattern: str) -> str:
+    """Rewrites leading global inline flags, i.e. `(?i)abc`, as flags scoped to the pattern, `(?i:abc)`.
+
+    Global flags must start a whole expression, so are scoped before a pattern
+    is embedded in a larger one.
+    """
+    flags = ""
+    match = global_flags.match(pattern)
+    while match:
+        flags += match.group(1)
+        pattern = pattern[match.end() :]
+        match = global_flags.match(pattern)
+    return f"(?{flags}:{pattern})" if flags else pattern
+
+
+def combine_patterns(patterns: List[str]) -> str:
+    """Combines regex patterns into one, recording whether each is found anywhere in a string.
+
+    Each pattern sits in an optional lookahead from the start of the string, so a
+    single match call reports every pattern found, even where matches overlap.
+    Patterns are captured in named groups `_p{i}`, so must not use numbered backreferences.
+    Leading global inline flags apply to their own pattern only, see `scope_inline_flags`.
+    """
+    return "^" + "".join(
+        rf"(?=(?:[\s\S]*?(?P<_p{i}>{scope_inline_flags(pattern)}))?)" for i, pattern in enumerate(patterns)
+    )
+
+
+def match_patterns(values: pd.Series, patterns: List[str]) -> np.ndarray:
+    """Searches string values for many regex patterns in a single combined pass.
+
+    Equivalent to `values.str.contains(pattern)` for each pattern, with missing
+    values treated as not matching. Patterns which cannot be combined, i.e.
+    using numbered backreferences, are searched one at a time instead.
+
+    Args:
+        values: Series of strings, ideally unique values
+        patterns: Regex patterns
+
+    Returns:
+        Boolean array of shape (len(values), len(patterns)).
+    """
+    if not patterns or values.empty:
+        return np.zeros((len(values), len(patterns)), dtype=bool)
+    values = values.astype(object)
+    try:
+        if any(numbered_backreference.search(pattern) for pattern in patterns):
+            raise re.error("numbered backreference")
+        combined = re.compile(combine_patterns(patterns))
+    except re.error as e:
+        logging.debug(f"Searching patterns separately, as they cannot be combined; {e}")
+        return np.column_stack([values.str.contains(pattern, na=False).astype(bool) for pattern in patterns])
+    extracted = values.str.extract(combined)
+    return extracted[[f"_p{i}" for i in range(len(patterns))]].notna().to_numpy()
+
+
+def match_patterns_by_codes(codes: np.ndarray, unique_matches: np.ndarray) -> np.ndarray:
+    """Broadcasts matches of unique values to rows using factorized codes, where -1 is missing."""
+    no_match = np.zeros((1, unique_matches.shape[1]), dtype=bool)
+    return np.vstack([unique_matches, no_match])[codes]
+
+
 def get_model(function: str) -> Callable:
     """Simple redirection to get named function from model.py."""
     return getattr(model, function)
@@ -96,6 +171,197 @@ def create_model_folder(model_config: Dict[str, Any]) -> None:
             json.dump(model_config, f, indent=4)
 
 
+def write_parquet_chunks(
+    chunks: Iterable[pd.DataFrame],
+    output_path: Path,
+    partition_cols: Optional[List[str]] = None,
+    row_group_size: Optional[int] = None,
+    compression: str = "snappy",
+    basename_template: str = "part-{i}.parquet",
+    dataset: bool = False,
+    schema: Optional[pa.Schema] = None,
+) -> int:
+    """Writes a stream of DataFrame chunks to parquet.
+
+    Only one chunk is held in memory at a time. All chunks are written with the
+    arrow schema of the first chunk, so that columns which happen to be entirely
+    missing in a later chunk keep their type. Column statistics are always
+    written, so readers can skip row groups using filters.
+
+    Without partition columns, a single parquet file is written and the row index
+    is not kept. With partition columns, a hive partitioned dataset directory is
+    written instead, i.e. `{output_path}/{col}={value}/part-0.parquet`. The row
+    index is kept to restore row order on read, and a `_common_metadata` file
+    records the full schema so partition columns keep their types, see
+    `read_parquet_dataset`.
+
+    Unpartitioned data can also be written as a dataset directory, so that later
+    chunks can be appended as new files using a different `basename_template`.
+
+    Args:
+        chunks: DataFrames with identical columns
+        output_path: Parquet file, or dataset directory if partitioned
+        partition_cols: Optional columns to partition the dataset by
+        row_group_size: Maximum rows per row group, smaller groups allow finer skipping
+        compression: Parquet compression codec, i.e. snappy, zstd, gzip, none
+        basename_template: Dataset file naming, must contain `{i}`
+        dataset: Write a dataset directory even without partition columns
+        schema: Optional arrow schema for dataset files, i.e. of existing files being appended to
+
+    Returns:
+        Number of rows written.
+    """
+    if partition_cols or dataset:
+        return _write_partitioned(
+            chunks, output_path, partition_cols or [], row_group_size, compression, basename_template, schema
+        )
+
+    writer: Optional[pq.ParquetWriter] = None
+    rows = 0
+    try:
+        for chunk in chunks:
+            if writer is None:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                writer = pq.ParquetWriter(output_path, table.schema, compression=compression, write_statistics=True)
+            else:
+                table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+            writer.write_table(table, row_group_size=row_group_size)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def _write_partitioned(
+    chunks: Iterable[pd.DataFrame],
+    output_path: Path,
+    partition_cols: List[str],
+    row_group_size: Optional[int],
+    compression: str,
+    basename_template: str,
+    schema: Optional[pa.Schema] = None,
+) -> int:
+    """Writes chunks to a hive partitioned parquet dataset directory, see `write_parquet_chunks`."""
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        return 0
+    if schema is None:
+        schema = pa.Table.from_pandas(first, preserve_index=True).schema
+    rows = 0
+
+    def _batches() -> Iterator[pa.RecordBatch]:
+        nonlocal rows
+        for chunk in itertools.chain([first], chunks):
+            rows += len(chunk)
+            yield from pa.Table.from_pandas(chunk, schema=schema, preserve_index=True).to_batches()
+
+    partitioning = None
+    if partition_cols:
+        partitioning = ds.partitioning(pa.schema([schema.field(col) for col in partition_cols]), flavor="hive")
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    file_format = ds.ParquetFileFormat()
+    ds.write_dataset(
+        _batches(),
+        output_path,
+        schema=schema,
+        format=file_format,
+        file_options=file_format.make_write_options(compression=compression, write_statistics=True),
+        partitioning=partitioning,
+        basename_template=basename_template,
+        max_rows_per_group=row_group_size,
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    pq.write_metadata(schema, Path(output_path, "_common_metadata"))
+    return rows
+
+
+def read_parquet_dataset(
+    input_path: Path, columns: Optional[List[str]] = None, filters: Optional[ds.Expression] = None
+) -> pd.DataFrame:
+    """Reads a parquet file, or a dataset directory written by `write_parquet_chunks`.
+
+    Partition columns are parsed back to their original types, and row order is
+    restored from the stored row index.
+
+    Args:
+        input_path: Parquet file or dataset directory
+        columns: Optional subset of columns to read
+        filters: Optional arrow dataset expression, used to skip partitions and row groups
+
+    Returns:
+        Pandas DataFrame.
+    """
+    common_metadata = Path(input_path, "_common_metadata")
+    if not common_metadata.exists():
+        dataset = ds.dataset(input_path, format="parquet")
+        return dataset.to_table(columns=columns, filter=filters).to_pandas()
+
+    schema = pq.read_schema(common_metadata)
+    partition_fields = [schema.field(name) for name in schema.names if name in _partition_names(input_path)]
+    dataset = ds.dataset(
+        input_path,
+        schema=schema,
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema(partition_fields), flavor="hive") if partition_fields else None,
+    )
+
+    index_columns = [col for col in schema.pandas_metadata["index_columns"] if isinstance(col, str)]
+    if columns is not None:
+        columns = [col for col in schema.names if col in set(columns) | set(index_columns)]
+    df = dataset.to_table(columns=columns, filter=filters).to_pandas()
+    return df.sort_index() if index_columns else df
+
+
+def iter_parquet_batches(
+    input_path: Path,
+    columns: Optional[List[str]] = None,
+    filters: Optional[ds.Expression] = None,
+    batch_size: int = config.default_chunksize,
+) -> Iterator[pd.DataFrame]:
+    """Reads a parquet file or dataset directory as a stream of DataFrames, holding one batch at a time.
+
+    Unlike `read_parquet_dataset`, row order and the stored row index are not restored.
+
+    Args:
+        input_path: Parquet file or dataset directory
+        columns: Optional subset of columns to read
+        filters: Optional arrow dataset expression, used to skip partitions and row groups
+        batch_size: Maximum rows per batch
+
+    Yields:
+        Pandas DataFrame batches.
+    """
+    dataset = ds.dataset(input_path, schema=read_parquet_schema(input_path), format="parquet", partitioning="hive")
+    for batch in dataset.to_batches(columns=columns, filter=filters, batch_size=batch_size):
+        yield batch.to_pandas()
+
+
+def read_parquet_schema(input_path: Path) -> pa.Schema:
+    """Arrow schema of a parquet file, or of a dataset directory written by `write_parquet_chunks`."""
+    common_metadata = Path(input_path, "_common_metadata")
+    if common_metadata.exists():
+        return pq.read_schema(common_metadata)
+    return ds.dataset(input_path, format="parquet").schema
+
+
+def remove_parquet(path: Path) -> None:
+    """Removes a parquet file or dataset directory, if it exists."""
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def _partition_names(input_path: Path) -> List[str]:
+    """Hive partition column names from the first data file path in a dataset directory."""
+    for path in sorted(Path(input_path).rglob("*.parquet")):
+        return [part.split("=")[0] for part in path.relative_to(input_path).parts[:-1]]
+    return []
+
+
 def create_tables_html() -> None:
     """Scan schemas directory to create HTML page for data documentation."""
     schema_paths = Path("schemas").glob("*.yaml")
@@ -119,7 +385,7 @@ def create_tables_html() -> None:
     html = "\n<p>\n".join(html_list)
 
     with open(output_path, "w") as f:
-        f.write(html)
+        f.write(html + "\n")
 
 
 def parse_schema_to_table(schema: Dict[str, Any]) -> str:
@@ -19,3 +19,38 @@
 # DEALINGS IN THE SOFTWARE.
 
 """Shared tests."""
+from pathlib import Path
+from typing import Any, Dict
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ndj_pipeline import config, utils
+
+
+@pytest.fixture
+def model_config(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Dict[str, Any]:
+    """Example experiment config, on a small random titanic-like dataset in a temporary model folder."""
+    rng = np.random.default_rng(0)
+    rows = 300
+    df = pd.DataFrame(
+        {
+            "passengerid": np.arange(rows),
+            "fare": rng.gamma(2.0, 15.0, rows),
+            "sex": rng.integers(0, 2, rows),
+            "age": np.where(rng.random(rows) < 0.2, np.nan, rng.uniform(1, 80, rows)),
+            "sibsp": rng.integers(0, 4, rows),
+            "parch": rng.integers(0, 3, rows),
+            "pclass": rng.choice(["1", "2", "3"], rows),
+            "embarked": rng.choice(["c", "q", "s", None], rows),
+            "survived": rng.choice(["0", "1"], rows),
+            "_filter": rng.choice(["", "remove_me"], rows, p=[0.9, 0.1]),
+        }
+    )
+    df.to_parquet(Path(tmp_path, "titanic.parquet"))
+
+    monkeypatch.setattr(config, "default_model_folder", tmp_path)
+    model_config = utils.load_model_config(str(Path(Path(__file__).parents[1], "data", "example_experiment.yaml")))
+    model_config["data_file"] = [str(tmp_path), "titanic.parquet"]
+    return model_config
@@ -0,0 +1,78 @@
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+"""Tests for batch.py."""
+import json
+from pathlib import Path
+from typing import Any, Dict
+
+import pandas as pd
+
+from ndj_pipeline import batch, model, prep, utils
+
+
+def test_run_matches_sequential(model_config: Dict[str, Any], tmp_path: Path) -> None:
+    """Experiments run in parallel on shared prepared data give the same results as running each alone."""
+    model_configs = [
+        {**model_config, "run_name": "a", "model_params": {"n_estimators": 20, "random_state": 42}},
+        {**model_config, "run_name": "b", "model_params": {"n_estimators": 30, "random_state": 42}},
+        {**model_config, "run_name": "c", "split": {"method": "hash", "test_size": 0.2}},
+    ]
+    config_paths = []
+    for experiment in model_configs:
+        config_path = Path(tmp_path, f"{experiment['run_name']}.json")
+        with open(config_path, "w") as f:
+            json.dump(experiment, f)
+        config_paths.append(config_path)
+
+    cache_folder = Path(tmp_path, "cache")
+    summary = batch.run(config_paths, processes=2, output_path=Path(tmp_path, "summary.csv"), cache_folder=cache_folder)
+    assert summary["status"].tolist() == ["success"] * 3
+    assert len(list(cache_folder.glob("prep_*/prepared.json"))) == 2
+
+    results = {}
+    for experiment in model_configs:
+        model_path = utils.get_model_path(experiment)
+        assert Path(model_path, "filter_counts.csv").exists()
+        results[experiment["run_name"]] = pd.read_csv(Path(model_path, "pred_test.csv"), index_col=0)
+
+    for experiment in model_configs:
+        model.run_model_training(experiment, use_cache=False)
+        expected = pd.read_csv(Path(utils.get_model_path(experiment), "pred_test.csv"), index_col=0)
+        pd.testing.assert_frame_equal(results[experiment["run_name"]], expected)
+
+
+def test_run_resumes_from_prepared(model_config: Dict[str, Any], tmp_path: Path) -> None:
+    """Experiments resume after the stages they loaded prepared data for, and re-run them when it changes."""
+    config_path = Path(tmp_path, "a.json")
+    with open(config_path, "w") as f:
+        json.dump(model_config, f)
+    cache_folder = Path(tmp_path, "cache")
+    batch.run([config_path], output_path=Path(tmp_path, "summary.csv"), cache_folder=cache_folder)
+    model_path = utils.get_model_path(model_config)
+    fitted = Path(model_path, "model.joblib").stat().st_mtime_ns
+
+    model.run_model_training(model_config)
+    assert Path(model_path, "model.joblib").stat().st_mtime_ns == fitted
+
+    hashed = {**model_config, "split": {"method": "hash", "test_size": 0.2}}
+    model.run_model_training(hashed)
+    data = prep.apply_filtering(prep.load_data_and_key(hashed), hashed)
+    test = pd.read_csv(Path(model_path, "pred_test.csv"), index_col=0)
+    assert sorted(test.index) == sorted(prep.split(data, hashed)[1].index)
@@ -0,0 +1,96 @@
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Tests for cache.py."""
+import os
+from pathlib import Path
+from typing import List
+
+import pandas as pd
+
+from ndj_pipeline import cache
+
+
+def test_load_or_create(tmp_path: Path) -> None:
+    """Cached frames are reused until the key or input contents change, not when inputs are only touched."""
+    input_path = Path(tmp_path, "raw.csv")
+    input_path.write_text("x\n1\n2\n")
+    cache_folder = Path(tmp_path, "cache")
+    calls: List[int] = []
+
+    def create() -> pd.DataFrame:
+        calls.append(1)
+        return pd.read_csv(input_path)
+
+    def load(key: int) -> pd.DataFrame:
+        return cache.load_or_create("raw", [input_path], {"key": key}, create, cache_folder)
+
+    expected = load(1)
+    pd.testing.assert_frame_equal(load(1), expected)
+    assert len(calls) == 1
+
+    stat = input_path.stat()
+    os.utime(input_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    pd.testing.assert_frame_equal(load(1), expected)
+    assert len(calls) == 1
+
+    load(2)
+    assert len(calls) == 2
+    input_path.write_text("x\n1\n3\n")
+    assert load(2)["x"].tolist() == [1, 3]
+    assert len(calls) == 3
+
+
+def test_stage_invalidation(tmp_path: Path) -> None:
+    """Cached stages are used only with the same key, and with their saved values and outputs present."""
+    cache_folder = Path(tmp_path, "_cache")
+    output = Path(tmp_path, "output.csv")
+    output.write_text("x\n")
+    state = {"data": pd.DataFrame({"x": [1, 2]}), "features": ["x"]}
+    cache.save_stage("load", {"k": 1}, "hash", state, cache_folder, ["data", "features"], [str(output)])
+
+    assert cache.load_stage("load", "hash", cache_folder)["outputs"] == [str(output)]
+    assert cache.load_stage("load", "changed", cache_folder) is None
+    assert cache.load_stage("other", "hash", cache_folder) is None
+
+    output.unlink()
+    assert cache.load_stage("load", "hash", cache_folder) is None
+    output.write_text("x\n")
+    Path(cache_folder, "load_features.pkl").unlink()
+    assert cache.load_stage("load", "hash", cache_folder) is None
+
+
+def test_stage_state(tmp_path: Path) -> None:
+    """State is rebuilt from the latest stage which saved each value, and re-saving replaces old values."""
+    cache_folder = Path(tmp_path, "_cache")
+    first = {"data": pd.DataFrame({"x": [1, 2]}), "features": ["x"]}
+    second = {**first, "data": first["data"].head(1)}
+    cache.save_stage("load", {}, "a", first, cache_folder, ["data", "features"])
+    cache.save_stage("filter", {}, "b", second, cache_folder, ["data"])
+
+    manifests = [cache.load_stage("load", "a", cache_folder), cache.load_stage("filter", "b", cache_folder)]
+    state = cache.load_stage_state(manifests, cache_folder)
+    pd.testing.assert_frame_equal(state["data"], second["data"])
+    assert state["features"] == ["x"]
+    assert cache.load_stage_state(manifests[1:], cache_folder) is None
+
+    cache.save_stage("filter", {}, "c", {"features": ["x"]}, cache_folder)
+    assert not Path(cache_folder, "filter_data.pkl").exists()
+    assert cache.load_stage("filter", "c", cache_folder)["saved"] == []
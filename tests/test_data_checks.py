@@ -0,0 +1,147 @@
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Tests for data_checks.py."""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ndj_pipeline import data_checks
+
+repo = Path(__file__).parents[1]
+input_path = Path(repo, "data", "titanic.csv")
+schema_path = Path(repo, "schemas", "titanic.yaml")
+
+
+@pytest.mark.parametrize("engine", ["c", "pyarrow"])
+def test_iter_typed_csv(engine: str) -> None:
+    """Streamed chunks have the requested size, and together match reading the whole file."""
+    chunks = list(data_checks.iter_typed_csv(input_path, schema_path, chunksize=100, engine=engine))
+    assert [len(chunk) for chunk in chunks] == [100] * 8 + [91]
+    pd.testing.assert_frame_equal(pd.concat(chunks), data_checks.read_typed_csv(input_path, schema_path))
+
+
+def test_read_typed_csv_engines() -> None:
+    """Both csv engines read the same values with the same schema dtypes."""
+    df = data_checks.read_typed_csv(input_path, schema_path)
+    pd.testing.assert_frame_equal(data_checks.read_typed_csv(input_path, schema_path, engine="pyarrow"), df)
+    assert df["passengerid"].dtype == "int64"
+    assert df["age"].dtype == "float64"
+
+
+def test_run_checks(tmp_path: Path) -> None:
+    """Sources are checked in parallel, with failures reported in the summary rather than raised."""
+    good = Path(tmp_path, "good.csv")
+    good.write_bytes(input_path.read_bytes())
+    bad = Path(tmp_path, "bad.csv")
+    bad.write_text(input_path.read_text().replace(",male,", ",unknown,", 1))
+    sources = {
+        name: {"input": path, "schema": schema_path, "output": Path(tmp_path, f"{name}.parquet")}
+        for name, path in {"good": good, "bad": bad}.items()
+    }
+
+    summary = data_checks.run_checks(sources, processes=2, chunksize=200)
+    assert summary["source"].tolist() == ["bad", "good"]
+    assert summary["status"].tolist() == ["failed", "passed"]
+    assert summary.loc[1, "rows"] == 891
+    expected = data_checks.read_typed_csv(input_path, schema_path)
+    pd.testing.assert_frame_equal(pd.read_parquet(sources["good"]["output"]), expected)
+
+
+def test_validate_sampled_failures() -> None:
+    """Failures in sampled rows are counted against the check which found them."""
+    schema = data_checks.without_unique_checks(data_checks.load_schema(schema_path))
+    df = data_checks.read_typed_csv(input_path, schema_path)
+    df.loc[:5, "embarked"] = "X"
+    df.loc[:3, "pclass"] = 9
+    df.loc[:2, "sex"] = pd.NA
+
+    reports = []
+    for chunk in [df.iloc[:400], df.iloc[400:]]:
+        _, failure_cases, report = data_checks.validate_sampled(chunk, schema, sample=1.0)
+        reports.append(report)
+    summary = data_checks.summarise_coverage(reports).set_index(["column", "check"])
+
+    embarked = next(check["check"] for check in data_checks.list_value_checks(schema) if check["column"] == "embarked")
+    failures = summary.loc[summary["failures"] > 0, "failures"]
+    assert failures.to_dict() == {
+        ("pclass", "isin({1, 2, 3})"): 4,
+        ("sex", "not_nullable"): 3,
+        ("embarked", embarked): 6,
+    }
+    assert (summary["rows_checked"] == len(df)).all()
+    assert (summary["coverage"] == 1).all()
+
+
+def test_duplicate_tracker_chunks() -> None:
+    """Duplicates are found within and across chunks, matching `DataFrame.duplicated`."""
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"a": rng.integers(0, 20, 1_000), "b": rng.choice(["x", "y"], 1_000)})
+    tracker = data_checks.DuplicateTracker()
+    duplicated = np.concatenate([tracker.update(df.iloc[i : i + 99]) for i in range(0, len(df), 99)])
+    np.testing.assert_array_equal(duplicated, df.duplicated().to_numpy())
+    assert tracker.duplicates == df.duplicated().sum()
+    assert len(tracker.seen()) == len(df.drop_duplicates())
+
+
+def test_duplicate_tracker_key_sample() -> None:
+    """Key columns are checked for uniqueness, reporting a sample of offending keys with their row index."""
+    df = pd.DataFrame({"key": [1, 2, 3, 2, 1, 2], "value": range(6)}, index=list("abcdef"))
+    tracker = data_checks.DuplicateTracker(["key"], sample_size=2)
+    np.testing.assert_array_equal(tracker.update(df), [False, False, False, True, True, True])
+    assert tracker.report() == {
+        "key": "key",
+        "duplicates": 3,
+        "sample": [{"index": "d", "key": 2}, {"index": "e", "key": 1}],
+    }
+
+
+def test_duplicate_tracker_restore() -> None:
+    """Saved hashes of seen keys detect duplicates in later runs."""
+    tracker = data_checks.DuplicateTracker(["key"])
+    tracker.update(pd.DataFrame({"key": [1, 2, 3]}))
+    restored = data_checks.DuplicateTracker(["key"])
+    restored.add_seen(tracker.seen())
+    np.testing.assert_array_equal(restored.update(pd.DataFrame({"key": [3, 4, 4]})), [True, False, True])
+
+
+def test_complete_lines_end(tmp_path: Path) -> None:
+    """A final line without a newline is excluded, as it may still be being written."""
+    path = Path(tmp_path, "raw.csv")
+    path.write_bytes(b"a,b\n1,2\n3,")
+    assert data_checks.complete_lines_end(path, block_size=2) == 8
+    path.write_bytes(b"a,b\n1,2\n")
+    assert data_checks.complete_lines_end(path) == 8
+    path.write_bytes(b"a,b")
+    assert data_checks.complete_lines_end(path) == 0
+
+
+@pytest.mark.parametrize("engine", ["c", "pyarrow"])
+def test_iter_typed_csv_byte_range(engine: str) -> None:
+    """Reading consecutive byte ranges matches reading the whole file, with a continuing row index."""
+    end = len(b"".join(input_path.read_bytes().splitlines(keepends=True)[:400]))
+    first = data_checks.iter_typed_csv(input_path, schema_path, chunksize=150, engine=engine, end=end)
+    second = data_checks.iter_typed_csv(
+        input_path, schema_path, chunksize=150, engine=engine, start=end, row_offset=399
+    )
+    df = data_checks.read_typed_csv(input_path, schema_path)
+    pd.testing.assert_frame_equal(pd.concat(list(first) + list(second)), df)
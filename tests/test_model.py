@@ -0,0 +1,133 @@
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Tests for model.py."""
+import json
+from pathlib import Path
+from typing import Any, Dict
+
+import pandas as pd
+import pytest
+
+from ndj_pipeline import model, utils
+
+
+def test_check_native_categories() -> None:
+    """Native feature models reject categorical columns with more categories than max_bins."""
+    model_config = {"model_function_name": "hgbr", "model_params": {"max_bins": 100}}
+    model.check_native_categories(model_config, {"ticket": 100})
+    with pytest.raises(ValueError, match="ticket"):
+        model.check_native_categories(model_config, {"ticket": 101, "cabin": 3})
+    with pytest.raises(ValueError, match="255"):
+        model.check_native_categories({"model_function_name": "hgbr"}, {"ticket": 300})
+    model.check_native_categories({"model_function_name": "gbr"}, {"ticket": 300})
+
+
+def test_missing_estimator_refits(model_config: Dict[str, Any]) -> None:
+    """Deleting the fitted model re-runs the fit stage rather than failing when loading it."""
+    model.run_model_training(model_config)
+    model_path = Path(utils.get_model_path(model_config), "model.joblib")
+    model_path.unlink()
+    with pytest.raises(FileNotFoundError, match="model training"):
+        model.load_estimator(model_config)
+
+    model.run_model_training(model_config)
+    assert model_path.exists()
+    assert model.load_estimator(model_config).n_estimators == 50
+
+
+def test_training_resumes(model_config: Dict[str, Any]) -> None:
+    """Re-runs skip unchanged stages, and re-run stages whose written files are missing."""
+    model.run_model_training(model_config)
+    model_path = utils.get_model_path(model_config)
+    fitted = Path(model_path, "model.joblib").stat().st_mtime_ns
+
+    model.run_model_training(model_config)
+    assert Path(model_path, "model.joblib").stat().st_mtime_ns == fitted
+
+    Path(model_path, "pred_test.csv").unlink()
+    model.run_model_training(model_config)
+    assert Path(model_path, "pred_test.csv").exists()
+    assert Path(model_path, "model.joblib").stat().st_mtime_ns != fitted
+
+
+def test_run_cross_validation(model_config: Dict[str, Any]) -> None:
+    """Cross validation saves metrics per fold, and one out of fold prediction per training row."""
+    model.run_model_training({**model_config, "cv": {"folds": 3, "processes": 2}})
+    model_path = utils.get_model_path(model_config)
+    with open(Path(model_path, "metrics_cv.json")) as f:
+        metrics = json.load(f)
+    assert len(metrics["folds"]) == 3
+    assert set(metrics) == {"folds", "mean", "std", "out_of_fold"}
+
+    train = pd.read_parquet(Path(model_path, "prep_train.parquet"))
+    oof = pd.read_csv(Path(model_path, "pred_oof.csv"), index_col=0)
+    assert oof.index.is_unique
+    assert sorted(oof.index) == sorted(train.index)
+    assert oof["Predicted"].notna().all()
+    assert sorted(oof["fold"].unique()) == [0, 1, 2]
+    assert oof["fold"].value_counts().max() - oof["fold"].value_counts().min() <= 1
+
+    model.run_model_training({**model_config, "cv": {"folds": 3, "processes": 1}})
+    sequential = pd.read_csv(Path(model_path, "pred_oof.csv"), index_col=0)
+    pd.testing.assert_frame_equal(oof, sequential)
+
+
+def test_run_search(model_config: Dict[str, Any]) -> None:
+    """Search saves every trial, and the fit stage uses the best parameters, also when only it re-runs."""
+    search = {"params": {"max_depth": [1, 3], "learning_rate": [0.05, 0.2]}, "metric": "mse", "processes": 2}
+    model_config = {**model_config, "search": search}
+    model.run_model_training(model_config)
+    model_path = utils.get_model_path(model_config)
+
+    leaderboard = pd.read_csv(Path(model_path, "search_leaderboard.csv"))
+    assert len(leaderboard) == 4
+    assert leaderboard["mse"].is_monotonic_increasing
+    assert {"params", "mse", "wall_time"}.issubset(leaderboard.columns)
+    with open(Path(model_path, "search_params.json")) as f:
+        best = json.load(f)
+    assert best == {**model_config["model_params"], **json.loads(leaderboard.loc[0, "params"])}
+    searched = Path(model_path, "search_leaderboard.csv").stat().st_mtime_ns
+    fitted = Path(model_path, "model.joblib").stat().st_mtime_ns
+
+    model.run_model_training({**model_config, "plot_max_clip": 0.9})
+    assert Path(model_path, "search_leaderboard.csv").stat().st_mtime_ns == searched
+    assert Path(model_path, "model.joblib").stat().st_mtime_ns != fitted
+    estimator = model.load_estimator(model_config)
+    assert {name: estimator.get_params()[name] for name in best} == best
+
+
+def test_run_search_halving(model_config: Dict[str, Any]) -> None:
+    """Halving fits fewer candidates in each round, with increasing resource."""
+    search = {
+        "method": "halving",
+        "params": {"max_depth": [1, 2, 3], "learning_rate": [0.05, 0.1, 0.2]},
+        "resource": "n_estimators",
+        "processes": 2,
+    }
+    model.run_model_training({**model_config, "search": search})
+    model_path = utils.get_model_path(model_config)
+
+    leaderboard = pd.read_csv(Path(model_path, "search_leaderboard.csv"))
+    rounds = leaderboard.groupby("round")["resource"].agg(["size", "first"])
+    assert rounds["size"].tolist() == [9, 3, 1]
+    assert rounds["first"].is_monotonic_increasing
+    assert rounds["first"].iloc[-1] == 50
+    assert model.load_estimator(model_config).n_estimators == 50
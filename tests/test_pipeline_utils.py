@@ -0,0 +1,91 @@
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Tests for ndj_pipeline utils.py."""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from ndj_pipeline import utils
+
+
+def check_contains(values: pd.Series, patterns: list) -> None:
+    """Checks matches agree with searching each pattern separately."""
+    expected = np.column_stack([values.str.contains(pattern, na=False).astype(bool) for pattern in patterns])
+    np.testing.assert_array_equal(utils.match_patterns(values, patterns), expected)
+
+
+def test_match_patterns_overlapping() -> None:
+    """Patterns are found even where their matches overlap."""
+    values = pd.Series(["abcd", "abc", "bcd", "xyz", np.nan])
+    result = utils.match_patterns(values, ["abc", "bcd"])
+    np.testing.assert_array_equal(result, [[1, 1], [1, 0], [0, 1], [0, 0], [0, 0]])
+    check_contains(values, ["abc", "bcd", "b", "^a", "d$"])
+
+
+def test_match_patterns_flags() -> None:
+    """Leading inline flags apply to their own pattern only."""
+    values = pd.Series(["REMOVE_me", "remove", "Keep", np.nan])
+    result = utils.match_patterns(values, ["(?i)remove", "keep", "(?i)(?s)KEEP"])
+    np.testing.assert_array_equal(result, [[1, 0, 0], [1, 0, 0], [0, 0, 1], [0, 0, 0]])
+    check_contains(values, ["(?i)remove", "keep", "(?i)(?s)KEEP"])
+
+
+def test_match_patterns_fallback() -> None:
+    """Patterns which cannot be combined are searched one at a time."""
+    values = pd.Series(["aa", "ab", "_p0", np.nan])
+    check_contains(values, ["(a)\\1", "b"])
+    check_contains(values, ["(?P<_p0>a)", "_p0"])
+
+
+def test_scope_inline_flags() -> None:
+    """Global flags are rewritten as flags scoped to the pattern."""
+    assert utils.scope_inline_flags("(?i)abc") == "(?i:abc)"
+    assert utils.scope_inline_flags("(?i)(?s)a.c") == "(?is:a.c)"
+    assert utils.scope_inline_flags("abc(?i)") == "abc(?i)"
+
+
+def test_partitioned_parquet_round_trip(tmp_path: Path) -> None:
+    """Chunks written as a partitioned dataset read back with the same values, types and row order."""
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "pclass": rng.integers(1, 4, 1_000),
+            "age": rng.normal(size=1_000),
+            "sex": pd.array(rng.integers(0, 2, 1_000), dtype="Int64"),
+            "cabin": rng.choice(["a", "b"], 1_000),
+        }
+    )
+    df.loc[600:, "cabin"] = None
+    output_path = Path(tmp_path, "data.parquet")
+    chunks = (df.iloc[i : i + 300] for i in range(0, len(df), 300))
+
+    assert utils.write_parquet_chunks(chunks, output_path, partition_cols=["pclass"], row_group_size=50) == len(df)
+    assert sorted(path.name for path in output_path.iterdir()) == [
+        "_common_metadata",
+        "pclass=1",
+        "pclass=2",
+        "pclass=3",
+    ]
+    pd.testing.assert_frame_equal(utils.read_parquet_dataset(output_path), df)
+    filtered = utils.read_parquet_dataset(output_path, columns=["age"], filters=ds.field("pclass") == 2)
+    pd.testing.assert_frame_equal(filtered, df.loc[df["pclass"] == 2, ["age"]])
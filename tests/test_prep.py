@@ -0,0 +1,333 @@
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Tests for prep.py."""
+from pathlib import Path
+from typing import Any, Dict
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ndj_pipeline import prep, utils
+
+
+@pytest.fixture
+def keyed() -> pd.DataFrame:
+    """Rows indexed by a unique key, with an unbalanced stratum column."""
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {"key": np.arange(10_000) * 7 + 3, "group": rng.choice(["a", "b", "c"], 10_000, p=[0.6, 0.3, 0.1])}
+    )
+    return df.set_index("key")
+
+
+def test_hash_split_deterministic(keyed: pd.DataFrame) -> None:
+    """Rows keep their assignment when reordered or when more rows are added."""
+    is_test = pd.Series(prep.hash_split_mask(keyed, 0.2), index=keyed.index)
+    shuffled = keyed.sample(frac=1, random_state=1)
+    pd.testing.assert_series_equal(
+        pd.Series(prep.hash_split_mask(shuffled, 0.2), index=shuffled.index), is_test[shuffled.index]
+    )
+
+    subset = keyed.iloc[:5_000]
+    assert (prep.hash_split_mask(subset, 0.2) == is_test.iloc[:5_000].to_numpy()).all()
+
+
+def test_hash_split_salt(keyed: pd.DataFrame) -> None:
+    """A different salt gives a different split."""
+    assert (prep.hash_split_mask(keyed, 0.2, salt="a") != prep.hash_split_mask(keyed, 0.2, salt="b")).any()
+
+
+def test_hash_split_share(keyed: pd.DataFrame) -> None:
+    """Test share is close to test_size, and exact at the extremes."""
+    assert abs(prep.hash_split_mask(keyed, 0.2).mean() - 0.2) < 0.02
+    assert prep.hash_split_mask(keyed, 1.0).all()
+    assert not prep.hash_split_mask(keyed, 0.0).any()
+
+
+def test_hash_split_chunks(keyed: pd.DataFrame) -> None:
+    """Masks of chunks are the same as the mask of all rows, with or without strata."""
+    for stratify, test_size in [(None, 0.3), (["group"], {"a": 0.1, "b": 0.5, "c": 1.0})]:
+        is_test = prep.hash_split_mask(keyed, test_size, stratify=stratify)
+        chunks = [
+            prep.hash_split_mask(keyed.iloc[i : i + 999], test_size, stratify=stratify) for i in range(0, 10_000, 999)
+        ]
+        np.testing.assert_array_equal(np.concatenate(chunks), is_test)
+
+
+def test_hash_split_stratify(keyed: pd.DataFrame) -> None:
+    """Each stratum's test share is close to its test_size, and unaffected by other strata."""
+    test_size = {"a": 0.1, "b": 0.5, "c": 1.0}
+    is_test = prep.hash_split_mask(keyed, test_size, stratify=["group"])
+    shares = pd.Series(is_test).groupby(keyed["group"].to_numpy()).mean()
+    assert abs(shares["a"] - 0.1) < 0.02
+    assert abs(shares["b"] - 0.5) < 0.03
+    assert shares["c"] == 1.0
+
+    a_rows = (keyed["group"] == "a").to_numpy()
+    np.testing.assert_array_equal(is_test[a_rows], prep.hash_split_mask(keyed.loc[a_rows], 0.1))
+    np.testing.assert_array_equal(
+        prep.hash_split_mask(keyed, 0.2, stratify=["group"]), prep.hash_split_mask(keyed, 0.2)
+    )
+
+
+@pytest.mark.parametrize("test_size", [-0.1, 1.5, 2_000, {"a": 0.1, "b": 0.2}, {"a": 0.1, "b": 0.2, "c": 2.0}])
+def test_hash_split_invalid_size(keyed: pd.DataFrame, test_size: Any) -> None:
+    """Sizes outside a fraction, row counts, or strata without a size raise."""
+    with pytest.raises(ValueError):
+        prep.hash_split_mask(keyed, test_size, stratify=["group"])
+
+
+def test_hash_split_needs_unique_key(keyed: pd.DataFrame) -> None:
+    """Hashing row positions would not be stable, so a unique key is required."""
+    model_config = {"split": {"method": "hash", "test_size": 0.2}}
+    with pytest.raises(ValueError, match="unique_key"):
+        prep.split(keyed.reset_index(drop=True), model_config)
+    train, test = prep.split(keyed, {**model_config, "unique_key": ["key"]})
+    assert len(train) + len(test) == len(keyed)
+
+    model_config = {"split": {"method": "hash"}, "unique_key": ["key"]}
+    train, test = prep.split(keyed, model_config)
+    assert abs(len(test) / len(keyed) - 0.25) < 0.02
+
+
+def test_load_pushdown_filters(model_config: Dict[str, Any]) -> None:
+    """Only config columns are loaded, and pushed down filters skip the same rows as filtering after loading."""
+    utils.create_model_folder(model_config)
+    df = prep.load_data_and_key(model_config)
+    assert list(df.columns) == [col for col in prep.required_columns(model_config) if col != "passengerid"]
+    pushed = prep.load_data_and_key({**model_config, "pushdown_filters": True})
+    pd.testing.assert_frame_equal(pushed, prep.apply_filtering(df, model_config))
+    assert len(pushed) < len(df)
+
+
+@pytest.mark.parametrize("dtype", [object, "category"])
+def test_apply_filtering(model_config: Dict[str, Any], dtype: Any) -> None:
+    """Filtering matches per label `str.contains`, and counts rows matching each label."""
+    utils.create_model_folder(model_config)
+    rng = np.random.default_rng(2)
+    values = pd.Series(rng.choice(["", "remove_me", "drop", "remove_me drop", None], 1_000), dtype=dtype)
+    df = pd.DataFrame({"_filter": values, "x": range(1_000)})
+    labels = ["remove", "drop", "missing"]
+
+    filtered = prep.apply_filtering(df, {**model_config, "filters": labels})
+    contains = pd.concat([values.astype(object).str.contains(label, na=False) for label in labels], axis=1)
+    pd.testing.assert_frame_equal(filtered, df.loc[~contains.any(axis=1)])
+    counts = pd.read_csv(Path(utils.get_model_path(model_config), "filter_counts.csv"), index_col="filter")
+    assert counts["rows_matched"].tolist() == contains.sum().tolist()
+    assert (
+        counts["rows_matched_only"].tolist()
+        == (contains & (contains.sum(axis=1) == 1).to_numpy()[:, None]).sum().tolist()
+    )
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_feature_matrix(tmp_path: Path, dtype: str) -> None:
+    """Dense matrices hold feature values in order as one contiguous array of the config dtype."""
+    df = pd.DataFrame(
+        {
+            "age": [1.5, np.nan, 3.0, 4.0],
+            "sibsp": pd.array([1, None, 0, 2], dtype="Int64"),
+            "name": ["a", "b", "c", "d"],
+            "fare": [7.25, 8.05, 53.1, 0.0],
+        }
+    )
+    features = ["fare", "age", "sibsp"]
+    model_config = {"matrix_dtype": dtype}
+    expected = df[features].astype(float).to_numpy(dtype=dtype)
+
+    matrix = prep.feature_matrix(df, features, model_config)
+    assert matrix.dtype == dtype
+    assert matrix.flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(matrix, expected)
+
+    output_path = Path(tmp_path, "X.npy")
+    mapped = prep.feature_matrix(df, features, model_config, output_path=output_path)
+    assert isinstance(mapped, np.memmap)
+    mapped.flush()
+    np.testing.assert_array_equal(np.load(output_path), expected)
+
+    prep.save_feature_matrix(matrix, Path(tmp_path, "saved"))
+    np.testing.assert_array_equal(prep.load_feature_matrix(Path(tmp_path, "saved")), expected)
+    columns = prep.matrix_columns(matrix, features, ["sibsp", "fare"], df.index)
+    pd.testing.assert_frame_equal(columns, pd.DataFrame(expected[:, [2, 0]], columns=["sibsp", "fare"]))
+
+
+def test_sparse_feature_matrix() -> None:
+    """Sparse dummy matrices hold the same values as dense one-hot matrices."""
+    df = pd.DataFrame({"age": [1.5, np.nan, 3.0, 4.0], "pclass": [1, 2, 3, 2], "embarked": ["s", "c", "s", "q"]})
+    model_config = {"dummy_features": ["pclass", "embarked"], "min_dummy_percent": 0.3}
+    encoder = prep.fit_dummy_encoder(df, model_config)
+    dense, dummy_features = prep.apply_dummy_encoder(df.copy(), encoder)
+    codes, _ = prep.apply_dummy_encoder(df.copy(), encoder, sparse_dummies=True)
+    features = ["age"] + dummy_features
+
+    expected = prep.feature_matrix(dense, features, model_config)
+    matrix = prep.feature_matrix(codes, features, {**model_config, "sparse_dummies": True})
+    np.testing.assert_array_equal(matrix.toarray(), expected)
+    assert matrix.nnz < expected.size
+
+
+def test_dummy_encoder_unseen_values() -> None:
+    """Encoded columns match `pd.get_dummies` of fitted values, with unseen values in `_other_combined`."""
+    train = pd.DataFrame({"embarked": ["S", "C", "Q", "S", "S", "C"]})
+    new = pd.DataFrame({"embarked": ["C", "Z", "S", None, "Q"]}, index=[5, 6, 7, 8, 9])
+    encoder = prep.fit_dummy_encoder(train, {"dummy_features": ["embarked"], "min_dummy_percent": 0.0})
+    assert encoder["embarked"]["names"] == [f"embarked_##_{value}" for value in ["c", "q", "s", "other_combined"]]
+
+    encoded, names = prep.apply_dummy_encoder(new.copy(), encoder)
+    expected = pd.get_dummies(new["embarked"].str.lower(), dtype=np.uint8).reindex(
+        columns=["c", "q", "s"], fill_value=0
+    )
+    expected["other_combined"] = (1 - expected.sum(axis=1)).astype(np.uint8)
+    pd.testing.assert_frame_equal(encoded[names], expected.add_prefix("embarked_##_"))
+
+
+def test_compressed_dummies_min_percent() -> None:
+    """Values below the minimum incidence share the `_other_combined` column."""
+    values = pd.Series(["a"] * 6 + ["b"] * 3 + ["c"])
+    encoding = prep.fit_compressed_dummies(values, "x", 0.2)
+    assert encoding["names"] == ["x_##_a", "x_##_b", "x_##_other_combined"]
+    assert prep.dummy_codes(values, encoding).tolist() == [0] * 6 + [1] * 3 + [2]
+
+
+def test_hashed_dummies() -> None:
+    """Hashed dummies are `pd.get_dummies` columns summed into a fixed number of buckets, the same for any data."""
+    rng = np.random.default_rng(3)
+    values = pd.Series(rng.integers(0, 500, 2_000).astype(str))
+    encoding = prep.fit_hashed_dummies("ticket", 16)
+    codes = prep.dummy_codes(values, encoding)
+    assert codes.min() >= 0 and codes.max() < 16
+    np.testing.assert_array_equal(prep.dummy_codes(values.iloc[::-1], encoding), codes[::-1])
+
+    dummies = pd.get_dummies(values)
+    buckets = pd.Series(codes).groupby(values.to_numpy()).first()[dummies.columns]
+    expected = dummies.T.groupby(buckets.to_numpy()).sum().T.reindex(columns=range(16), fill_value=0)
+    encoded = prep.dense_dummies(codes, encoding["names"], values.index)
+    np.testing.assert_array_equal(encoded.to_numpy(), expected.to_numpy())
+
+
+@pytest.fixture
+def features() -> pd.DataFrame:
+    """Feature columns of several types, with missing values."""
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame(
+        {
+            "float": rng.normal(size=500).round(1),
+            "int": pd.array(rng.integers(0, 5, 500), dtype="Int64"),
+            "object": pd.Series(rng.integers(0, 5, 500), dtype=object),
+            "complete": rng.integers(0, 5, 500).astype(float),
+        }
+    )
+    for col in ["float", "int", "object"]:
+        df.loc[rng.random(500) < 0.2, col] = np.nan
+    return df
+
+
+@pytest.mark.parametrize("how", ["mean", "median", "mode"])
+def test_aggregate_block(how: str) -> None:
+    """Block aggregates match pandas, ignoring missing values, with NaN for columns without values."""
+    rng = np.random.default_rng(4)
+    block = rng.integers(0, 7, (301, 5)).astype(float)
+    block[rng.random(block.shape) < 0.3] = np.nan
+    block[:, 2] = np.nan
+    expected = pd.DataFrame(block).agg(how) if how != "mode" else pd.DataFrame(block).mode().iloc[0]
+    np.testing.assert_allclose(prep.aggregate_block(block, how), expected.to_numpy(dtype=float))
+
+
+def test_feature_aggregates(features: pd.DataFrame, model_config: Dict[str, Any]) -> None:
+    """Aggregates in blocks match pandas aggregation, and are saved to the model folder."""
+    utils.create_model_folder(model_config)
+    how = {"float": "mean", "int": "median", "complete": "mode"}
+    model_config = {**model_config, "simple_features": how, "aggregate_block_columns": 2, "aggregate_threads": 2}
+    expected = pd.Series(
+        [features["float"].mean(), features["int"].median(), features["complete"].mode().min()], index=list(how)
+    )
+
+    aggregates = prep.get_simple_feature_aggregates(features, model_config)
+    pd.testing.assert_series_equal(aggregates, expected, check_names=False)
+    pd.testing.assert_series_equal(prep.load_feature_aggregates(model_config), aggregates, check_names=False)
+    features.loc[0, "float"] = np.inf
+    with pytest.raises(ValueError, match="float"):
+        prep.get_simple_feature_aggregates(features, model_config)
+
+
+def test_fill_column(features: pd.DataFrame) -> None:
+    """Missing values are filled like `fillna`, without changing arrays the column shared before."""
+    expected = features.fillna({"float": 0.5, "int": 3, "object": 2})
+    before = {col: features[col].copy() for col in features}
+    arrays = {col: features[col].array for col in features}
+    for col, value in {"float": 0.5, "int": 3, "object": 2, "complete": 1.0}.items():
+        prep.fill_column(features, col, value)
+    pd.testing.assert_frame_equal(features, expected)
+    for col, array in arrays.items():
+        pd.testing.assert_extension_array_equal(array, before[col].array)
+    with pytest.raises(TypeError):
+        prep.fill_column(pd.DataFrame({"int": pd.array([1, None], dtype="Int64")}), "int", 0.5)
+
+
+def test_apply_feature_aggregates(features: pd.DataFrame) -> None:
+    """Aggregates fill like `fillna`, optionally downcasting, and report columns of the wrong type."""
+    aggregates = pd.Series({"float": 0.5, "int": 3.0, "complete": 1.0})
+    filled = prep.apply_feature_aggregates(features.copy(), aggregates, downcast=True)
+    expected = features.fillna(aggregates.to_dict())
+    pd.testing.assert_frame_equal(filled, expected, check_dtype=False)
+    assert filled["float"].dtype == np.float32
+    assert filled["int"].dtype == np.int8
+    with pytest.raises(ValueError, match="int"):
+        prep.apply_feature_aggregates(features.copy(), pd.Series({"int": 0.5}))
+
+
+@pytest.mark.parametrize("split", [{"method": "hash", "test_size": 0.3}, {"field": "is_train"}])
+def test_iter_train_batches(model_config: Dict[str, Any], split: Dict[str, Any]) -> None:
+    """Training rows read in batches, and their streamed aggregates, match those of model training."""
+    utils.create_model_folder(model_config)
+    df = pd.read_parquet(Path(*model_config["data_file"]))
+    df.loc[df.index % 7 == 0, "fare"] = np.nan
+    df["is_train"] = df.index % 3
+    input_path = Path(utils.get_model_path(model_config), "data.parquet")
+    utils.write_parquet_chunks([df.iloc[:150], df.iloc[150:]], input_path, row_group_size=40, dataset=True)
+
+    how = {"age": "mean", "sibsp": "median", "parch": "mode"}
+    model_config = {
+        **model_config,
+        "data_file": [str(input_path)],
+        "split": split,
+        "simple_features": how,
+        "streaming_aggregates": {"sketch_size": 1_000, "mode_counters": 100},
+    }
+    data = prep.apply_filtering(prep.load_data_and_key(model_config), model_config)
+    train = prep.filter_target(prep.split(data, model_config)[0], model_config)
+
+    batches = list(prep.iter_train_batches(model_config, list(how), batch_size=64))
+    assert len(batches) > 1
+    streamed = pd.concat(batches).sort_index()
+    pd.testing.assert_frame_equal(streamed[list(how)], train[list(how)].sort_index())
+
+    expected = prep.get_simple_feature_aggregates(train, model_config)
+    aggregates = prep.stream_feature_aggregates(prep.iter_train_batches(model_config, list(how), 64), model_config)
+    pd.testing.assert_series_equal(aggregates, expected, check_names=False)
+
+
+def test_iter_train_batches_random_split(model_config: Dict[str, Any]) -> None:
+    """Random splits depend on all rows, so training rows cannot be read in batches."""
+    with pytest.raises(ValueError, match="split"):
+        next(prep.iter_train_batches(model_config, ["age"]))
@@ -0,0 +1,46 @@
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Tests for score.py."""
+from pathlib import Path
+from typing import Any, Dict
+
+import pandas as pd
+import pytest
+
+from ndj_pipeline import model, score, utils
+
+
+@pytest.mark.parametrize(
+    "model_function_name, model_params",
+    [("gbr", {"n_estimators": 20, "random_state": 42}), ("hgbr", {"max_iter": 20, "random_state": 42})],
+)
+def test_score_round_trip(model_config: Dict[str, Any], model_function_name: str, model_params: Dict[str, Any]) -> None:
+    """Scoring saved model assets in batches reproduces the test predictions of model training."""
+    model_config = {**model_config, "model_function_name": model_function_name, "model_params": model_params}
+    model.run_model_training(model_config)
+    model_path = utils.get_model_path(model_config)
+    expected = pd.read_csv(Path(model_path, "pred_test.csv"), index_col="passengerid")
+
+    output_path = Path(model_path, "scored.csv")
+    rows = score.run(model_config, output_path=output_path, batch_size=64)
+    scored = pd.read_csv(output_path, index_col="passengerid")
+    assert rows == len(pd.read_parquet(Path(*model_config["data_file"])))
+    pd.testing.assert_series_equal(scored.loc[expected.index, "Predicted"], expected["Predicted"])
@@ -0,0 +1,120 @@
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Tests for streaming.py."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from ndj_pipeline import streaming
+
+
+def rank_error(values: np.ndarray, estimate: float) -> float:
+    """Distance of an estimated median from the true median, as a fraction of all values."""
+    return abs(np.searchsorted(np.sort(values), estimate) / len(values) - 0.5)
+
+
+def test_quantile_sketch_exact_when_small() -> None:
+    """Median is exact while no values have been compacted."""
+    sketch = streaming.QuantileSketch(size=200)
+    values = np.array([5.0, 1.0, np.nan, 3.0, 2.0])
+    sketch.update(values)
+    assert sketch.count == 4
+    assert sketch.median() == 2.5
+
+
+def test_quantile_sketch_rank_error() -> None:
+    """Median rank error stays around 1 / size, while memory stays bounded."""
+    values = np.random.default_rng(0).lognormal(size=100_000)
+    sketch = streaming.QuantileSketch(size=200)
+    for batch in np.array_split(values, 50):
+        sketch.update(batch)
+    assert sketch.count == len(values)
+    assert sum(len(level) for level in sketch.levels) < 5 * 200
+    assert rank_error(values, sketch.median()) < 0.02
+
+
+def test_quantile_sketch_merge() -> None:
+    """Merged sketches count every value, with the same rank error as a single sketch."""
+    values = np.random.default_rng(1).normal(size=60_000)
+    sketches = [streaming.QuantileSketch(size=200, seed=i) for i in range(3)]
+    for sketch, part in zip(sketches, np.array_split(values, 3)):
+        sketch.update(part)
+    merged = streaming.QuantileSketch(size=200)
+    for sketch in sketches:
+        merged.merge(sketch)
+    assert merged.count == len(values)
+    assert sum(len(level) for level in merged.levels) < 5 * 200
+    assert rank_error(values, merged.median()) < 0.02
+
+
+def test_heavy_hitters_exact_within_size() -> None:
+    """Counts and mode are exact with no more distinct values than counters."""
+    hitters = streaming.HeavyHitters(size=10)
+    hitters.update(np.array([1.0, 2.0, 2.0, np.nan]))
+    hitters.update(np.array([3.0, 3.0, 2.0, 1.0, 1.0]))
+    assert hitters.counts.to_dict() == {1.0: 3, 2.0: 3, 3.0: 2}
+    assert hitters.mode() == 1.0
+
+
+def test_heavy_hitters_error_bound() -> None:
+    """Values more frequent than n / (size + 1) are kept, undercounted by at most that."""
+    rng = np.random.default_rng(2)
+    values = np.concatenate([np.full(3_000, 7.0), np.full(1_500, 8.0), rng.integers(100, 10_000, 20_000)])
+    rng.shuffle(values)
+    size = 20
+    hitters = streaming.HeavyHitters(size=size)
+    for batch in np.array_split(values.astype(float), 10):
+        hitters.update(batch)
+
+    bound = len(values) / (size + 1)
+    true_counts = pd.Series(values).value_counts()
+    assert len(hitters.counts) <= size
+    for value in [7.0, 8.0]:
+        assert true_counts[value] - bound <= hitters.counts[value] <= true_counts[value]
+    assert hitters.mode() == 7.0
+
+
+def test_heavy_hitters_merge() -> None:
+    """Merging keeps frequent values seen across separate streams."""
+    rng = np.random.default_rng(3)
+    first, second = streaming.HeavyHitters(size=10), streaming.HeavyHitters(size=10)
+    first.update(np.concatenate([np.full(500, 1.0), rng.integers(10, 1_000, 2_000).astype(float)]))
+    second.update(np.concatenate([np.full(600, 1.0), np.full(700, 2.0), rng.integers(10, 1_000, 2_000).astype(float)]))
+    first.merge(second)
+    assert len(first.counts) <= 10
+    assert first.mode() == 1.0
+    assert 1_100 - 5_800 / 11 <= first.counts[1.0] <= 1_100
+
+
+def test_streaming_aggregator_matches_exact() -> None:
+    """Means are exact, and medians and modes exact for small data, whatever the batching."""
+    df = pd.DataFrame({"a": [1.0, np.nan, 3.0, 4.0], "b": [1, 2, 2, 5], "c": [2.0, 2.0, np.nan, 1.0]})
+    aggregator = streaming.StreamingAggregator({"a": "mean", "b": "median", "c": "mode"})
+    for start in range(0, len(df), 3):
+        aggregator.update(df.iloc[start : start + 3])
+    expected = pd.Series({"a": df["a"].mean(), "b": df["b"].median(), "c": 2.0})
+    pd.testing.assert_series_equal(aggregator.result(), expected, check_names=False)
+
+
+def test_streaming_aggregator_unsupported() -> None:
+    """Only mean, median and mode can be streamed."""
+    with pytest.raises(ValueError, match="sum"):
+        streaming.StreamingAggregator({"a": "sum"})
@@ -0,0 +1,86 @@
+# Copyright © 2021 by Nick Jenkins. All rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Tests for transform.py."""
+import shutil
+from pathlib import Path
+from typing import List
+
+import pandas as pd
+import pytest
+
+from ndj_pipeline import transform, utils
+
+repo = Path(__file__).parents[1]
+
+
+@pytest.fixture
+def raw_lines(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> List[bytes]:
+    """Lines of the raw titanic csv, in a temporary copy of the data folders."""
+    for path in [Path("data", "titanic_features.yaml"), Path("schemas", "titanic.yaml")]:
+        Path(tmp_path, path.parent).mkdir(exist_ok=True)
+        shutil.copy(Path(repo, path), Path(tmp_path, path))
+    Path(tmp_path, "data", "processed").mkdir()
+    monkeypatch.chdir(tmp_path)
+    return Path(repo, "data", "titanic.csv").read_bytes().splitlines(keepends=True)
+
+
+def read_processed() -> pd.DataFrame:
+    """Processed titanic rows, in key order."""
+    df = pd.read_parquet(Path("data", "processed", "titanic.parquet"))
+    return df.sort_values("passengerid").reset_index(drop=True)
+
+
+def test_incremental_append(raw_lines: List[bytes]) -> None:
+    """Appending raw rows and updating gives the same processed data as a full rebuild."""
+    raw_path = Path("data", "titanic.csv")
+    raw_path.write_bytes(b"".join(raw_lines[:400]) + raw_lines[400][:10])
+    transform.update_titanic_features(chunksize=100)
+    assert len(read_processed()) == 399
+
+    raw_path.write_bytes(b"".join(raw_lines))
+    transform.update_titanic_features(chunksize=100)
+    appended = read_processed()
+    parts = {path.name.split("-")[1] for path in Path("data", "processed", "titanic.parquet").glob("part-*.parquet")}
+    assert parts == {"0", "1"}
+
+    utils.remove_parquet(Path("data", "processed", "titanic.parquet"))
+    transform.update_titanic_features(chunksize=100)
+    pd.testing.assert_frame_equal(appended, read_processed())
+
+
+def test_incremental_rebuild(raw_lines: List[bytes]) -> None:
+    """Previously processed rows being modified, or the fingerprint changing, forces a full rebuild."""
+    raw_path = Path("data", "titanic.csv")
+    output_path = Path("data", "processed", "titanic.parquet")
+    raw_path.write_bytes(b"".join(raw_lines[:400]))
+    transform.update_titanic_features(chunksize=100)
+    fingerprint = transform.titanic_fingerprint(Path("schemas", "titanic.yaml"), Path("data", "titanic_features.yaml"))
+    assert transform.load_watermark(output_path, raw_path, fingerprint)["rows"] == 399
+    assert transform.load_watermark(output_path, raw_path, "changed") is None
+
+    raw_path.write_bytes(b"".join(raw_lines[:399] + [raw_lines[400]] + raw_lines[401:]))
+    assert transform.load_watermark(output_path, raw_path, fingerprint) is None
+    raw_path.write_bytes(b"".join(raw_lines[:300]))
+    assert transform.load_watermark(output_path, raw_path, fingerprint) is None
+
+    raw_path.write_bytes(b"".join(raw_lines[:399] + [raw_lines[400]] + raw_lines[401:]))
+    transform.update_titanic_features(chunksize=100)
+    assert list(read_processed()["passengerid"]) == list(range(1, 399)) + list(range(400, 892))